@@ -0,0 +1,148 @@
+import os
+import re
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from media_utils import normalize_time, time_to_seconds
+
+logger = logging.getLogger(__name__)
+
+# Настройки пакетного режима
+BATCH_MAX_CLIPS = int(os.getenv("BATCH_MAX_CLIPS", "10"))
+# Диапазоны, между которыми меньше этого зазора (секунды), скачиваются одним куском
+BATCH_MERGE_GAP = int(os.getenv("BATCH_MERGE_GAP", "30"))
+# Сколько клипов нарезается одновременно из скачанных кусков
+BATCH_PARALLEL_CUTS = int(os.getenv("BATCH_PARALLEL_CUTS", "3"))
+
+# Telegram принимает не больше 10 файлов в одной медиагруппе
+MEDIA_GROUP_SIZE = 10
+
+RANGE_PATTERN = re.compile(r'^\s*([\d:]+)\s*[-–—]\s*([\d:]+)\s*$')
+
+
+@dataclass
+class Clip:
+    """Один запрошенный фрагмент"""
+    start_time: str
+    end_time: str
+
+    @property
+    def start(self) -> int:
+        return time_to_seconds(self.start_time)
+
+    @property
+    def end(self) -> int:
+        return time_to_seconds(self.end_time)
+
+
+@dataclass
+class Section:
+    """Кусок видео, который скачивается один раз и покрывает несколько клипов"""
+    start: int
+    end: int
+    clips: list[int] = field(default_factory=list)
+
+
+class RangeParseError(ValueError):
+    """Ошибка в списке диапазонов"""
+
+
+def parse_ranges(text: str) -> list[Clip]:
+    """
+    Разбирает список диапазонов: по одному на строку или через запятую/точку с запятой
+    Например: 02:21:15-02:21:50, 1:05-1:30
+    """
+    clips = []
+    for line_number, chunk in enumerate(re.split(r'[\n,;]+', text), start=1):
+        if not chunk.strip():
+            continue
+        match = RANGE_PATTERN.match(chunk)
+        if not match:
+            raise RangeParseError(f"Не удалось разобрать диапазон: {chunk.strip()}")
+        start_time = normalize_time(match.group(1))
+        end_time = normalize_time(match.group(2))
+        if not start_time or not end_time:
+            raise RangeParseError(f"Неверный формат времени: {chunk.strip()}")
+        if time_to_seconds(end_time) <= time_to_seconds(start_time):
+            raise RangeParseError(f"Время конца должно быть больше времени начала: {chunk.strip()}")
+        clips.append(Clip(start_time, end_time))
+
+    if not clips:
+        raise RangeParseError("Не найдено ни одного диапазона")
+    if len(clips) > BATCH_MAX_CLIPS:
+        raise RangeParseError(f"Слишком много фрагментов: {len(clips)} (максимум {BATCH_MAX_CLIPS})")
+    return clips
+
+
+def merge_ranges(clips: list[Clip], gap: int = BATCH_MERGE_GAP) -> list[Section]:
+    """
+    Объединяет пересекающиеся и близкие диапазоны в минимальные покрывающие куски
+    Скачать лишние gap секунд дешевле, чем делать еще один запрос к YouTube
+    """
+    sections: list[Section] = []
+    for index in sorted(range(len(clips)), key=lambda i: clips[i].start):
+        clip = clips[index]
+        if sections and clip.start <= sections[-1].end + gap:
+            sections[-1].end = max(sections[-1].end, clip.end)
+            sections[-1].clips.append(index)
+        else:
+            sections.append(Section(clip.start, clip.end, [index]))
+    return sections
+
+
+def covered_seconds(sections: list[Section]) -> int:
+    """Сколько секунд видео нужно скачать для всех кусков"""
+    return sum(section.end - section.start for section in sections)
+
+
+class ClipCutter:
+    """
+    Нарезает клипы из скачанных кусков параллельно, начиная с каждого куска, как только он готов
+    cut_clip(source, start, end, output) - корутина нарезки, возвращает True при успехе
+    """
+
+    def __init__(self, clips: list[Clip], sections: list[Section], output_dir: Path, cut_clip,
+                 parallel: int = BATCH_PARALLEL_CUTS):
+        self.clips = clips
+        self.sections = sections
+        self.output_dir = output_dir
+        self.cut_clip = cut_clip
+        self.semaphore = asyncio.Semaphore(max(1, parallel))
+        self.results: list[Path | None] = [None] * len(clips)
+        self.tasks: dict[int, list[asyncio.Task]] = {}
+
+    def add(self, section_index: int, source: Path):
+        """Запускает нарезку клипов куска (повторный вызов для того же куска ничего не делает)"""
+        if section_index in self.tasks:
+            return
+        self.tasks[section_index] = [
+            asyncio.create_task(self._cut(section_index, clip_index, source))
+            for clip_index in self.sections[section_index].clips
+        ]
+
+    async def _cut(self, section_index: int, clip_index: int, source: Path):
+        section = self.sections[section_index]
+        clip = self.clips[clip_index]
+        output = self.output_dir / f"clip_{clip_index}_{clip.start_time.replace(':', '-')}_{clip.end_time.replace(':', '-')}.mp4"
+        # Время внутри скачанного куска отсчитывается от его начала
+        offset_start = clip.start - section.start
+        offset_end = clip.end - section.start
+        async with self.semaphore:
+            if await self.cut_clip(source, offset_start, offset_end, output):
+                self.results[clip_index] = output
+            else:
+                logger.warning(f"Не удалось вырезать фрагмент {clip.start_time}-{clip.end_time}")
+
+    async def wait(self) -> list[Path | None]:
+        """Дожидается всех нарезок; клипы кусков, которые так и не добавили, остаются None"""
+        await asyncio.gather(*(task for tasks in self.tasks.values() for task in tasks))
+        return self.results
+
+    async def close(self):
+        """Останавливает нарезки (задача прервалась)"""
+        tasks = [task for tasks in self.tasks.values() for task in tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
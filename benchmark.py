@@ -0,0 +1,536 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import logging
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+from dataclasses import dataclass
+from functools import partial
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from yt_dlp.extractor.common import InfoExtractor
+
+from metadata_cache import MetadataCache
+from media_utils import extract_video_id
+from job_journal import JobJournal
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Рабочая папка бенчмарка: синтетические исходники кешируются между запусками
+BENCH_DIR = Path(os.getenv("BENCH_DIR", ".bench"))
+BASELINE_FILE = Path("benchmark_baseline.json")
+# Допустимое ухудшение относительно базовой линии (доля)
+BENCH_TOLERANCE = float(os.getenv("BENCH_TOLERANCE", "0.25"))
+# Длительность синтетических исходников (секунды)
+SOURCE_SECONDS = int(os.getenv("BENCH_SOURCE_SECONDS", "180"))
+# Клип начинается не на ключевом кадре, чтобы работала умная нарезка
+CLIP_START = 37
+CLIP_LENGTHS = [5, 30, 120]
+QUICK_CLIP_LENGTHS = [5, 30]
+CASE_TIMEOUT = 1800
+
+# Токен фейкового Bot API и чат, в который "отправляются" клипы
+FAKE_TOKEN = "1:bench"
+FAKE_CHAT_ID = 42
+RESULT_PREFIX = "BENCH_RESULT "
+
+# Меньшие отклонения - шум измерений, а не регрессия
+NOISE_FLOOR = {"wall": 0.5, "cpu": 0.5, "peak_rss_mb": 20, "write_bytes": MB}
+
+
+@dataclass(frozen=True)
+class SourceFormat:
+    """Синтетический исходник: как его отдает YouTube (DASH-потоки или один файл)"""
+    name: str
+    codec: str  # h264 | vp9
+    width: int
+    height: int
+    fps: int
+    layout: str  # dash | muxed
+
+    @property
+    def video_id(self) -> str:
+        # ID той же длины, что у YouTube, чтобы ссылки проходили extract_video_id
+        return f"bench{SOURCE_FORMATS.index(self):06d}"
+
+    @property
+    def url(self) -> str:
+        return f"https://www.youtube.com/watch?v={self.video_id}"
+
+    def files(self) -> dict[str, str]:
+        stem = f"{self.name}_{SOURCE_SECONDS}s"
+        if self.layout == 'muxed':
+            return {'muxed': f"{stem}.mp4"}
+        if self.codec == 'vp9':
+            return {'video': f"{stem}.video.webm", 'audio': f"{stem}.audio.webm"}
+        # Как у YouTube: фрагментированный MP4 с индексом sidx в начале файла
+        return {'video': f"{stem}.video.frag.mp4", 'audio': f"{stem}.audio.frag.m4a"}
+
+    def formats(self, base_url: str) -> list[dict]:
+        """Форматы в том виде, в каком их возвращает экстрактор yt-dlp"""
+        files = self.files()
+        vcodec = 'vp09.00.40.08' if self.codec == 'vp9' else 'avc1.640028'
+        video = {'vcodec': vcodec, 'width': self.width, 'height': self.height, 'fps': self.fps}
+        if self.layout == 'muxed':
+            return [{'format_id': '18', 'url': f"{base_url}/{files['muxed']}", 'ext': 'mp4',
+                     'acodec': 'mp4a.40.2', 'protocol': 'http', **video}]
+        audio_ext, acodec = ('webm', 'opus') if self.codec == 'vp9' else ('m4a', 'mp4a.40.2')
+        return [
+            {'format_id': '137', 'url': f"{base_url}/{files['video']}", 'ext': files['video'].rsplit('.', 1)[1],
+             'acodec': 'none', 'protocol': 'http', **video},
+            {'format_id': '140', 'url': f"{base_url}/{files['audio']}", 'ext': audio_ext,
+             'vcodec': 'none', 'acodec': acodec, 'abr': 128, 'protocol': 'http'},
+        ]
+
+
+SOURCE_FORMATS = [
+    SourceFormat('h264_1080p30_dash', 'h264', 1920, 1080, 30, 'dash'),
+    SourceFormat('h264_720p30_muxed', 'h264', 1280, 720, 30, 'muxed'),
+    SourceFormat('h264_1080p60_dash', 'h264', 1920, 1080, 60, 'dash'),
+    SourceFormat('vp9_720p30_dash', 'vp9', 1280, 720, 30, 'dash'),
+]
+
+
+def clock(seconds: int) -> str:
+    """Секунды в формате HH:MM:SS, как их вводит пользователь"""
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def generate_source(source: SourceFormat, media_dir: Path):
+    """Создает исходник из testsrc2/sine (ключевой кадр раз в 2 секунды, как у YouTube)"""
+    video_input = ['-f', 'lavfi', '-i',
+                   f"testsrc2=size={source.width}x{source.height}:rate={source.fps}:duration={SOURCE_SECONDS}"]
+    audio_input = ['-f', 'lavfi', '-i', f"sine=frequency=440:sample_rate=48000:duration={SOURCE_SECONDS}"]
+    if source.codec == 'vp9':
+        video_args = ['-c:v', 'libvpx-vp9', '-deadline', 'realtime', '-cpu-used', '8', '-b:v', '2M']
+        audio_args = ['-c:a', 'libopus', '-b:a', '128k']
+    else:
+        movflags = '+faststart' if source.layout == 'muxed' else '+dash+global_sidx'
+        video_args = ['-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-movflags', movflags]
+        audio_args = ['-c:a', 'aac', '-b:a', '128k', '-movflags', movflags]
+    video_args += ['-g', str(source.fps * 2)]
+
+    jobs = []
+    files = source.files()
+    if source.layout == 'muxed':
+        jobs.append([*video_input, *audio_input, *video_args, *audio_args, str(media_dir / files['muxed'])])
+    else:
+        jobs.append([*video_input, *video_args, '-an', str(media_dir / files['video'])])
+        jobs.append([*audio_input, *audio_args, '-vn', str(media_dir / files['audio'])])
+
+    for args in jobs:
+        output = Path(args[-1])
+        if output.exists():
+            continue
+        logger.info(f"Создаю исходник {output.name}")
+        partial_output = output.with_name(f"tmp_{output.name}")
+        result = subprocess.run(['ffmpeg', '-v', 'error', *args[:-1], '-y', str(partial_output)],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"ffmpeg не смог создать {output.name}: {result.stderr}")
+        partial_output.replace(output)
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Раздает исходники с поддержкой Range: ffmpeg и yt-dlp перематывают видео запросами диапазонов"""
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def _serve(self, send_body: bool):
+        path = Path(self.translate_path(self.path))
+        if not path.is_file():
+            self.send_error(404)
+            return
+        size = path.stat().st_size
+        start, end = 0, size - 1
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+            else:
+                start = max(size - int(match.group(2)), 0)
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{size}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(str(path)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not send_body:
+            return
+        remaining = end - start + 1
+        try:
+            with open(path, 'rb') as source:
+                source.seek(start)
+                while remaining > 0:
+                    chunk = source.read(min(remaining, 256 * 1024))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+                    self.server.count(len(chunk))
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg закрывает соединение, как только прочитал нужный фрагмент
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    """Фейковый Bot API: принимает отправку клипов и отвечает правдоподобными сообщениями"""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.count(len(body))
+        method = self.path.rsplit('/', 1)[-1]
+        self.server.calls.append(method)
+        message = {"message_id": len(self.server.calls), "date": int(time.time()),
+                   "chat": {"id": FAKE_CHAT_ID, "type": "private"}}
+        file = {"file_id": f"bench-file-{len(self.server.calls)}", "file_unique_id": f"u{len(self.server.calls)}"}
+        if method == 'getMe':
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method in ('sendMessage', 'editMessageText'):
+            result = {**message, "text": ""}
+        elif method == 'sendDocument':
+            result = {**message, "document": file}
+        elif method == 'sendVideo':
+            result = {**message, "video": {**file, "width": 0, "height": 0, "duration": 0}}
+        elif method == 'sendMediaGroup':
+            result = [{**message, "document": file}]
+        else:
+            result = True
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CountingServer(ThreadingHTTPServer):
+    """HTTP-сервер, который считает переданные байты"""
+    daemon_threads = True
+
+    def __init__(self, handler):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.bytes = 0
+        self.calls: list[str] = []
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, size: int):
+        with self._lock:
+            self.bytes += size
+
+    def reset(self):
+        with self._lock:
+            self.bytes = 0
+            self.calls = []
+
+    def start(self) -> 'CountingServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class StubYoutubeIE(InfoExtractor):
+    """Экстрактор-заглушка: отдает форматы синтетических исходников вместо обращения к YouTube"""
+    _VALID_URL = r'https?://(?:www\.)?youtube\.com/watch\?v=(?P<id>bench\d{6})'
+
+    def __init__(self, media_url: str, downloader=None):
+        super().__init__(downloader)
+        self.media_url = media_url
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        source = next(source for source in SOURCE_FORMATS if source.video_id == video_id)
+        return {
+            'id': video_id,
+            'title': source.name,
+            'duration': SOURCE_SECONDS,
+            'formats': source.formats(self.media_url),
+        }
+
+
+class StubMetadataCache(MetadataCache):
+    """Кеш метаданных, который извлекает их экстрактором-заглушкой (yt-dlp по ссылке выбрал бы настоящий YouTube)"""
+
+    def __init__(self, media_url: str):
+        super().__init__()
+        self.media_url = media_url
+
+    def get_or_extract(self, url: str, ydl) -> dict:
+        key = extract_video_id(url) or url
+        info = self.get(key)
+        if info is None:
+            extractor = StubYoutubeIE(self.media_url)
+            ydl.add_info_extractor(extractor)
+            info = ydl.extract_info(url, download=False, process=False, ie_key=extractor.ie_key())
+            self.put(key, info)
+        return info
+
+
+def resource_snapshot() -> dict:
+    """Время и ввод-вывод процесса вместе с завершившимися дочерними (ffmpeg)"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io = {}
+    try:
+        for line in Path('/proc/self/io').read_text().splitlines():
+            name, _, value = line.partition(':')
+            io[name] = int(value)
+    except OSError:
+        # Не Linux: байты ввода-вывода не считаем
+        pass
+    return {
+        'wall': time.perf_counter(),
+        'cpu': own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+        'read_bytes': io.get('read_bytes', 0),
+        'write_bytes': io.get('write_bytes', 0),
+        'rchar': io.get('rchar', 0),
+        'wchar': io.get('wchar', 0),
+    }
+
+
+class StageTimer:
+    """Разница ресурсов между отметками этапов конвейера"""
+
+    def __init__(self):
+        self.stages: dict[str, dict] = {}
+        self.first = self.last = resource_snapshot()
+
+    def mark(self, stage: str):
+        now = resource_snapshot()
+        stage_stats = self.stages.setdefault(stage, {name: 0 for name in now})
+        for name, value in now.items():
+            stage_stats[name] += value - self.last[name]
+        self.last = now
+
+    def total(self) -> dict:
+        return {name: self.last[name] - self.first[name] for name in self.last}
+
+
+class TimedJournal(JobJournal):
+    """Журнал задач, который отмечает время прохождения этапов"""
+
+    def __init__(self, timer: StageTimer):
+        super().__init__()
+        self.timer = timer
+
+    def advance(self, job_id: str | None, stage: str, **artifacts):
+        super().advance(job_id, stage, **artifacts)
+        self.timer.mark(stage)
+
+
+async def measure_case(source: SourceFormat, seconds: int, media_url: str, api_url: str) -> dict:
+    """Выполняет один клип: конвейер скачивания и нарезки, затем отправку в фейковый Bot API"""
+    # Модули бота читают настройки при импорте - к этому моменту окружение задано родительским процессом
+    from telegram import Bot, Message
+
+    import bot
+    import pipeline
+    from format_selector import get_tier
+    from process_runner import JobHandle
+
+    timer = StageTimer()
+    pipeline.metadata_cache = StubMetadataCache(media_url)
+    pipeline.journal = TimedJournal(timer)
+    start_time = clock(CLIP_START)
+    end_time = clock(CLIP_START + seconds)
+    # Качество по умолчанию, как у пользователя, который его не выбирал (bot.process_clip)
+    quality = get_tier(None).name
+    journal_id = pipeline.journal.create(pipeline.JOB_KIND_CLIP, FAKE_CHAT_ID, FAKE_CHAT_ID,
+                                         {'url': source.url, 'start_time': start_time, 'end_time': end_time,
+                                          'quality': quality})
+
+    clip = await pipeline.fetch_clip(JobHandle("bench"), source.url, start_time, end_time, journal_id, quality)
+    timer.mark('finalize')
+    if clip is None:
+        raise RuntimeError("конвейер не вернул клип")
+    output_bytes = len(clip) if isinstance(clip, bytes) else clip.stat().st_size
+
+    async with Bot(FAKE_TOKEN, base_url=f"{api_url}/bot") as telegram_bot:
+        message = Message.de_json({"message_id": 1, "date": 0, "chat": {"id": FAKE_CHAT_ID, "type": "private"}},
+                                  telegram_bot)
+        sent = await bot.upload_clip(message, clip, start_time, end_time)
+    timer.mark('upload')
+
+    total = timer.total()
+    return {
+        **total,
+        'stages': timer.stages,
+        'output_bytes': output_bytes,
+        'sent_as': 'video' if sent.video else 'document',
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_child_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def run_case(source: SourceFormat, seconds: int, media_server: CountingServer, api_server: CountingServer,
+             streaming: bool) -> dict:
+    """Запускает случай в отдельном процессе: чистые кеши и пиковая память только этого случая"""
+    work_dir = Path(tempfile.mkdtemp(prefix='run_', dir=BENCH_DIR))
+    env = {
+        **os.environ,
+        'TELEGRAM_BOT_TOKEN': FAKE_TOKEN,
+        'DOWNLOAD_DIR': str(work_dir / 'downloads'),
+        'CLIP_CACHE_DIR': str(work_dir / 'cache'),
+        'JOB_JOURNAL_DB': str(work_dir / 'journal.sqlite3'),
+        'TMPFS_DIR': '',
+        'STREAMING_MODE': '1' if streaming else '0',
+    }
+    media_server.reset()
+    api_server.reset()
+    case = {'source': source.name, 'seconds': seconds, 'media_url': media_server.base_url,
+            'api_url': api_server.base_url}
+    try:
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run-case', json.dumps(case)],
+            env=env, capture_output=True, text=True, timeout=CASE_TIMEOUT,
+        )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    lines = [line for line in result.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+    if result.returncode != 0 or not lines:
+        raise RuntimeError(f"случай {source.name}/{seconds}s завершился ошибкой:\n{result.stderr[-3000:]}")
+    stats = json.loads(lines[-1][len(RESULT_PREFIX):])
+    stats['served_bytes'] = media_server.bytes
+    stats['uploaded_bytes'] = api_server.bytes
+    return stats
+
+
+def compare(results: dict, baseline: dict, tolerance: float = BENCH_TOLERANCE) -> list[str]:
+    """Сравнивает результаты с базовой линией и возвращает описания регрессий"""
+    regressions = []
+    for case, stats in results.items():
+        reference = baseline.get('cases', {}).get(case)
+        if not reference:
+            continue
+        for metric, floor in NOISE_FLOOR.items():
+            old, new = reference.get(metric, 0), stats.get(metric, 0)
+            if old > 0 and new > old * (1 + tolerance) and new - old > floor:
+                regressions.append(f"{case}: {metric} {old:.2f} -> {new:.2f} (+{(new / old - 1) * 100:.0f}%)")
+    return regressions
+
+
+def format_report(results: dict) -> str:
+    lines = [f"{'случай':<28}{'время':>8}{'CPU':>8}{'чтение':>9}{'запись':>9}{'сеть':>9}{'RSS':>7}{'ffmpeg':>8}  этапы (с)"]
+    for case, stats in results.items():
+        stages = ", ".join(f"{name} {value['wall']:.1f}" for name, value in stats['stages'].items())
+        lines.append(
+            f"{case:<28}{stats['wall']:>7.1f}s{stats['cpu']:>7.1f}s"
+            f"{stats['read_bytes'] / MB:>7.0f}MB{stats['write_bytes'] / MB:>7.0f}MB"
+            f"{stats['served_bytes'] / MB:>7.0f}MB{stats['peak_rss_mb']:>6.0f}M{stats['peak_child_rss_mb']:>7.0f}M"
+            f"  {stages}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк конвейера нарезки на синтетических видео, без сети")
+    parser.add_argument('--quick', action='store_true', help="короткие клипы и два формата")
+    parser.add_argument('--sources', help="форматы исходников через запятую: " +
+                        ", ".join(source.name for source in SOURCE_FORMATS))
+    parser.add_argument('--lengths', help="длины клипов в секундах через запятую")
+    parser.add_argument('--streaming', action='store_true', help="потоковый режим (STREAMING_MODE)")
+    parser.add_argument('--output', type=Path, help="сохранить результаты в JSON")
+    parser.add_argument('--baseline', type=Path, default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true', help="записать результаты как базовую линию")
+    parser.add_argument('--check', action='store_true', help="код возврата 1 при регрессии относительно базовой линии")
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.run_case:
+        case = json.loads(args.run_case)
+        source = next(source for source in SOURCE_FORMATS if source.name == case['source'])
+        stats = asyncio.run(measure_case(source, case['seconds'], case['media_url'], case['api_url']))
+        print(RESULT_PREFIX + json.dumps(stats), flush=True)
+        return
+
+    # Базовая линия зависит от машины и в репозиторий не входит - без нее проверять не с чем
+    if args.check and not args.save_baseline and not args.baseline.exists():
+        parser.exit(2, f"Базовая линия {args.baseline} не найдена. Сначала запишите ее на этой машине:\n"
+                       f"  python benchmark.py --save-baseline --baseline {args.baseline}\n")
+
+    sources = SOURCE_FORMATS[:2] if args.quick else SOURCE_FORMATS
+    if args.sources:
+        names = set(args.sources.split(','))
+        sources = [source for source in SOURCE_FORMATS if source.name in names]
+    lengths = QUICK_CLIP_LENGTHS if args.quick else CLIP_LENGTHS
+    if args.lengths:
+        lengths = [int(value) for value in args.lengths.split(',')]
+    lengths = [seconds for seconds in lengths if CLIP_START + seconds <= SOURCE_SECONDS]
+
+    media_dir = BENCH_DIR / 'media'
+    media_dir.mkdir(parents=True, exist_ok=True)
+    for source in sources:
+        generate_source(source, media_dir)
+
+    media_server = CountingServer(partial(RangeRequestHandler, directory=str(media_dir))).start()
+    api_server = CountingServer(FakeBotApiHandler).start()
+    results = {}
+    try:
+        for source in sources:
+            for seconds in lengths:
+                case = f"{source.name}/{seconds}s"
+                logger.info(f"Случай {case}")
+                results[case] = run_case(source, seconds, media_server, api_server, args.streaming)
+    finally:
+        media_server.shutdown()
+        api_server.shutdown()
+
+    print(format_report(results))
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2), encoding='utf-8')
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps({
+            'machine': {'platform': platform.platform(), 'cpus': os.cpu_count(), 'python': platform.python_version()},
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'cases': results,
+        }, indent=2), encoding='utf-8')
+        print(f"Базовая линия записана в {args.baseline}")
+        return
+
+    if args.baseline.exists():
+        regressions = compare(results, json.loads(args.baseline.read_text(encoding='utf-8')))
+        for regression in regressions:
+            print(f"РЕГРЕССИЯ {regression}")
+        if not regressions:
+            print("Регрессий относительно базовой линии нет")
+        if regressions and args.check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
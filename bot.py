@@ -1,76 +1,109 @@
 import os
 import re
+import time
+import signal
 import asyncio
 import logging
+from contextlib import ExitStack
 from pathlib import Path
 from dotenv import load_dotenv
-from telegram import Update
+
+# Загружаем переменные окружения до импорта модулей, которые читают настройки
+load_dotenv()
+
+from telegram import InputMediaDocument, Message, ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
 import yt_dlp
 
-# Загружаем переменные окружения
-load_dotenv()
+from batch import BATCH_MAX_CLIPS, MEDIA_GROUP_SIZE, Clip, RangeParseError, covered_seconds, merge_ranges, parse_ranges
+from clip_cache import MEDIA_DOCUMENT, MEDIA_VIDEO, ClipCache, SingleFlight, clip_key
+from media_utils import extract_video_id, normalize_time, time_to_seconds
+from encoding_profiles import TELEGRAM_LOCAL_MODE, UPLOAD_LIMIT, profile_signature
+from core_budget import core_budget
+from format_selector import DEFAULT_QUALITY, QUALITY_TIERS, get_tier
+from throttle import TokenBucket, classify_error, youtube_throttle
+from metrics import (describe_counters, describe_summaries, inc, install_trace_logging, job_trace, observe, registry,
+                     replay, stage, trace_id)
+from delivery import TELEGRAM_POOL_SIZE, TELEGRAM_TIMEOUT, UPLOAD_TIMEOUT, streamable_video, upload_input
+from process_runner import JobCancelled, JobHandle
+from pipeline import (JOB_KIND_BATCH, JOB_KIND_CLIP, download_batch, fetch_clip, job_priority, journal, metadata_cache,
+                      wants_preview, warm_ydl_pool, workspaces, ydl_pool)
+from streaming import PREVIEW_MAX_SECONDS, PREVIEW_QUALITY
+from workspace import DiskQuotaError
+from job_journal import JOB_CANCELLED, JOB_DONE, JOB_FAILED, JOURNAL_MAX_RESUMES, STAGE_UPLOADED, JournalEntry
+from durable_queue import JOB_BACKEND, QUEUE_INFLIGHT, DurableQueue, RemoteJobError, run_remote
+from scheduler import JobScheduler, QueueFullError, UserLimitError, format_eta
+from webhook_server import (HEALTH_SERVER, HTTP_LISTEN, HTTP_PORT, WEBHOOK_MAX_CONNECTIONS, WEBHOOK_PATH, WEBHOOK_SECRET,
+                            WEBHOOK_URL, HealthServer, derive_secret)
 
 # Настройка логирования
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format='%(asctime)s - %(name)s - [%(trace_id)s] %(levelname)s - %(message)s',
     level=logging.INFO
 )
+install_trace_logging()
 logger = logging.getLogger(__name__)
 
-# Создаем директорию для загрузок
-DOWNLOAD_DIR = Path("downloads")
-DOWNLOAD_DIR.mkdir(exist_ok=True)
-
 # Получаем токен бота
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN не установлен в переменных окружения")
 
+# Адрес Bot API (например, локальный сервер telegram-bot-api или фейковый сервер для тестов)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip('/')
+
+# Пользователи Telegram (через запятую), которым доступна команда /stats
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").replace(' ', '').split(',') if user_id}
+
+# Бот реагирует только на сообщения - остальные обновления Telegram даже не присылает
+ALLOWED_UPDATES = [Update.MESSAGE]
+
 # Состояния для диалога
-WAITING_FOR_URL, WAITING_FOR_START_TIME, WAITING_FOR_END_TIME = range(3)
+WAITING_FOR_URL, WAITING_FOR_QUALITY, WAITING_FOR_START_TIME, WAITING_FOR_END_TIME, WAITING_FOR_RANGES = range(5)
 
+# Как часто проверять позицию в очереди и прогресс задачи (секунды)
+QUEUE_STATUS_INTERVAL = 1
+# Статусное сообщение редактируется только при изменениях и не чаще раза в столько секунд
+STATUS_EDIT_INTERVAL = float(os.getenv("STATUS_EDIT_INTERVAL", "3"))
+# Сколько правок статусов в секунду бот делает на всех пользователей (Telegram ограничивает ~30 запросов/с)
+STATUS_EDIT_RATE = float(os.getenv("STATUS_EDIT_RATE", "10"))
 
-def normalize_time(time_str: str) -> str | None:
-    """
-    Нормализует время до формата HH:MM:SS
-    Возвращает None если формат неверный
-    """
-    # Убираем пробелы
-    time_str = time_str.strip()
-    
-    # Проверяем формат HH:MM:SS
-    time_pattern = r'^(\d{1,2}):(\d{2}):(\d{2})$'
-    match = re.match(time_pattern, time_str)
-    
-    if match:
-        hours = int(match.group(1))
-        minutes = int(match.group(2))
-        seconds = int(match.group(3))
-        
-        # Проверяем валидность
-        if minutes >= 60 or seconds >= 60:
-            return None
-        
-        # Форматируем с ведущими нулями
-        return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
-    
-    # Проверяем формат MM:SS
-    time_pattern_mmss = r'^(\d{1,2}):(\d{2})$'
-    match = re.match(time_pattern_mmss, time_str)
-    
-    if match:
-        minutes = int(match.group(1))
-        seconds = int(match.group(2))
-        
-        # Проверяем валидность
-        if minutes >= 60 or seconds >= 60:
-            return None
-        
-        # Форматируем как 00:MM:SS
-        return f"00:{minutes:02d}:{seconds:02d}"
-    
-    return None
+# Подписи этапов задачи в статусном сообщении
+STAGE_LABELS = {
+    'extract': "Получаю информацию о видео",
+    'download': "Скачиваю",
+    'merge': "Склеиваю дорожки",
+    'probe': "Проверяю файл",
+    'cut': "Вырезаю фрагмент",
+    'encode': "Перекодирую",
+    'stream': "Вырезаю и кодирую потоком",
+}
+
+# Общая очередь для процессов worker.py (JOB_BACKEND=queue); иначе задачи выполняются в процессе бота
+job_queue = DurableQueue() if JOB_BACKEND == "queue" else None
+
+# Планировщик задач скачивания (воркеры запускаются в post_init)
+# С общей очередью он только ограничивает пользователей, а параллелизм задают процессы worker.py
+scheduler = JobScheduler(workers=QUEUE_INFLIGHT) if job_queue else JobScheduler()
+
+# Кеш готовых клипов и объединение одинаковых запросов
+clip_cache = ClipCache()
+# Кеш клипов делит бюджет диска с папками задач и освобождает место под новые задачи
+workspaces.add_cache(clip_cache)
+clip_flights = SingleFlight()
+
+# Общий темп правок статусов: лишние правки пропускаются, следующая покажет свежий прогресс
+status_edits = TokenBucket(STATUS_EDIT_RATE, max(1, int(STATUS_EDIT_RATE)))
+
+# Задачи пользователей в работе: user_id -> [(задача планировщика, ручка отмены)]
+active_jobs: dict[int, list] = {}
+
+# Проверка готовности и метрики (отдельно от публичного порта webhook)
+health_server: HealthServer | None = None
+
+# Бот останавливается: прерванные задачи остаются в журнале и продолжаются после запуска
+shutting_down = False
 
 
 def is_valid_youtube_url(text: str) -> bool:
@@ -81,252 +114,116 @@ def is_valid_youtube_url(text: str) -> bool:
     return bool(re.match(url_pattern, text.strip()))
 
 
-def download_video_segment(url: str, start_time: str, end_time: str) -> Path | None:
-    """
-    Скачивает фрагмент видео с YouTube
-    Пытается использовать download_sections для скачивания только нужного фрагмента
-    """
-    import subprocess
-    
-    # Формируем имя файла (безопасное для файловой системы)
-    safe_timestamp = f"{start_time.replace(':', '-')}_{end_time.replace(':', '-')}"
-    output_path = DOWNLOAD_DIR / f"video_{safe_timestamp}"
-    
-    # Вычисляем длительность для download_sections
-    start_seconds = sum(int(x) * 60 ** (2 - i) for i, x in enumerate(start_time.split(':')))
-    end_seconds = sum(int(x) * 60 ** (2 - i) for i, x in enumerate(end_time.split(':')))
-    duration = end_seconds - start_seconds
-    
-    # Опции для yt-dlp - пытаемся скачать только нужный фрагмент
-    # download_sections работает с форматами, которые поддерживают сегментированную загрузку
-    ydl_opts = {
-        # Используем лучший видео формат (без ограничений) + лучшее аудио
-        # bv* - лучшее видео любого формата, ba* - лучшее аудио
-        'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/bestvideo+bestaudio/best',
-        'outtmpl': str(output_path) + '.%(ext)s',
-        # Не указываем merge_output_format, чтобы сохранить исходное качество
-        # Будем перекодировать в MP4 через ffmpeg с сохранением качества
-        'download_sections': f'*{start_time}-{end_time}',  # Пытаемся скачать только сегмент
-        'quiet': False,
-        'no_warnings': False,
-        'extract_flat': False,
-        # Опции для обхода блокировок YouTube
-        'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'referer': 'https://www.youtube.com/',
-        'extractor_args': {
-            'youtube': {
-                'player_client': ['android', 'web'],  # Пробуем разные клиенты
-            }
-        },
-    }
-    
+async def run_remote_job(handle: JobHandle, kind: str, payload: dict, clip_seconds: int) -> dict:
+    """Выполняет задачу в процессе worker.py через общую очередь (прогресс и превью воркера попадают в handle)"""
     try:
-        logger.info(f"Пытаюсь скачать только фрагмент: URL={url}, сегмент={start_time}-{end_time}")
-        
-        # Пытаемся скачать только нужный фрагмент
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
-        
-        logger.info(f"Скачивание завершено, ищу файл: {output_path}")
-        
-        # Проверяем, что файл создан (yt-dlp может добавить расширение)
-        # Сначала проверяем mp4 (merge_output_format)
-        expected_path = output_path.with_suffix('.mp4')
-        if expected_path.exists():
-            file_size = expected_path.stat().st_size
-            logger.info(f"Файл скачан: {expected_path}, размер: {file_size / 1024 / 1024:.2f} MB")
-            
-            # Проверяем размер - если файл слишком большой, значит скачался весь файл
-            # Примерно: 10 секунд видео в максимальном качестве должно быть < 50 MB
-            # Если файл > 100 MB, вероятно скачался весь файл (для 10 секунд это точно много)
-            if file_size > 100 * 1024 * 1024:  # Больше 100 MB - явно весь файл
-                logger.warning(f"Файл слишком большой ({file_size / 1024 / 1024:.2f} MB), возможно скачался весь файл")
-                logger.info("Обрезаю и перекодирую через ffmpeg для совместимости...")
-                # Обрезаем и перекодируем через ffmpeg в совместимый формат
-                final_path = DOWNLOAD_DIR / f"video_{safe_timestamp}.mp4"
-                ffmpeg_cmd = [
-                    'ffmpeg',
-                    '-i', str(expected_path),
-                    '-ss', start_time,
-                    '-t', str(duration),
-                    '-c:v', 'libx264',  # Перекодируем видео в H.264
-                    '-preset', 'slow',  # Медленнее, но лучше качество
-                    '-crf', '15',  # Очень высокое качество (почти без потерь)
-                    '-c:a', 'aac',  # Перекодируем аудио в AAC
-                    '-b:a', '256k',  # Высокий битрейт аудио для лучшего качества
-                    '-movflags', '+faststart',  # Для стриминга и мобильных устройств
-                    '-pix_fmt', 'yuv420p',  # Совместимость с iPhone и другими устройствами
-                    '-y',
-                    str(final_path)
-                ]
-                result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True, timeout=600)
-                if result.returncode == 0 and final_path.exists():
-                    expected_path.unlink()  # Удаляем большой файл
-                    logger.info(f"Фрагмент обрезан и перекодирован: {final_path}")
-                    return final_path
-                else:
-                    logger.error(f"Ошибка при перекодировании: {result.stderr}")
-            
-            # Если файл нормального размера, проверяем длительность через ffprobe
-            logger.info("Проверяю длительность и формат файла...")
-            
-            # Проверяем длительность и кодек через ffprobe
-            probe_cmd = [
-                'ffprobe',
-                '-v', 'error',
-                '-select_streams', 'v:0',
-                '-show_entries', 'stream=codec_name,width,height,duration',
-                '-show_entries', 'format=duration',
-                '-of', 'json',
-                str(expected_path)
-            ]
-            probe_result = subprocess.run(probe_cmd, capture_output=True, text=True, timeout=10)
-            
-            needs_reencode = True
-            if probe_result.returncode == 0:
-                import json
-                try:
-                    probe_data = json.loads(probe_result.stdout)
-                    video_stream = probe_data.get('streams', [{}])[0]
-                    format_info = probe_data.get('format', {})
-                    
-                    codec = video_stream.get('codec_name', '')
-                    actual_duration = float(format_info.get('duration', 0))
-                    
-                    logger.info(f"Кодек: {codec}, Длительность: {actual_duration:.2f}s, Ожидалось: {duration}s")
-                    
-                    # Если длительность намного больше ожидаемой, значит скачался весь файл
-                    if actual_duration > duration * 2:
-                        logger.warning(f"Файл слишком длинный ({actual_duration:.2f}s vs {duration}s), обрезаю...")
-                        # Обрезаем файл, но сначала пробуем копирование без перекодирования
-                        final_path = DOWNLOAD_DIR / f"video_{safe_timestamp}_final.mp4"
-                        
-                        # Пробуем обрезать с копированием потоков (без перекодирования)
-                        ffmpeg_cmd_copy = [
-                            'ffmpeg',
-                            '-i', str(expected_path),
-                            '-ss', start_time,
-                            '-t', str(duration),
-                            '-c', 'copy',  # Копируем без перекодирования
-                            '-avoid_negative_ts', 'make_zero',
-                            '-y',
-                            str(final_path)
-                        ]
-                        result = subprocess.run(ffmpeg_cmd_copy, capture_output=True, text=True, timeout=300)
-                        if result.returncode == 0 and final_path.exists():
-                            expected_path.unlink()
-                            logger.info(f"Фрагмент обрезан без перекодирования: {final_path}")
-                            return final_path
-                        else:
-                            logger.warning(f"Копирование не удалось, перекодирую: {result.stderr}")
-                    
-                    # Проверяем, нужна ли перекодировка для совместимости
-                    # Если кодек уже H.264 и формат MP4, можно попробовать без перекодирования
-                    if codec == 'h264' and expected_path.suffix == '.mp4':
-                        logger.info("Файл уже в H.264/MP4, проверяю совместимость...")
-                        # Проверяем pix_fmt
-                        pix_fmt_cmd = [
-                            'ffprobe',
-                            '-v', 'error',
-                            '-select_streams', 'v:0',
-                            '-show_entries', 'stream=pix_fmt',
-                            '-of', 'default=noprint_wrappers=1:nokey=1',
-                            str(expected_path)
-                        ]
-                        pix_result = subprocess.run(pix_fmt_cmd, capture_output=True, text=True, timeout=10)
-                        if pix_result.returncode == 0:
-                            pix_fmt = pix_result.stdout.strip()
-                            logger.info(f"Pix_fmt: {pix_fmt}")
-                            # Если yuv420p или yuv420p10le, можно использовать без перекодирования
-                            if pix_fmt in ['yuv420p', 'yuv420p10le']:
-                                logger.info("Файл совместим, используем без перекодирования")
-                                needs_reencode = False
-                except (ValueError, KeyError, json.JSONDecodeError) as e:
-                    logger.warning(f"Не удалось проанализировать файл: {e}")
-            
-            # Перекодируем только если нужно
-            if needs_reencode:
-                logger.info("Перекодирую в совместимый формат для мобильных устройств...")
-                final_path = DOWNLOAD_DIR / f"video_{safe_timestamp}_final.mp4"
-                ffmpeg_cmd = [
-                    'ffmpeg',
-                    '-i', str(expected_path),
-                    '-c:v', 'libx264',
-                    '-preset', 'veryslow',  # Максимальное качество
-                    '-crf', '13',  # Еще выше качество (13 - почти без потерь)
-                    '-c:a', 'aac',
-                    '-b:a', '320k',  # Максимальный битрейт аудио
-                    '-movflags', '+faststart',
-                    '-pix_fmt', 'yuv420p',
-                    '-y',
-                    str(final_path)
-                ]
-                result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True, timeout=900)
-                if result.returncode == 0 and final_path.exists():
-                    expected_path.unlink()
-                    logger.info(f"Фрагмент перекодирован: {final_path}")
-                    return final_path
-                else:
-                    logger.warning(f"Перекодирование не удалось: {result.stderr}")
-            
-            # Если не нужно перекодирование, возвращаем исходный файл
-            logger.info("Используем исходный файл без перекодирования")
-            return expected_path
-        
-        # Ищем файл с любым расширением и перекодируем в совместимый формат
-        for ext in ['.mp4', '.mkv', '.webm', '.m4a']:
-            alt_path = output_path.with_suffix(ext)
-            if alt_path.exists():
-                file_size = alt_path.stat().st_size
-                logger.info(f"Найден файл: {alt_path}, размер: {file_size / 1024 / 1024:.2f} MB")
-                
-                # Перекодируем в совместимый MP4 формат
-                final_path = DOWNLOAD_DIR / f"video_{safe_timestamp}_final.mp4"
-                logger.info("Перекодирую в совместимый формат для мобильных устройств...")
-                ffmpeg_cmd = [
-                    'ffmpeg',
-                    '-i', str(alt_path),
-                    '-c:v', 'libx264',
-                    '-preset', 'slow',  # Медленнее, но лучше качество
-                    '-crf', '15',  # Очень высокое качество
-                    '-c:a', 'aac',
-                    '-b:a', '256k',  # Высокий битрейт аудио для лучшего качества
-                    '-movflags', '+faststart',
-                    '-pix_fmt', 'yuv420p',
-                    '-y',
-                    str(final_path)
-                ]
-                result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True, timeout=600)
-                if result.returncode == 0 and final_path.exists():
-                    alt_path.unlink()  # Удаляем исходный файл
-                    logger.info(f"Файл перекодирован: {final_path}")
-                    return final_path
-                else:
-                    logger.warning(f"Перекодирование не удалось: {result.stderr}")
-                    return alt_path
-        
-        # Ищем файлы, начинающиеся с нашего имени
-        found_files = list(DOWNLOAD_DIR.glob(f"video_{safe_timestamp}*"))
-        logger.info(f"Найдено файлов с паттерном: {len(found_files)}")
-        for file in found_files:
-            if file.is_file():
-                file_size = file.stat().st_size
-                logger.info(f"Найден файл: {file}, размер: {file_size / 1024 / 1024:.2f} MB")
-                return file
-        
-        logger.warning(f"Файл не найден после скачивания. Искал: {output_path}")
-        logger.warning(f"Содержимое директории downloads: {list(DOWNLOAD_DIR.iterdir())}")
-        return None
-            
-    except subprocess.TimeoutExpired:
-        logger.error("Таймаут при обрезке видео")
-        return None
-    except yt_dlp.utils.DownloadError as e:
-        logger.error(f"Ошибка yt-dlp при скачивании: {e}", exc_info=True)
-        raise
-    except Exception as e:
-        logger.error(f"Неожиданная ошибка при скачивании: {e}", exc_info=True)
+        # При перезапуске бота задачу в очереди не отменяем: после запуска бот дождется ее по журналу
+        result = await run_remote(job_queue, kind, payload, priority=job_priority(clip_seconds),
+                                  dedup_key=payload.get('journal_id'), detach=lambda: shutting_down,
+                                  on_progress=handle.restore)
+    except RemoteJobError as e:
+        if e.error_type == 'download':
+            # Сохраняем тип ошибки, чтобы пользователь получил то же сообщение, что и без воркеров
+            raise yt_dlp.utils.DownloadError(str(e))
         raise
+    # Этапы и решения воркера попадают в метрики бота
+    replay(result.pop('metrics', None))
+    return result
+
+
+async def fetch_clip_job(handle: JobHandle, url: str, start_time: str, end_time: str, quality: str,
+                         preview: bool, journal_id: str) -> Path | bytes | None:
+    """Получает клип в процессе бота или через воркер (preview - параллельно приготовить превью)"""
+    if job_queue is None:
+        with job_trace(journal_id):
+            return await fetch_clip(handle, url, start_time, end_time, journal_id, quality, preview)
+    clip_seconds = time_to_seconds(end_time) - time_to_seconds(start_time)
+    payload = {'url': url, 'start_time': start_time, 'end_time': end_time, 'quality': quality,
+               'preview': preview, 'journal_id': journal_id}
+    result = await run_remote_job(handle, JOB_KIND_CLIP, payload, clip_seconds)
+    return Path(result['path']) if result.get('path') else None
+
+
+async def download_batch_job(handle: JobHandle, url: str, clips: list[Clip], quality: str,
+                             journal_id: str) -> list[Path | None]:
+    """Скачивает и нарезает пакет в процессе бота или через воркер"""
+    if job_queue is None:
+        with job_trace(journal_id):
+            return await download_batch(handle, url, clips, journal_id, quality)
+    payload = {
+        'url': url,
+        'clips': [{'start_time': clip.start_time, 'end_time': clip.end_time} for clip in clips],
+        'quality': quality,
+        'journal_id': journal_id,
+    }
+    result = await run_remote_job(handle, JOB_KIND_BATCH, payload, covered_seconds(merge_ranges(clips)))
+    return [Path(path) if path else None for path in result.get('paths', [])]
+
+
+def progress_text(progress: dict) -> str:
+    """Строка этапа задачи: 'Скачиваю: 45% (2.1 MB/s)'"""
+    text = STAGE_LABELS.get(progress.get('stage'), "Обрабатываю")
+    details = []
+    if progress.get('percent') is not None:
+        # Шаг 5% - меньше правок сообщения при том же ощущении движения
+        details.append(f"{int(progress['percent']) // 5 * 5}%")
+    if progress.get('speed'):
+        details.append(f"{progress['speed'] / 1024 / 1024:.1f} MB/s")
+    if not details:
+        return f"{text}..."
+    return f"{text}: {details[0]}" + (f" ({details[1]})" if len(details) > 1 else "")
+
+
+def queue_status_text(job, label: str, handle: JobHandle | None = None) -> str:
+    """Текст статусного сообщения для задачи в очереди или в работе"""
+    if job.started:
+        if handle and handle.progress:
+            return f"⏳ Обработка: {label}\n\n{progress_text(handle.progress)}"
+        return (
+            f"⏳ Скачиваю и обрабатываю {label}...\n\n"
+            f"⏱ Пожалуйста, подождите. Это может занять некоторое время."
+        )
+    return (
+        f"🕐 {label[0].upper()}{label[1:]} в очереди.\n\n"
+        f"Позиция: {scheduler.position(job)}\n"
+        f"Примерное время: {format_eta(scheduler.eta(job))}"
+    )
+
+
+async def wait_for_job(job, status_msg, label: str, handle: JobHandle | None = None):
+    """
+    Ожидает завершения задачи и обновляет статусное сообщение (позиция в очереди, этап и прогресс)
+    Правки объединяются: не чаще STATUS_EDIT_INTERVAL на сообщение и в общем темпе STATUS_EDIT_RATE,
+    пропущенные промежуточные состояния не отправляются - следующая правка покажет последнее
+    """
+    last_text = status_msg.text
+    next_edit = time.monotonic() + STATUS_EDIT_INTERVAL
+    while not job.future.done():
+        await asyncio.wait({job.future}, timeout=QUEUE_STATUS_INTERVAL)
+        if job.future.done():
+            break
+        text = queue_status_text(job, label, handle)
+        if text == last_text or time.monotonic() < next_edit or not status_edits.try_reserve():
+            continue
+        try:
+            await status_msg.edit_text(text)
+            last_text = text
+            next_edit = time.monotonic() + STATUS_EDIT_INTERVAL
+        except RetryAfter as e:
+            # Telegram просит подождать - до этого момента сообщение не трогаем
+            next_edit = time.monotonic() + e.retry_after
+            logger.warning(f"Telegram ограничил правки статуса на {e.retry_after}s")
+        except Exception as e:
+            logger.warning(f"Не удалось обновить статус очереди: {e}")
+    if job.future.cancelled():
+        raise JobCancelled(f"Задача #{job.job_id} отменена")
+    if shutting_down:
+        # Задача могла закончиться из-за убитого ffmpeg - такой результат не отправляем и не закрываем;
+        # готовые файлы после запуска найдутся по журналу
+        if not job.future.exception():
+            logger.info(f"Задача #{job.job_id} завершилась во время остановки, отправлю после запуска")
+        raise JobCancelled(f"Задача #{job.job_id} прервана остановкой бота")
+    return job.future.result()
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -334,6 +231,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "🤖 Привет! Я бот для скачивания фрагментов видео с YouTube."
     )
+    context.user_data.pop('batch', None)
     # Сразу переходим к запросу URL
     await update.message.reply_text("📎 Отправь ссылку на YouTube видео:")
     return WAITING_FOR_URL
@@ -341,6 +239,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def download_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало диалога скачивания"""
+    context.user_data.pop('batch', None)
+    await update.message.reply_text("📎 Отправь ссылку на YouTube видео:")
+    return WAITING_FOR_URL
+
+
+async def batch_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Начало диалога пакетного скачивания: несколько фрагментов одного видео"""
+    context.user_data['batch'] = True
     await update.message.reply_text("📎 Отправь ссылку на YouTube видео:")
     return WAITING_FOR_URL
 
@@ -356,7 +262,35 @@ async def receive_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Сохраняем URL в контексте
     context.user_data['url'] = url
     
-    await update.message.reply_text("⏱️ Отправь время начала в формате 00:00:00:")
+    # Кнопки вместо inline-клавиатуры: бот получает только сообщения (ALLOWED_UPDATES)
+    keyboard = ReplyKeyboardMarkup([list(QUALITY_TIERS)], one_time_keyboard=True, resize_keyboard=True)
+    await update.message.reply_text(
+        f"🎚️ Выбери качество (по умолчанию {get_tier(DEFAULT_QUALITY).name}).\n"
+        f"Чем ниже качество, тем быстрее будет готов клип:",
+        reply_markup=keyboard
+    )
+    return WAITING_FOR_QUALITY
+
+
+async def receive_quality(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Получение уровня качества: он ограничивает разрешение клипа и выбор формата для скачивания"""
+    choice = update.message.text.strip().lower()
+    if choice.rstrip('p') not in {name.rstrip('p') for name in QUALITY_TIERS}:
+        await update.message.reply_text(f"❌ Выбери одно из значений: {', '.join(QUALITY_TIERS)}")
+        return WAITING_FOR_QUALITY
+    
+    context.user_data['quality'] = get_tier(choice).name
+    
+    if context.user_data.get('batch'):
+        await update.message.reply_text(
+            f"⏱️ Отправь фрагменты, по одному на строку (не больше {BATCH_MAX_CLIPS}):\n\n"
+            f"02:21:15-02:21:50\n"
+            f"02:30:00-02:31:10",
+            reply_markup=ReplyKeyboardRemove()
+        )
+        return WAITING_FOR_RANGES
+    
+    await update.message.reply_text("⏱️ Отправь время начала в формате 00:00:00:", reply_markup=ReplyKeyboardRemove())
     return WAITING_FOR_START_TIME
 
 
@@ -398,52 +332,392 @@ async def receive_end_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Время конца должно быть больше времени начала. Попробуй еще раз:")
         return WAITING_FOR_END_TIME
     
-    # Отправляем сообщение о начале загрузки
-    status_msg = await update.message.reply_text(
-        f"⏳ Скачиваю и обрабатываю фрагмент {start_time}-{end_time}...\n\n"
-        f"⏱ Пожалуйста, подождите. Это может занять некоторое время."
-    )
+    await process_clip(update.message, update.effective_user.id, url, start_time, end_time,
+                       quality=context.user_data.get('quality'))
+    
+    # Очищаем данные пользователя
+    context.user_data.clear()
     
+    return ConversationHandler.END
+
+
+async def receive_ranges(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Получение списка фрагментов в пакетном режиме и начало скачивания"""
+    try:
+        clips = parse_ranges(update.message.text)
+    except RangeParseError as e:
+        await update.message.reply_text(f"❌ {e}\n\nОтправь фрагменты еще раз в формате 00:00:00-00:00:00:")
+        return WAITING_FOR_RANGES
+    
+    url = context.user_data.get('url')
+    await process_batch(update.message, update.effective_user.id, url, clips,
+                        quality=context.user_data.get('quality'))
+    
+    # Очищаем данные пользователя
+    context.user_data.clear()
+    
+    return ConversationHandler.END
+
+
+def clip_filename(start_time: str, end_time: str) -> str:
+    """Имя файла клипа для отправки пользователю"""
+    return f"video_{start_time.replace(':', '-')}_{end_time.replace(':', '-')}.mp4"
+
+
+async def upload_clip(message: Message, clip: Path | bytes, start_time: str, end_time: str):
+    """
+    Отправляет клип (файл или данные из потокового режима) и возвращает сообщение
+    Клип h264/AAC с faststart уходит видео с потоковым воспроизведением, остальные - документом,
+    чтобы Telegram не перекодировал их и не ухудшал качество
+    """
+    caption = f"📹 Фрагмент {start_time}-{end_time}"
+    if isinstance(clip, bytes):
+        return await message.reply_document(
+            document=clip,
+            filename=clip_filename(start_time, end_time),
+            caption=caption,
+            read_timeout=UPLOAD_TIMEOUT,
+            write_timeout=UPLOAD_TIMEOUT,
+        )
+    meta = await streamable_video(clip)
+    try:
+        with ExitStack() as stack:
+            if meta:
+                return await message.reply_video(
+                    video=upload_input(clip, stack),
+                    filename=clip_filename(start_time, end_time),
+                    caption=caption,
+                    duration=meta.duration,
+                    width=meta.width,
+                    height=meta.height,
+                    thumbnail=upload_input(meta.thumbnail, stack) if meta.thumbnail else None,
+                    supports_streaming=True,
+                    read_timeout=UPLOAD_TIMEOUT,
+                    write_timeout=UPLOAD_TIMEOUT,
+                )
+            return await message.reply_document(
+                document=upload_input(clip, stack),
+                filename=clip_filename(start_time, end_time),
+                caption=caption,
+                read_timeout=UPLOAD_TIMEOUT,
+                write_timeout=UPLOAD_TIMEOUT,
+            )
+    finally:
+        if meta and meta.thumbnail:
+            meta.thumbnail.unlink(missing_ok=True)
+
+
+def sent_media(sent: Message) -> tuple[str, str]:
+    """file_id отправленного клипа и то, как он отправлен (видео или документ)"""
+    if sent.video:
+        return sent.video.file_id, MEDIA_VIDEO
+    return sent.document.file_id, MEDIA_DOCUMENT
+
+
+def remember_upload(key: str | None, sent: Message):
+    """Запоминает file_id отправленного клипа для повторных запросов"""
+    if key:
+        file_id, media = sent_media(sent)
+        clip_cache.store_file_id(key, file_id, media)
+
+
+async def send_cached_clip(message: Message, key: str, start_time: str, end_time: str) -> bool:
+    """
+    Пытается отправить клип из кеша: сначала по file_id, затем из дискового кеша
+    Возвращает True, если клип отправлен
+    """
+    for media in (MEDIA_VIDEO, MEDIA_DOCUMENT):
+        file_id = clip_cache.get_file_id(key, media)
+        if not file_id:
+            continue
+        try:
+            if media == MEDIA_VIDEO:
+                await message.reply_video(
+                    video=file_id,
+                    caption=f"📹 Фрагмент {start_time}-{end_time}",
+                    supports_streaming=True
+                )
+            else:
+                await message.reply_document(
+                    document=file_id,
+                    caption=f"📹 Фрагмент {start_time}-{end_time}"
+                )
+            logger.info(f"Клип {key} отправлен по file_id из кеша")
+            return True
+        except BadRequest as e:
+            logger.warning(f"Telegram не принял file_id из кеша: {e}")
+            clip_cache.forget_file_id(key, media)
+    
+    cached_path = clip_cache.get_path(key)
+    if cached_path:
+        sent = await upload_clip(message, cached_path, start_time, end_time)
+        remember_upload(key, sent)
+        logger.info(f"Клип {key} отправлен из дискового кеша")
+        return True
+    
+    return False
+
+
+async def process_clip(message: Message, user_id: int, url: str, start_time: str, end_time: str,
+                       journal_id: str | None = None, quality: str | None = None):
+    """
+    Отдает клип из кеша, присоединяется к такому же запросу в работе или ставит новую задачу
+    journal_id - задача из журнала, продолжаемая после перезапуска
+    quality - уровень качества, выбранный пользователем (None - по умолчанию)
+    """
+    quality = get_tier(quality).name
+    if journal_id is None:
+        journal_id = journal.create(JOB_KIND_CLIP, message.chat_id, user_id,
+                                    {'url': url, 'start_time': start_time, 'end_time': end_time, 'quality': quality})
+    # Обработчик выполняется в своей задаче asyncio: ID задачи попадает во все ее логи
+    trace_id.set(journal_id)
+    started = time.monotonic()
+    video_id = extract_video_id(url)
+    key = clip_key(video_id, start_time, end_time, profile_signature(quality=quality)) if video_id else None
+    
+    status_msg = None
+    while key:
+        if await send_cached_clip(message, key, start_time, end_time):
+            if status_msg:
+                await status_msg.delete()
+            finish_journal(journal_id, JOB_DONE)
+            inc('clip_cache_hits_total')
+            record_job(JOB_KIND_CLIP, 'cached', started)
+            return
+        flight = clip_flights.get(key)
+        if flight is None:
+            break
+        # Такой же фрагмент уже обрабатывается - ждем его вместо второго скачивания
+        if status_msg is None:
+            status_msg = await message.reply_text(
+                f"⏳ Фрагмент {start_time}-{end_time} уже обрабатывается, жду результат..."
+            )
+        await asyncio.shield(flight)
+    
+    if status_msg:
+        await status_msg.delete()
+    
+    if key:
+        clip_flights.begin(key)
+    try:
+        await run_clip_job(message, user_id, url, start_time, end_time, key, journal_id, quality)
+    finally:
+        if key:
+            clip_flights.end(key)
+
+
+def record_job(kind: str, status: str, started: float):
+    """Учитывает завершенную задачу в метриках"""
+    inc('jobs_total', kind=kind, status=status)
+    observe('job_seconds', time.monotonic() - started, kind=kind)
+
+
+def finish_journal(journal_id: str, status: str):
+    """
+    Закрывает задачу в журнале и удаляет ее папку
+    При перезапуске бота прерванная задача остается открытой с последним пройденным этапом
+    """
+    if shutting_down and status != JOB_DONE:
+        entry = journal.get(journal_id)
+        if entry:
+            logger.info(f"Задача {journal_id} прервана остановкой, продолжится с этапа {entry.stage}")
+        return
+    journal.finish(journal_id, status)
+    workspaces.release(journal_id)
+
+
+async def submit_job(message: Message, user_id: int, clip_seconds: int, journal_id: str, handle: JobHandle,
+                     func, *args):
+    """
+    Резервирует место под задачу, ставит ее в очередь планировщика и запоминает для /cancel
+    func вызывается как func(handle, *args, journal_id)
+    Возвращает None (и сообщает пользователю), если задача не принята
+    """
     try:
-        # Скачиваем видео
-        video_path = await asyncio.to_thread(
-            download_video_segment, url, start_time, end_time
+        workspaces.admit(journal_id, clip_seconds)
+    except DiskQuotaError as e:
+        logger.warning(f"Задача {journal_id} отклонена: {e}")
+        await message.reply_text(
+            "❌ На сервере сейчас не хватает места для обработки.\n\n"
+            "Попробуйте через несколько минут или выберите фрагмент покороче."
         )
+        return None
+    try:
+        job = scheduler.submit(user_id, clip_seconds, func, handle, *args, journal_id)
+    except QueueFullError:
+        await message.reply_text(
+            "❌ Сейчас слишком много запросов, очередь заполнена.\n\n"
+            "Попробуйте через несколько минут."
+        )
+        return None
+    except UserLimitError:
+        await message.reply_text(
+            "❌ У вас уже есть задачи в очереди.\n\n"
+            "Дождитесь их завершения и попробуйте снова."
+        )
+        return None
+    
+    # Запоминаем задачу, чтобы /cancel мог ее остановить
+    active_jobs.setdefault(user_id, []).append((job, handle))
+    return job
+
+
+def release_job(user_id: int, job, handle: JobHandle):
+    """Убирает завершенную задачу из списка активных"""
+    user_jobs = active_jobs.get(user_id, [])
+    if (job, handle) in user_jobs:
+        user_jobs.remove((job, handle))
+    if not user_jobs:
+        active_jobs.pop(user_id, None)
+
+
+async def report_job_error(status_msg, error: Exception, handle: JobHandle, label: str):
+    """Сообщает пользователю о неудачной задаче"""
+    if isinstance(error, JobCancelled) and shutting_down:
+        # Бот перезапускается: файлы оставляем, задача продолжится по журналу
+        await status_msg.edit_text(f"♻️ Бот перезапускается. Обработка: {label} - продолжится после запуска.")
+    elif isinstance(error, JobCancelled):
+        # Отмена пользователем не ошибка - в метриках она видна по jobs_total{status="cancelled"}
+        # Файлы могли появиться уже после отмены, пока поток yt-dlp завершался
+        handle.cleanup()
+        await status_msg.edit_text(f"❌ Обработка: {label} - отменена.")
+    elif isinstance(error, yt_dlp.utils.DownloadError):
+        error_msg = str(error)
+        logger.error(f"Ошибка yt-dlp: {error_msg}")
+        inc('errors_total', kind=classify_error(error) or 'download')
         
-        if video_path and video_path.exists():
+        # Ограничения YouTube: задача уже повторялась с задержками и другими клиентами
+        if classify_error(error) or "bot" in error_msg.lower():
+            await status_msg.edit_text(
+                f"❌ YouTube временно заблокировал запрос (повторные попытки не помогли).\n\n"
+                f"Попробуйте:\n"
+                f"• Подождать несколько минут\n"
+                f"• Использовать другой URL\n"
+                f"• Попробовать позже\n\n"
+                f"Это временная проблема, обычно решается сама."
+            )
+        else:
+            # Обрезаем длинные сообщения об ошибках
+            short_error = error_msg[:300] if len(error_msg) > 300 else error_msg
+            await status_msg.edit_text(
+                f"❌ Ошибка при скачивании:\n{short_error}\n\n"
+                f"Проверьте URL и попробуйте еще раз."
+            )
+    else:
+        logger.error(f"Неожиданная ошибка: {error}", exc_info=error)
+        inc('errors_total', kind=type(error).__name__)
+        await status_msg.edit_text(
+            f"❌ Произошла ошибка: {str(error)[:200]}\n\n"
+            f"Попробуйте еще раз или обратитесь к администратору."
+        )
+
+
+async def send_preview(message: Message, handle: JobHandle, start_time: str, end_time: str) -> Message | None:
+    """
+    Ждет превью, которое задача готовит параллельно с клипом, и отправляет его
+    Возвращает сообщение с превью (None - превью не отправлено)
+    """
+    while handle.preview is None:
+        await asyncio.sleep(QUEUE_STATUS_INTERVAL)
+    clip_seconds = time_to_seconds(end_time) - time_to_seconds(start_time)
+    covered = "" if clip_seconds <= PREVIEW_MAX_SECONDS else f", первые {PREVIEW_MAX_SECONDS} с"
+    try:
+        with ExitStack() as stack:
+            sent = await message.reply_video(
+                video=upload_input(handle.preview, stack),
+                filename=f"preview_{clip_filename(start_time, end_time)}",
+                caption=f"👀 Превью {start_time}-{end_time} ({PREVIEW_QUALITY}{covered}). Полное качество - следом",
+                supports_streaming=True,
+                read_timeout=UPLOAD_TIMEOUT,
+                write_timeout=UPLOAD_TIMEOUT,
+            )
+    except (TelegramError, OSError) as e:
+        logger.warning(f"Не удалось отправить превью: {e}")
+        inc('previews_total', status='failed')
+        return None
+    inc('previews_total', status='sent')
+    return sent
+
+
+async def retire_preview(preview: asyncio.Task | None, replaced: bool):
+    """
+    Останавливает превью, если оно еще не готово
+    replaced=True - клип в полном качестве отправлен, и превью заменяется им (сообщение удаляется)
+    """
+    if preview is None:
+        return
+    if not preview.done():
+        preview.cancel()
+        # Дожидаемся отмены, чтобы отправка не читала превью из уже удаленной папки задачи
+        await asyncio.gather(preview, return_exceptions=True)
+        inc('previews_total', status='late')
+        return
+    if not replaced or preview.cancelled() or preview.exception() or preview.result() is None:
+        return
+    try:
+        await preview.result().delete()
+    except TelegramError as e:
+        logger.warning(f"Не удалось удалить превью: {e}")
+
+
+async def run_clip_job(message: Message, user_id: int, url: str, start_time: str, end_time: str,
+                       key: str | None, journal_id: str, quality: str):
+    """Ставит задачу в очередь, ждет результат и отправляет клип"""
+    clip_seconds = time_to_seconds(end_time) - time_to_seconds(start_time)
+    handle = JobHandle(f"{user_id}:{start_time}-{end_time}")
+    label = f"фрагмент {start_time}-{end_time}"
+    status = JOB_FAILED
+    started = time.monotonic()
+    
+    # Ставим задачу в очередь планировщика
+    with_preview = wants_preview(clip_seconds, quality)
+    job = await submit_job(message, user_id, clip_seconds, journal_id, handle, fetch_clip_job,
+                           url, start_time, end_time, quality, with_preview)
+    if job is None:
+        finish_journal(journal_id, status)
+        return
+    status_msg = await message.reply_text(queue_status_text(job, label))
+    # Превью готовит сама задача (там же, где клип); бот отправляет его, как только оно появится
+    preview = asyncio.create_task(send_preview(message, handle, start_time, end_time)) if with_preview else None
+    
+    try:
+        # Ждем выполнения задачи, обновляя позицию в очереди и прогресс
+        video_path = await wait_for_job(job, status_msg, label, handle)
+        
+        if isinstance(video_path, bytes):
+            # Потоковый режим: клип уже в памяти, на диск ничего не пишем
+            await status_msg.edit_text("✅ Видео готово! Отправляю...")
+            with stage('upload'):
+                sent = await upload_clip(message, video_path, start_time, end_time)
+            await status_msg.delete()
+            journal.advance(journal_id, STAGE_UPLOADED, file_id=sent_media(sent)[0])
+            status = JOB_DONE
+            remember_upload(key, sent)
+        elif video_path and video_path.exists():
             # Отправляем видео
             await status_msg.edit_text("✅ Видео скачано! Отправляю...")
             
             file_size = video_path.stat().st_size
-            max_size = 50 * 1024 * 1024  # 50 MB - лимит Telegram для видео
-            
-            # Telegram перекодирует видео при отправке через reply_video, что ухудшает качество
-            # Отправляем как файл через reply_document для сохранения оригинального качества
-            max_size_document = 2000 * 1024 * 1024  # 2 GB - лимит Telegram для документов
             
-            if file_size > max_size_document:
+            # Профиль кодирования уже подобран под этот лимит, сюда попадаем только если перекодирование не удалось
+            if file_size > UPLOAD_LIMIT:
                 await status_msg.edit_text(
                     f"❌ Файл слишком большой ({file_size / 1024 / 1024:.1f} MB). "
-                    f"Максимальный размер: 2000 MB"
+                    f"Максимальный размер: {UPLOAD_LIMIT / 1024 / 1024:.0f} MB"
                 )
             else:
-                with open(video_path, 'rb') as video_file:
-                    # Отправляем как документ для сохранения качества
-                    await update.message.reply_document(
-                        document=video_file,
-                        filename=f"video_{start_time.replace(':', '-')}_{end_time.replace(':', '-')}.mp4",
-                        caption=f"📹 Фрагмент {start_time}-{end_time}"
-                    )
+                with stage('upload'):
+                    sent = await upload_clip(message, video_path, start_time, end_time)
                 await status_msg.delete()
-            
-            # Удаляем файл после отправки
-            try:
-                video_path.unlink()
-            except Exception as e:
-                logger.warning(f"Не удалось удалить файл {video_path}: {e}")
+                journal.advance(journal_id, STAGE_UPLOADED, file_id=sent_media(sent)[0])
+                status = JOB_DONE
+                if key:
+                    # Сохраняем клип и file_id для повторных запросов (остальное удалится вместе с папкой задачи)
+                    remember_upload(key, sent)
+                    clip_cache.store_file(key, video_path)
         else:
-            error_details = "Не удалось скачать или найти файл после загрузки."
             logger.error(f"Ошибка скачивания: URL={url}, start={start_time}, end={end_time}")
+            inc('errors_total', kind='no_clip')
             await status_msg.edit_text(
                 f"❌ Ошибка при скачивании видео.\n\n"
                 f"Возможные причины:\n"
@@ -452,48 +726,347 @@ async def receive_end_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"• Проблемы с доступом к YouTube\n\n"
                 f"Попробуйте еще раз с другими параметрами."
             )
+    except Exception as e:
+        if isinstance(e, JobCancelled):
+            status = JOB_CANCELLED
+        await report_job_error(status_msg, e, handle, label)
+    finally:
+        # Клип в полном качестве заменяет превью; при ошибке превью остается у пользователя
+        await retire_preview(preview, replaced=status == JOB_DONE)
+        release_job(user_id, job, handle)
+        finish_journal(journal_id, status)
+        record_job(JOB_KIND_CLIP, status, started)
+
+
+async def send_batch_clips(message: Message, items: list[tuple[Clip, str | Path]]) -> list:
+    """
+    Отправляет клипы пакета медиагруппами (file_id из кеша или файлы)
+    Возвращает сообщения в порядке items, None - клип отправить не удалось
+    """
+    messages: list = []
+    for offset in range(0, len(items), MEDIA_GROUP_SIZE):
+        chunk = items[offset:offset + MEDIA_GROUP_SIZE]
+        if len(chunk) > 1:
+            try:
+                with ExitStack() as stack:
+                    media = []
+                    for clip, source in chunk:
+                        if isinstance(source, Path):
+                            media.append(InputMediaDocument(
+                                media=upload_input(source, stack),
+                                filename=clip_filename(clip.start_time, clip.end_time),
+                                caption=f"📹 Фрагмент {clip.start_time}-{clip.end_time}"
+                            ))
+                        else:
+                            media.append(InputMediaDocument(
+                                media=source,
+                                caption=f"📹 Фрагмент {clip.start_time}-{clip.end_time}"
+                            ))
+                    messages.extend(await message.reply_media_group(
+                        media=media, read_timeout=UPLOAD_TIMEOUT, write_timeout=UPLOAD_TIMEOUT
+                    ))
+                continue
+            except BadRequest as e:
+                # Обычно это устаревший file_id в кеше - отправляем по одному, чтобы найти его
+                logger.warning(f"Telegram не принял медиагруппу, отправляю по одному: {e}")
+        
+        # Медиагруппа из одного файла не допускается - отправляем обычным документом
+        for clip, source in chunk:
+            if isinstance(source, Path):
+                messages.append(await upload_clip(message, source, clip.start_time, clip.end_time))
+                continue
+            try:
+                messages.append(await message.reply_document(
+                    document=source,
+                    caption=f"📹 Фрагмент {clip.start_time}-{clip.end_time}"
+                ))
+            except BadRequest as e:
+                logger.warning(f"Telegram не принял file_id из кеша: {e}")
+                messages.append(None)
+    return messages
+
+
+async def process_batch(message: Message, user_id: int, url: str, clips: list[Clip],
+                        journal_id: str | None = None, quality: str | None = None):
+    """
+    Пакетный режим: отдает из кеша готовые клипы, остальные скачивает одной задачей
+    и отправляет все медиагруппами
+    journal_id - задача из журнала, продолжаемая после перезапуска
+    quality - уровень качества, выбранный пользователем (None - по умолчанию)
+    """
+    quality = get_tier(quality).name
+    if journal_id is None:
+        journal_id = journal.create(JOB_KIND_BATCH, message.chat_id, user_id, {
+            'url': url,
+            'clips': [{'start_time': clip.start_time, 'end_time': clip.end_time} for clip in clips],
+            'quality': quality,
+        })
+    trace_id.set(journal_id)
+    started = time.monotonic()
+    video_id = extract_video_id(url)
+    signature = profile_signature(quality=quality)
+    keys = [
+        clip_key(video_id, clip.start_time, clip.end_time, signature) if video_id else None
+        for clip in clips
+    ]
+    sources: list[str | Path | None] = [
+        (clip_cache.get_file_id(key) or clip_cache.get_path(key)) if key else None
+        for key in keys
+    ]
+    pending = [index for index, source in enumerate(sources) if source is None]
+    if len(pending) < len(clips):
+        inc('clip_cache_hits_total', len(clips) - len(pending))
     
-    except yt_dlp.utils.DownloadError as e:
-        error_msg = str(e)
-        logger.error(f"Ошибка yt-dlp: {error_msg}")
+    job = None
+    status = JOB_FAILED
+    handle = JobHandle(f"{user_id}:batch")
+    label = f"фрагменты ({len(pending)} шт.)"
+    if pending:
+        pending_clips = [clips[index] for index in pending]
+        clip_seconds = covered_seconds(merge_ranges(pending_clips))
+        job = await submit_job(message, user_id, clip_seconds, journal_id, handle, download_batch_job,
+                               url, pending_clips, quality)
+        if job is None:
+            finish_journal(journal_id, status)
+            return
+        status_msg = await message.reply_text(queue_status_text(job, label))
+    else:
+        status_msg = await message.reply_text("✅ Все фрагменты уже готовы! Отправляю...")
+    
+    try:
+        if job is not None:
+            paths = await wait_for_job(job, status_msg, label, handle)
+            for index, path in zip(pending, paths):
+                if path is None:
+                    continue
+                if path.stat().st_size > UPLOAD_LIMIT:
+                    logger.warning(f"Клип {path.name} больше лимита ({path.stat().st_size / 1024 / 1024:.1f} MB)")
+                    continue
+                sources[index] = path
         
-        # Специальная обработка ошибки с подтверждением от YouTube
-        if "Sign in to confirm you're not a bot" in error_msg or "bot" in error_msg.lower():
+        ready = [index for index, source in enumerate(sources) if source is not None]
+        if not ready:
             await status_msg.edit_text(
-                f"❌ YouTube временно заблокировал запрос.\n\n"
-                f"Попробуйте:\n"
-                f"• Подождать несколько минут\n"
-                f"• Использовать другой URL\n"
-                f"• Попробовать позже\n\n"
-                f"Это временная проблема, обычно решается сама."
+                f"❌ Не удалось скачать ни одного фрагмента.\n\n"
+                f"Проверьте, что фрагменты не выходят за пределы видео, и попробуйте еще раз."
             )
+            return
+        
+        await status_msg.edit_text("✅ Фрагменты готовы! Отправляю...")
+        with stage('upload'):
+            messages = await send_batch_clips(message, [(clips[index], sources[index]) for index in ready])
+        
+        failed = [clips[index] for index in range(len(clips)) if index not in ready]
+        for index, sent in zip(ready, messages):
+            key = keys[index]
+            if sent is None:
+                failed.append(clips[index])
+                if key:
+                    clip_cache.forget_file_id(key)
+                continue
+            if key:
+                # Сохраняем клип и file_id для повторных запросов
+                remember_upload(key, sent)
+                if isinstance(sources[index], Path) and sources[index].parent != clip_cache.directory:
+                    clip_cache.store_file(key, sources[index])
+        journal.advance(journal_id, STAGE_UPLOADED)
+        status = JOB_DONE
+        
+        if failed:
+            ranges = "\n".join(f"• {clip.start_time}-{clip.end_time}" for clip in failed)
+            await status_msg.edit_text(f"⚠️ Не удалось получить фрагменты:\n{ranges}\n\nПопробуйте запросить их еще раз.")
         else:
-            # Обрезаем длинные сообщения об ошибках
-            short_error = error_msg[:300] if len(error_msg) > 300 else error_msg
-            await status_msg.edit_text(
-                f"❌ Ошибка при скачивании:\n{short_error}\n\n"
-                f"Проверьте URL и попробуйте еще раз."
-            )
+            await status_msg.delete()
     except Exception as e:
-        logger.error(f"Неожиданная ошибка: {e}", exc_info=True)
-        await status_msg.edit_text(
-            f"❌ Произошла ошибка: {str(e)[:200]}\n\n"
-            f"Попробуйте еще раз или обратитесь к администратору."
-        )
-    
-    # Очищаем данные пользователя
-    context.user_data.clear()
-    
-    return ConversationHandler.END
+        if isinstance(e, JobCancelled):
+            status = JOB_CANCELLED
+        await report_job_error(status_msg, e, handle, label)
+    finally:
+        if job is not None:
+            release_job(user_id, job, handle)
+        # Удаляем скачанные куски и клипы, не попавшие в кеш
+        finish_journal(journal_id, status)
+        record_job(JOB_KIND_BATCH, status if pending else 'cached', started)
+
+
+def cancel_user_jobs(user_id: int) -> int:
+    """Отменяет все задачи пользователя (в очереди и выполняющиеся), возвращает их число"""
+    cancelled = 0
+    for job, handle in list(active_jobs.get(user_id, [])):
+        handle.cancel()
+        if scheduler.cancel(job):
+            cancelled += 1
+    return cancelled
 
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Отмена диалога"""
+    """Отмена диалога и всех задач пользователя"""
     context.user_data.clear()
-    await update.message.reply_text("❌ Отменено.")
+    cancelled = cancel_user_jobs(update.effective_user.id)
+    if cancelled:
+        await update.message.reply_text(f"❌ Отменено. Остановлено задач: {cancelled}.",
+                                        reply_markup=ReplyKeyboardRemove())
+    else:
+        await update.message.reply_text("❌ Отменено.", reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
 
+def health_status() -> dict:
+    """Состояние очереди, кешей и диска для проверки готовности"""
+    return {"queued": scheduler.queued, "running": scheduler.running,
+            "encode_cores": f"{core_budget.allocated}/{core_budget.cores}", "encode_waiting": core_budget.waiting,
+            **youtube_throttle.stats(), **ydl_pool.stats(), **metadata_cache.stats(), **workspaces.stats()}
+
+
+def metrics_text() -> str:
+    """Метрики бота в формате Prometheus (с воркерами - вместе с записями их задач)"""
+    return registry.render(health_status())
+
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сводка метрик для администраторов"""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("❌ Команда доступна только администраторам.")
+        return
+    sections = [
+        ("Этапы (p50/p95/p99)", describe_summaries('stage_seconds')),
+        ("Ожидание в очереди", describe_summaries('queue_wait_seconds')),
+        ("Ожидание ядер", describe_summaries('core_wait_seconds')),
+        ("Задачи целиком", describe_summaries('job_seconds')),
+        ("Завершенные задачи", describe_counters('jobs_total')),
+        ("Как получены клипы", describe_counters('encode_decisions_total')),
+        ("Запасные пути", describe_counters('fallbacks_total')),
+        ("Ошибки", describe_counters('errors_total')),
+        ("Ограничения YouTube", describe_counters('youtube_throttled_total')),
+        ("Кеш метаданных", describe_counters('metadata_cache_total')),
+    ]
+    lines = ["📊 Статистика с запуска бота"]
+    for title, items in sections:
+        if items:
+            lines += ["", f"{title}:", *(f"• {item}" for item in items)]
+    lines += ["", "Сейчас:", *(f"• {name}: {value}" for name, value in health_status().items())]
+    await update.message.reply_text("\n".join(lines))
+
+
+def journal_label(entry: JournalEntry) -> str:
+    """Описание задачи из журнала для сообщений пользователю"""
+    if entry.kind == JOB_KIND_BATCH:
+        return f"фрагменты ({len(entry.payload['clips'])} шт.)"
+    return f"фрагмент {entry.payload['start_time']}-{entry.payload['end_time']}"
+
+
+async def resume_job(application: Application, entry: JournalEntry):
+    """Продолжает задачу из журнала с последнего пройденного этапа"""
+    label = journal_label(entry)
+    if entry.stage == STAGE_UPLOADED:
+        # Клип уже отправлен, бот остановился до закрытия записи
+        journal.finish(entry.job_id, JOB_DONE)
+        workspaces.release(entry.job_id)
+        return
+    if entry.resumes >= JOURNAL_MAX_RESUMES:
+        journal.finish(entry.job_id, JOB_FAILED)
+        workspaces.release(entry.job_id)
+        logger.error(f"Задача {entry.job_id} прерывалась {entry.resumes} раз(а), больше не продолжаю")
+        try:
+            await application.bot.send_message(
+                entry.chat_id,
+                f"❌ Не удалось обработать {label}: бот несколько раз перезапускался.\n\nПопробуйте еще раз."
+            )
+        except TelegramError as e:
+            logger.warning(f"Не удалось сообщить о проваленной задаче {entry.job_id}: {e}")
+        return
+    
+    journal.mark_resumed(entry.job_id)
+    logger.info(f"Продолжаю задачу {entry.job_id} с этапа {entry.stage}")
+    try:
+        # Сообщение бота служит точкой ответа вместо исходного сообщения пользователя
+        message = await application.bot.send_message(
+            entry.chat_id, f"♻️ Бот перезапускался. Продолжаю: {label}."
+        )
+    except TelegramError as e:
+        logger.warning(f"Чат задачи {entry.job_id} недоступен, задача закрыта: {e}")
+        journal.finish(entry.job_id, JOB_FAILED)
+        workspaces.release(entry.job_id)
+        return
+    
+    payload = entry.payload
+    if entry.kind == JOB_KIND_BATCH:
+        clips = [Clip(item['start_time'], item['end_time']) for item in payload['clips']]
+        await process_batch(message, entry.user_id, payload['url'], clips, entry.job_id, payload.get('quality'))
+    else:
+        await process_clip(message, entry.user_id, payload['url'], payload['start_time'], payload['end_time'],
+                           entry.job_id, payload.get('quality'))
+
+
+async def on_startup(application: Application):
+    """Запуск фоновых компонентов после инициализации бота"""
+    global health_server
+    await scheduler.start()
+    
+    # Продолжаем задачи, прерванные перезапуском, остальные файлы в downloads - брошенные
+    journal.purge()
+    entries = journal.active()
+    workspaces.sweep({entry.job_id for entry in entries})
+    for entry in entries:
+        application.create_task(resume_job(application, entry))
+    if entries:
+        logger.info(f"Продолжаю прерванных задач: {len(entries)}")
+    
+    if job_queue is None:
+        # YouTube опрашивает сам бот - прогреваем экземпляры YoutubeDL, пока нет задач
+        application.create_task(asyncio.to_thread(warm_ydl_pool))
+    
+    # Свои обработчики сигналов вместо обработчиков PTB: те останавливают приложение, не прерывая задачи
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, request_stop, application)
+        except NotImplementedError:
+            # Windows: остается KeyboardInterrupt
+            pass
+    
+    if HEALTH_SERVER:
+        # Поднимается до webhook: пока бот запускается, проверка готовности отвечает 503
+        health_server = HealthServer(application, health=health_status, metrics=metrics_text)
+        await health_server.start()
+
+
+def interrupt_jobs():
+    """
+    Бот останавливается: прерывает все задачи, не удаляя файлы (после запуска они продолжатся по журналу)
+    Вызывается до Application.stop(): он ждет все задачи, созданные приложением, то есть все клипы целиком
+    """
+    global shutting_down
+    if shutting_down:
+        return
+    shutting_down = True
+    # Убиваем ffmpeg и прерываем скачивания, чтобы они не пережили бота
+    interrupted = 0
+    for user_jobs in list(active_jobs.values()):
+        for job, handle in list(user_jobs):
+            handle.cancel(cleanup=False)
+            if scheduler.cancel(job):
+                interrupted += 1
+    logger.info(f"Бот останавливается, прервано задач: {interrupted}")
+
+
+def request_stop(application: Application):
+    """Сигнал остановки: сначала прерываем задачи, потом останавливаем приложение"""
+    interrupt_jobs()
+    if application.running:
+        application.stop_running()
+    else:
+        # Приложение еще запускается - выходим так же, как обработчик сигналов PTB
+        raise SystemExit
+
+
+async def on_shutdown(application: Application):
+    """Остановка фоновых компонентов"""
+    # Обычно задачи уже прерваны по сигналу; здесь - если приложение остановилось иначе
+    interrupt_jobs()
+    await scheduler.stop()
+    if health_server:
+        await health_server.stop()
 
 
 def main():
@@ -503,28 +1076,71 @@ def main():
         return
     
     # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+    # concurrent_updates нужен, чтобы долгие задачи одного пользователя не блокировали остальных
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    # Один пул соединений на все запросы бота; таймауты с запасом, чтобы пул не отказывал под нагрузкой
+    builder = (
+        builder
+        .connection_pool_size(TELEGRAM_POOL_SIZE)
+        .pool_timeout(TELEGRAM_TIMEOUT)
+        .connect_timeout(TELEGRAM_TIMEOUT)
+        .read_timeout(TELEGRAM_TIMEOUT)
+        .write_timeout(TELEGRAM_TIMEOUT)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    if TELEGRAM_LOCAL_MODE:
+        # Локальный сервер Bot API читает клипы с диска по пути, без загрузки через бота
+        builder = builder.local_mode(True)
+    application = builder.build()
     
     # Создаем ConversationHandler для диалога скачивания
     download_handler = ConversationHandler(
         entry_points=[
             CommandHandler("start", start),
-            CommandHandler("download", download_start)
+            CommandHandler("download", download_start),
+            CommandHandler("batch", batch_start),
         ],
         states={
             WAITING_FOR_URL: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_url)],
+            WAITING_FOR_QUALITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_quality)],
             WAITING_FOR_START_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_start_time)],
             WAITING_FOR_END_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_end_time)],
+            WAITING_FOR_RANGES: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_ranges)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
     )
     
     # Регистрируем обработчики
     application.add_handler(download_handler)
+    # /cancel вне диалога - останавливает уже запущенные задачи
+    application.add_handler(CommandHandler("cancel", cancel))
+    application.add_handler(CommandHandler("stats", stats))
     
     # Запускаем бота
-    logger.info("Бот запущен...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        logger.info("Бот запущен в режиме webhook...")
+        # Сигналы остановки обрабатывает request_stop (ставится в on_startup)
+        # Webhook при остановке не удаляется: при перезапуске Telegram придержит обновления и доставит их новой реплике
+        application.run_webhook(
+            listen=HTTP_LISTEN,
+            port=HTTP_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or derive_secret(BOT_TOKEN),
+            allowed_updates=ALLOWED_UPDATES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            stop_signals=None,
+        )
+    else:
+        logger.info("Бот запущен...")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES, stop_signals=None)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import shutil
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Настройки кеша готовых клипов
+CLIP_CACHE_DIR = Path(os.getenv("CLIP_CACHE_DIR", "cache/clips"))
+CLIP_CACHE_MAX_MB = int(os.getenv("CLIP_CACHE_MAX_MB", "2048"))
+
+# Профиль кодирования входит в ключ, чтобы разные настройки не смешивались
+DEFAULT_PROFILE = "default"
+
+INDEX_FILE = "index.json"
+
+# Как клип был отправлен в Telegram: file_id видео нельзя отправить документом и наоборот
+MEDIA_DOCUMENT = "document"
+MEDIA_VIDEO = "video"
+
+
+def file_id_field(media: str) -> str:
+    """Поле индекса с file_id (для документов - file_id, как до появления отправки видео)"""
+    return "file_id" if media == MEDIA_DOCUMENT else f"{media}_file_id"
+
+
+def clip_key(video_id: str, start_time: str, end_time: str, profile: str = DEFAULT_PROFILE) -> str:
+    """Ключ кеша: ID видео + сегмент + профиль кодирования"""
+    raw = f"{video_id}|{start_time}|{end_time}|{profile}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+
+
+class ClipCache:
+    """
+    Кеш готовых клипов.
+    Хранит файлы на диске с LRU-вытеснением по размеру и индекс key -> Telegram file_id,
+    чтобы повторные запросы отправлялись без скачивания и загрузки.
+    """
+
+    def __init__(self, directory: Path = CLIP_CACHE_DIR, max_bytes: int = CLIP_CACHE_MAX_MB * 1024 * 1024):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index: dict[str, dict] = self._load()
+
+    def _load(self) -> dict[str, dict]:
+        index_path = self.directory / INDEX_FILE
+        if not index_path.exists():
+            return {}
+        try:
+            index = json.loads(index_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Не удалось прочитать индекс кеша клипов: {e}")
+            return {}
+        # Убираем ссылки на файлы, которых больше нет
+        for entry in index.values():
+            if entry.get('file') and not (self.directory / entry['file']).exists():
+                entry['file'] = None
+                entry['size'] = 0
+        return index
+
+    def _save(self):
+        index_path = self.directory / INDEX_FILE
+        tmp_path = index_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(self._index), encoding='utf-8')
+        tmp_path.replace(index_path)
+
+    def _touch(self, entry: dict):
+        entry['last_used'] = time.time()
+
+    def get_file_id(self, key: str, media: str = MEDIA_DOCUMENT) -> str | None:
+        """Возвращает Telegram file_id ранее загруженного клипа, отправленного как media"""
+        with self._lock:
+            entry = self._index.get(key)
+            if not entry or not entry.get(file_id_field(media)):
+                return None
+            self._touch(entry)
+            self._save()
+            return entry[file_id_field(media)]
+
+    def get_path(self, key: str) -> Path | None:
+        """Возвращает путь к клипу в дисковом кеше"""
+        with self._lock:
+            entry = self._index.get(key)
+            if not entry or not entry.get('file'):
+                return None
+            path = self.directory / entry['file']
+            if not path.exists():
+                entry['file'] = None
+                entry['size'] = 0
+                self._save()
+                return None
+            self._touch(entry)
+            self._save()
+            return path
+
+    def store_file(self, key: str, path: Path) -> Path:
+        """Перемещает готовый клип в кеш и возвращает новый путь"""
+        target = self.directory / f"{key}{path.suffix or '.mp4'}"
+        shutil.move(str(path), target)
+        with self._lock:
+            entry = self._index.setdefault(key, {'file_id': None})
+            entry['file'] = target.name
+            entry['size'] = target.stat().st_size
+            self._touch(entry)
+            self._evict(keep=key)
+            self._save()
+        logger.info(f"Клип {key} сохранен в кеш ({entry['size'] / 1024 / 1024:.2f} MB)")
+        return target
+
+    def store_file_id(self, key: str, file_id: str, media: str = MEDIA_DOCUMENT):
+        """Запоминает file_id после первой загрузки в Telegram"""
+        with self._lock:
+            entry = self._index.setdefault(key, {'file': None, 'size': 0})
+            entry[file_id_field(media)] = file_id
+            self._touch(entry)
+            self._save()
+
+    def forget_file_id(self, key: str, media: str = MEDIA_DOCUMENT):
+        """Удаляет file_id, который Telegram больше не принимает"""
+        with self._lock:
+            entry = self._index.get(key)
+            if entry:
+                entry[file_id_field(media)] = None
+                self._save()
+
+    def total_size(self) -> int:
+        return sum(entry.get('size', 0) for entry in self._index.values())
+
+    def trim(self, bytes_to_free: int) -> int:
+        """Вытесняет давно использованные клипы, чтобы освободить место под задачи; возвращает освобожденные байты"""
+        with self._lock:
+            before = self.total_size()
+            self._evict(limit=max(0, before - bytes_to_free))
+            self._save()
+            return before - self.total_size()
+
+    def _evict(self, keep: str | None = None, limit: int | None = None):
+        """Удаляет самые давно использованные файлы, пока кеш не уложится в бюджет"""
+        limit = self.max_bytes if limit is None else limit
+        total = self.total_size()
+        if total <= limit:
+            return
+        candidates = sorted(
+            (item for item in self._index.items() if item[1].get('file') and item[0] != keep),
+            key=lambda item: item[1].get('last_used', 0),
+        )
+        for key, entry in candidates:
+            if total <= limit:
+                break
+            try:
+                (self.directory / entry['file']).unlink(missing_ok=True)
+            except OSError as e:
+                logger.warning(f"Не удалось удалить {entry['file']} из кеша: {e}")
+                continue
+            total -= entry.get('size', 0)
+            logger.info(f"Клип {key} вытеснен из дискового кеша")
+            entry['file'] = None
+            entry['size'] = 0
+            # Без file_id запись больше не нужна
+            if not entry.get('file_id') and not entry.get(file_id_field(MEDIA_VIDEO)):
+                del self._index[key]
+
+
+class SingleFlight:
+    """
+    Объединяет одинаковые запросы: пока задача по ключу выполняется,
+    остальные ждут ее завершения вместо запуска второго конвейера
+    """
+
+    def __init__(self):
+        self._flights: dict[str, asyncio.Future] = {}
+
+    def get(self, key: str) -> asyncio.Future | None:
+        return self._flights.get(key)
+
+    def begin(self, key: str):
+        self._flights[key] = asyncio.get_running_loop().create_future()
+
+    def end(self, key: str):
+        flight = self._flights.pop(key, None)
+        if flight and not flight.done():
+            flight.set_result(None)
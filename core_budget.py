@@ -0,0 +1,139 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+from metrics import observe
+
+logger = logging.getLogger(__name__)
+
+
+def available_cores() -> int:
+    """Ядра, доступные процессу: привязка к CPU и лимит контейнера (cgroup v2 cpu.max)"""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    try:
+        # "200000 100000" - два ядра, "max 100000" - без лимита
+        quota, period = Path('/sys/fs/cgroup/cpu.max').read_text().split()
+        if quota != 'max':
+            cores = min(cores, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cores
+
+
+# Сколько ядер процесс отдает под кодирование (по умолчанию - все доступные)
+ENCODE_CORES = int(os.getenv("ENCODE_CORES", "0")) or available_cores()
+# Потоков на одно кодирование; остальные ядра достаются параллельным задачам
+ENCODE_THREADS = int(os.getenv("ENCODE_THREADS", "0")) or (
+    ENCODE_CORES if ENCODE_CORES <= 4 else max(4, ENCODE_CORES // 2)
+)
+# Учитывать ли внешнюю нагрузку по loadavg (в контейнере это нагрузка всего хоста)
+ENCODE_LOAD_AWARE = os.getenv("ENCODE_LOAD_AWARE", "").lower() in ("1", "true", "yes")
+
+
+def lookahead_threads(threads: int) -> int:
+    """Потоки lookahead x264: по умолчанию он берет threads/6, на малом бюджете это 0-1 и упирается в него"""
+    return max(1, threads // 4)
+
+
+class CoreBudget:
+    """
+    Распределяет ядра между одновременными кодированиями ffmpeg.
+    Каждое кодирование получает явное число потоков и ждет своей очереди, если ядра заняты:
+    без этого каждый libx264 берет все ядра, и параллельные задачи душат друг друга.
+    """
+
+    def __init__(self, cores: int = ENCODE_CORES, threads_per_encode: int = ENCODE_THREADS,
+                 load_aware: bool = ENCODE_LOAD_AWARE):
+        self.load_aware = load_aware
+        self.configure(cores, threads_per_encode)
+        self.allocated = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    def configure(self, cores: int, threads_per_encode: int | None = None):
+        """Задает бюджет (воркеры делят ядра машины между процессами)"""
+        self.cores = max(1, cores)
+        self.threads_per_encode = max(1, min(threads_per_encode or self.cores, self.cores))
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def capacity(self) -> int:
+        """Сколько ядер можно раздать сейчас"""
+        if not self.load_aware:
+            return self.cores
+        try:
+            # Нагрузка сверх наших кодирований - чужие процессы
+            external = max(0.0, os.getloadavg()[0] - self.allocated)
+        except OSError:
+            return self.cores
+        return max(1, self.cores - int(external))
+
+    def _grant(self, want: int) -> int:
+        """Сколько ядер выдать прямо сейчас (0 - ждать)"""
+        free = self.capacity() - self.allocated
+        if self.allocated == 0:
+            # Одно кодирование выполняется всегда, даже если нагрузка съела весь бюджет
+            free = max(free, 1)
+        # Ждем хотя бы половину желаемого, чтобы не запускать кодирование на одном ядре надолго
+        if free < max(1, want // 2):
+            return 0
+        return min(want, free)
+
+    @asynccontextmanager
+    async def reserve(self, want: int | None = None):
+        """Выдает ядра на время кодирования; возвращает число потоков для ffmpeg"""
+        want = max(1, min(want or self.threads_per_encode, self.cores))
+        requested = time.monotonic()
+        granted = 0 if self._waiters else self._grant(want)
+        if not granted:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            logger.info(f"Кодирование ждет ядра: занято {self.allocated}/{self.cores}, в очереди {len(self._waiters)}")
+            try:
+                while not granted:
+                    await waiter
+                    granted = self._grant(want)
+                    if not granted:
+                        waiter = asyncio.get_running_loop().create_future()
+                        self._waiters.appendleft(waiter)
+            except BaseException:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                self._wake()
+                raise
+        self.allocated += granted
+        observe('core_wait_seconds', time.monotonic() - requested)
+        if self._waiters and self.allocated < self.capacity():
+            # Ядер хватило с запасом - следующий в очереди тоже может начать
+            self._wake()
+        try:
+            yield granted
+        finally:
+            self.allocated -= granted
+            self._wake()
+
+    def _wake(self):
+        """Будит первого в очереди (FIFO), он сам проверит, хватает ли ядер"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+
+def thread_args(threads: int) -> list[str]:
+    """-threads для декодера и фильтров ffmpeg (ставится перед -i)"""
+    return ['-threads', str(threads)]
+
+
+# Бюджет ядер процесса (у бота и у каждого процесса worker.py свой)
+core_budget = CoreBudget()
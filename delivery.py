@@ -0,0 +1,136 @@
+import os
+import json
+import struct
+import logging
+from contextlib import ExitStack
+from dataclasses import dataclass
+from pathlib import Path
+
+from encoding_profiles import TELEGRAM_LOCAL_MODE, UPLOAD_LIMIT
+from process_runner import run_process
+
+logger = logging.getLogger(__name__)
+
+# Как отправлять готовые клипы: auto - видео с потоковым воспроизведением, если файл подходит,
+# document - всегда документом
+CLIP_SEND_MODE = os.getenv("CLIP_SEND_MODE", "auto")
+# Пул соединений к Bot API (один на все запросы бота) и таймауты обычных запросов (секунды)
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "32"))
+TELEGRAM_TIMEOUT = float(os.getenv("TELEGRAM_TIMEOUT", "30"))
+# Таймаут отправки файла: большие клипы в облачный Bot API загружаются долго
+UPLOAD_TIMEOUT = float(os.getenv("UPLOAD_TIMEOUT", "600"))
+
+# Telegram принимает миниатюру JPEG не больше 320x320 и 200 KB
+THUMBNAIL_SIZE = 320
+PROBE_TIMEOUT = 30
+THUMBNAIL_TIMEOUT = 30
+
+# Кодеки, которые клиенты Telegram воспроизводят без перекодирования
+STREAMABLE_VIDEO_CODECS = {'h264'}
+STREAMABLE_AUDIO_CODECS = {'aac'}
+
+
+@dataclass
+class VideoMeta:
+    """Параметры клипа для отправки через sendVideo"""
+    duration: int
+    width: int
+    height: int
+    thumbnail: Path | None = None
+
+
+def upload_input(path: Path, stack: ExitStack):
+    """
+    Источник файла для отправки: локальному серверу Bot API передаем путь (файл не копируется
+    через процесс бота), облачному - открытый файл, который закроет stack
+    """
+    if TELEGRAM_LOCAL_MODE:
+        return Path(path).resolve()
+    return stack.enter_context(open(path, 'rb'))
+
+
+def has_faststart(path: Path) -> bool:
+    """moov-атом стоит перед mdat: клиент начинает воспроизведение, не дожидаясь всего файла"""
+    try:
+        with open(path, 'rb') as mp4:
+            while True:
+                header = mp4.read(8)
+                if len(header) < 8:
+                    return False
+                size, box = struct.unpack('>I4s', header)
+                header_size = 8
+                if size == 1:
+                    size = struct.unpack('>Q', mp4.read(8))[0]
+                    header_size = 16
+                if box == b'moov':
+                    return True
+                if box == b'mdat' or size < header_size:
+                    # size 0 - атом до конца файла
+                    return False
+                mp4.seek(size - header_size, os.SEEK_CUR)
+    except OSError:
+        return False
+
+
+async def streamable_video(path: Path) -> VideoMeta | None:
+    """
+    Проверяет, можно ли отправить клип видео с потоковым воспроизведением:
+    mp4 с faststart, h264 + AAC и размер в пределах лимита
+    Возвращает параметры для sendVideo или None, если клип нужно отправить документом
+    """
+    if CLIP_SEND_MODE != 'auto' or path.suffix.lower() != '.mp4':
+        return None
+    if path.stat().st_size > UPLOAD_LIMIT or not has_faststart(path):
+        return None
+
+    probe_cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-show_entries', 'stream=codec_type,codec_name,width,height',
+        '-show_entries', 'format=duration',
+        '-of', 'json',
+        str(path)
+    ]
+    result = await run_process(probe_cmd, timeout=PROBE_TIMEOUT)
+    if result.returncode != 0:
+        return None
+    try:
+        probe_data = json.loads(result.stdout)
+        duration = float(probe_data.get('format', {}).get('duration', 0))
+    except (json.JSONDecodeError, TypeError, ValueError):
+        return None
+    streams = probe_data.get('streams') or []
+    video = [stream for stream in streams if stream.get('codec_type') == 'video']
+    audio = [stream for stream in streams if stream.get('codec_type') == 'audio']
+    if not video or video[0].get('codec_name') not in STREAMABLE_VIDEO_CODECS:
+        return None
+    if any(stream.get('codec_name') not in STREAMABLE_AUDIO_CODECS for stream in audio):
+        return None
+
+    return VideoMeta(
+        duration=round(duration),
+        width=int(video[0].get('width') or 0),
+        height=int(video[0].get('height') or 0),
+        thumbnail=await make_thumbnail(path, duration),
+    )
+
+
+async def make_thumbnail(path: Path, duration: float) -> Path | None:
+    """Миниатюра из кадра в начале клипа (рядом с клипом, чтобы ее видел и локальный сервер Bot API)"""
+    thumbnail = path.with_name(f"{path.stem}_thumb.jpg")
+    thumbnail_cmd = [
+        'ffmpeg',
+        '-v', 'error',
+        '-ss', f"{min(duration / 2, 1.0):.3f}",
+        '-i', str(path),
+        '-frames:v', '1',
+        '-vf', f"scale={THUMBNAIL_SIZE}:{THUMBNAIL_SIZE}:force_original_aspect_ratio=decrease",
+        '-q:v', '5',
+        '-y',
+        str(thumbnail)
+    ]
+    result = await run_process(thumbnail_cmd, timeout=THUMBNAIL_TIMEOUT)
+    if result.returncode != 0 or not thumbnail.exists():
+        logger.warning(f"Не удалось сделать миниатюру для {path}: {result.stderr}")
+        return None
+    return thumbnail
@@ -0,0 +1,344 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# Где выполняются задачи: local - в процессе бота, queue - в отдельных процессах worker.py
+JOB_BACKEND = os.getenv("JOB_BACKEND", "local").lower()
+JOB_QUEUE_DB = Path(os.getenv("JOB_QUEUE_DB", "data/jobs.sqlite3"))
+# Воркер продлевает аренду задачи; если он упал, задачу заберет другой после истечения аренды
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Как часто фронтенд проверяет готовность задачи
+QUEUE_POLL_INTERVAL = float(os.getenv("QUEUE_POLL_INTERVAL", "1.0"))
+# Сколько задач фронтенд держит в общей очереди одновременно (параллелизм задают воркеры)
+QUEUE_INFLIGHT = int(os.getenv("QUEUE_INFLIGHT", "32"))
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+FINAL_STATUSES = (STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED)
+
+# Итог продления аренды
+LEASE_HELD = "held"
+# Фронтенд попросил отмену - файлы задачи можно удалять
+LEASE_CANCELLED = "cancelled"
+# Аренда истекла: задачу забрал другой воркер (или она провалена) - ее файлы больше не наши
+LEASE_LOST = "lost"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    error_type TEXT,
+    dedup_key TEXT,
+    progress TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, priority, id);
+CREATE INDEX IF NOT EXISTS jobs_dedup ON jobs (dedup_key, status);
+"""
+
+
+class RemoteJobError(Exception):
+    """Задача завершилась ошибкой в воркере"""
+
+    def __init__(self, message: str, error_type: str | None = None):
+        super().__init__(message)
+        self.error_type = error_type
+
+
+@dataclass
+class QueuedJob:
+    job_id: int
+    kind: str
+    payload: dict
+    status: str
+    attempts: int
+    max_attempts: int
+    cancel_requested: bool
+    result: dict | None
+    error: str | None
+    error_type: str | None
+    progress: dict | None = None
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> "QueuedJob":
+        return cls(
+            job_id=row['id'],
+            kind=row['kind'],
+            payload=json.loads(row['payload']),
+            status=row['status'],
+            attempts=row['attempts'],
+            max_attempts=row['max_attempts'],
+            cancel_requested=bool(row['cancel_requested']),
+            result=json.loads(row['result']) if row['result'] else None,
+            error=row['error'],
+            error_type=row['error_type'],
+            progress=json.loads(row['progress']) if row['progress'] else None,
+        )
+
+
+class DurableQueue:
+    """
+    Очередь задач в SQLite: переживает перезапуск бота и падение воркеров.
+    Работает между процессами одного хоста (WAL, короткие транзакции, аренда задач).
+    """
+
+    def __init__(self, path: Path = JOB_QUEUE_DB, lease_seconds: int = JOB_LEASE_SECONDS,
+                 max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.path = Path(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Очереди, созданные до появления dedup_key и progress, дополняем колонками
+            columns = [row['name'] for row in conn.execute("PRAGMA table_info(jobs)").fetchall()]
+            for column in ('dedup_key', 'progress'):
+                if columns and column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # Соединение на операцию: очередь используют разные процессы и потоки
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, kind: str, payload: dict, priority: int = 0, dedup_key: str | None = None) -> int:
+        """
+        Ставит задачу в очередь
+        Если задача с тем же dedup_key еще не завершена, возвращает ее номер вместо новой
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                existing = None
+                if dedup_key:
+                    existing = conn.execute(
+                        "SELECT id FROM jobs WHERE dedup_key = ? AND status IN (?, ?) AND cancel_requested = 0",
+                        (dedup_key, STATUS_QUEUED, STATUS_RUNNING),
+                    ).fetchone()
+                if existing is None:
+                    cursor = conn.execute(
+                        "INSERT INTO jobs (kind, payload, priority, status, max_attempts, dedup_key, "
+                        "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (kind, json.dumps(payload), priority, STATUS_QUEUED, self.max_attempts, dedup_key, now, now),
+                    )
+                    job_id = cursor.lastrowid
+                else:
+                    job_id = existing['id']
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        if existing is None:
+            logger.info(f"Задача #{job_id} ({kind}) поставлена в общую очередь")
+        else:
+            logger.info(f"Задача #{job_id} ({kind}) уже в общей очереди, жду ее")
+        return job_id
+
+    def claim(self, worker: str) -> QueuedJob | None:
+        """
+        Забирает следующую задачу: новую или брошенную упавшим воркером (аренда истекла)
+        Возвращает None, если задач нет
+        """
+        now = time.time()
+        with self._connect() as conn:
+            # IMMEDIATE: два воркера не смогут забрать одну задачу
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._expire_leases(conn, now)
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE status = ? AND cancel_requested = 0 ORDER BY priority, id LIMIT 1",
+                    (STATUS_QUEUED,),
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, worker = ?, attempts = attempts + 1, lease_until = ?, "
+                        "updated_at = ? WHERE id = ?",
+                        (STATUS_RUNNING, worker, now + self.lease_seconds, now, row['id']),
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        job = QueuedJob.from_row(row)
+        job.status = STATUS_RUNNING
+        job.attempts += 1
+        return job
+
+    def _expire_leases(self, conn: sqlite3.Connection, now: float):
+        """Возвращает в очередь задачи с истекшей арендой, исчерпавшие попытки помечает ошибкой"""
+        for row in conn.execute(
+            "SELECT id, attempts, max_attempts, worker, cancel_requested FROM jobs WHERE status = ? AND lease_until < ?",
+            (STATUS_RUNNING, now),
+        ).fetchall():
+            if row['cancel_requested']:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?",
+                    (STATUS_CANCELLED, now, row['id']),
+                )
+            elif row['attempts'] >= row['max_attempts']:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                    (STATUS_FAILED, "Воркер не завершил задачу за отведенные попытки", now, row['id']),
+                )
+                logger.error(f"Задача #{row['id']} провалена: воркеры падали {row['attempts']} раз(а)")
+            else:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker = NULL, lease_until = NULL, updated_at = ? WHERE id = ?",
+                    (STATUS_QUEUED, now, row['id']),
+                )
+                logger.warning(f"Задача #{row['id']} возвращена в очередь: воркер {row['worker']} не отвечает")
+
+    def heartbeat(self, job_id: int, worker: str) -> str:
+        """
+        Продлевает аренду задачи
+        Возвращает LEASE_HELD, LEASE_CANCELLED (задачу отменили) или LEASE_LOST (задача уже не у этого воркера)
+        """
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_until = ?, updated_at = ? "
+                "WHERE id = ? AND worker = ? AND status = ? AND cancel_requested = 0",
+                (now + self.lease_seconds, now, job_id, worker, STATUS_RUNNING),
+            )
+            if cursor.rowcount == 1:
+                return LEASE_HELD
+            row = conn.execute("SELECT worker, status, cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        # Отмена наша, только пока задачу не забрал другой воркер (после истечения аренды она остается за нами)
+        if (row and row['cancel_requested'] and row['worker'] == worker
+                and row['status'] in (STATUS_RUNNING, STATUS_CANCELLED)):
+            return LEASE_CANCELLED
+        return LEASE_LOST
+
+    def set_progress(self, job_id: int, worker: str, progress: dict):
+        """Записывает этап и прогресс задачи - фронтенд показывает их пользователю"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET progress = ? WHERE id = ? AND worker = ? AND status = ?",
+                (json.dumps(progress), job_id, worker, STATUS_RUNNING),
+            )
+
+    def complete(self, job_id: int, worker: str, result: dict) -> bool:
+        return self._finish(job_id, worker, STATUS_DONE, result=json.dumps(result))
+
+    def fail(self, job_id: int, worker: str, error: str, error_type: str | None = None) -> bool:
+        return self._finish(job_id, worker, STATUS_FAILED, error=error[:2000], error_type=error_type)
+
+    def mark_cancelled(self, job_id: int, worker: str) -> bool:
+        return self._finish(job_id, worker, STATUS_CANCELLED)
+
+    def _finish(self, job_id: int, worker: str, status: str, result: str | None = None,
+                error: str | None = None, error_type: str | None = None) -> bool:
+        """Записывает итог задачи; False - задача уже не у этого воркера и итог отброшен"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, error_type = ?, lease_until = NULL, updated_at = ? "
+                "WHERE id = ? AND worker = ? AND status = ?",
+                (status, result, error, error_type, time.time(), job_id, worker, STATUS_RUNNING),
+            )
+            if cursor.rowcount != 1:
+                # Аренда истекла и задачу уже забрал другой воркер - его результат главнее
+                logger.warning(f"Задача #{job_id}: результат воркера {worker} отброшен")
+                return False
+            return True
+
+    def release(self, job_id: int, worker: str):
+        """Возвращает задачу в очередь при штатной остановке воркера (попытка не засчитывается)"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = NULL, lease_until = NULL, attempts = attempts - 1, "
+                "updated_at = ? WHERE id = ? AND worker = ? AND status = ?",
+                (STATUS_QUEUED, time.time(), job_id, worker, STATUS_RUNNING),
+            )
+
+    def request_cancel(self, job_id: int):
+        """Просит отменить задачу: из очереди убирается сразу, выполняющуюся остановит воркер"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET cancel_requested = 1, updated_at = ? WHERE id = ?",
+                (now, job_id),
+            )
+            conn.execute(
+                "UPDATE jobs SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+                (STATUS_CANCELLED, now, job_id, STATUS_QUEUED),
+            )
+
+    def get(self, job_id: int) -> QueuedJob | None:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return QueuedJob.from_row(row) if row else None
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {row['status']: row['n'] for row in rows}
+
+    def purge(self, older_than: float):
+        """Удаляет завершенные задачи старше older_than секунд"""
+        with self._connect() as conn:
+            conn.execute(
+                f"DELETE FROM jobs WHERE status IN ({', '.join('?' * len(FINAL_STATUSES))}) AND updated_at < ?",
+                (*FINAL_STATUSES, time.time() - older_than),
+            )
+
+
+async def run_remote(queue: DurableQueue, kind: str, payload: dict, priority: int = 0,
+                     dedup_key: str | None = None, poll_interval: float = QUEUE_POLL_INTERVAL,
+                     detach: Callable[[], bool] | None = None,
+                     on_progress: Callable[[dict], None] | None = None) -> dict:
+    """
+    Ставит задачу в общую очередь и ждет, пока ее выполнит воркер
+    При отмене корутины просит воркер остановить задачу, если только detach() не вернул True
+    (например, бот перезапускается и после запуска снова дождется этой же задачи по dedup_key)
+    on_progress получает этап и прогресс, которые пишет воркер
+    """
+    job_id = await asyncio.to_thread(queue.enqueue, kind, payload, priority, dedup_key)
+    try:
+        while True:
+            await asyncio.sleep(poll_interval)
+            job = await asyncio.to_thread(queue.get, job_id)
+            if job is None or job.status == STATUS_CANCELLED:
+                raise asyncio.CancelledError()
+            if job.status == STATUS_DONE:
+                return job.result or {}
+            if job.status == STATUS_FAILED:
+                raise RemoteJobError(job.error or "Ошибка воркера", job.error_type)
+            if on_progress and job.status == STATUS_RUNNING and job.progress:
+                on_progress(job.progress)
+    except asyncio.CancelledError:
+        if detach is None or not detach():
+            await asyncio.to_thread(queue.request_cancel, job_id)
+        raise
@@ -0,0 +1,220 @@
+import os
+import logging
+from dataclasses import dataclass
+
+from core_budget import core_budget, lookahead_threads
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Локальный сервер Bot API (telegram-bot-api --local) читает файлы по пути и принимает их до 2000 MB
+TELEGRAM_LOCAL_MODE = os.getenv("TELEGRAM_LOCAL_MODE", "").lower() in ("1", "true", "yes")
+
+# Лимиты Telegram Bot API на отправку файлов ботом
+TELEGRAM_CLOUD_LIMIT = 50 * MB
+TELEGRAM_LOCAL_LIMIT = 2000 * MB
+
+# По умолчанию ориентируемся на лимит сервера Bot API, с которым работает бот
+UPLOAD_LIMIT = int(os.getenv("UPLOAD_LIMIT_MB", "0")) * MB or (
+    TELEGRAM_LOCAL_LIMIT if TELEGRAM_LOCAL_MODE else TELEGRAM_CLOUD_LIMIT
+)
+# Сколько секунд можно тратить на перекодирование одного клипа
+ENCODE_TIME_BUDGET = int(os.getenv("ENCODE_TIME_BUDGET", "300"))
+
+# Запас под погрешность оценки размера и контейнер
+SIZE_SAFETY = 0.92
+
+# Пресеты libx264 от лучшего качества к самому быстрому
+PRESETS = ['veryslow', 'slower', 'slow', 'medium', 'fast', 'faster', 'veryfast', 'superfast', 'ultrafast']
+
+# Примерная скорость libx264 в кадрах/с для 1080p на типичном 2-4 ядерном хосте
+PRESET_FPS_1080P = {
+    'veryslow': 6, 'slower': 12, 'slow': 25, 'medium': 45, 'fast': 60,
+    'faster': 80, 'veryfast': 120, 'superfast': 180, 'ultrafast': 260,
+}
+# Сколько потоков кодирования соответствует таблице выше
+PRESET_FPS_THREADS = 3
+
+# Примерное число бит на пиксель для CRF (для 30 к/с, растет с качеством)
+CRF_BITS_PER_PIXEL = {13: 0.25, 15: 0.18, 18: 0.11, 20: 0.08, 23: 0.05}
+# Самое высокое качество, которое имеет смысл выбирать
+CRF_CHOICES = [13, 15, 18, 20, 23]
+
+# Ниже этого битрейта на пиксель картинка разваливается - лучше уменьшить разрешение
+MIN_BITS_PER_PIXEL = 0.04
+SCALE_HEIGHTS = [1080, 720, 480, 360]
+
+AUDIO_BITRATE = 192_000
+
+# Превью: важнее скорость, чем картинка - самый быстрый пресет и заметно сжатое качество
+PREVIEW_CRF = int(os.getenv("PREVIEW_CRF", "32"))
+PREVIEW_AUDIO_BITRATE = 64_000
+
+
+@dataclass(frozen=True)
+class EncodingProfile:
+    """Параметры перекодирования клипа под лимит размера и бюджет времени"""
+    preset: str
+    crf: int | None = None
+    video_bitrate: int | None = None  # бит/с, если кодируем под целевой размер
+    two_pass: bool = False
+    height: int | None = None  # None - исходное разрешение
+    audio_bitrate: int = AUDIO_BITRATE
+    size_limit: int = UPLOAD_LIMIT
+    copy_ok: bool = True
+
+    @property
+    def name(self) -> str:
+        rate = f"crf{self.crf}" if self.crf is not None else f"{self.video_bitrate // 1000}k"
+        passes = "-2pass" if self.two_pass else ""
+        scale = f"-{self.height}p" if self.height else ""
+        return f"{self.preset}-{rate}{passes}{scale}"
+
+    @property
+    def allows_copy(self) -> bool:
+        """Можно ли копировать исходные кадры (умная нарезка) без нарушения профиля"""
+        return self.copy_ok and self.crf is not None and self.height is None
+
+    def video_args(self, pass_num: int | None = None, passlog: str | None = None,
+                   threads: int | None = None) -> list[str]:
+        """Аргументы ffmpeg для видео (threads - ядра, выданные кодированию бюджетом)"""
+        args = ['-c:v', 'libx264', '-preset', self.preset]
+        if threads:
+            args += ['-threads', str(threads),
+                     '-x264-params', f"threads={threads}:lookahead-threads={lookahead_threads(threads)}"]
+        if self.crf is not None:
+            args += ['-crf', str(self.crf)]
+        else:
+            args += [
+                '-b:v', str(self.video_bitrate),
+                # Ограничиваем пики, чтобы однопроходное кодирование тоже уложилось в размер
+                '-maxrate', str(int(self.video_bitrate * 1.2)),
+                '-bufsize', str(self.video_bitrate * 2),
+            ]
+            if self.two_pass and pass_num:
+                args += ['-pass', str(pass_num)]
+                if passlog:
+                    args += ['-passlogfile', passlog]
+        if self.height:
+            args += ['-vf', f"scale=-2:{self.height}"]
+        return args
+
+    def audio_args(self) -> list[str]:
+        return ['-c:a', 'aac', '-b:a', str(self.audio_bitrate)]
+
+
+def profile_signature(size_limit: int = UPLOAD_LIMIT, quality: str | None = None) -> str:
+    """Строка настроек кодирования (и уровня качества) для ключа кеша клипов"""
+    signature = f"x264-{size_limit // MB}mb-{ENCODE_TIME_BUDGET}s"
+    return f"{signature}-{quality}" if quality else signature
+
+
+def estimate_encode_seconds(preset: str, frames: float, pixels: int, threads: int | None = None) -> float:
+    """Оценка времени кодирования для пресета с учетом ядер, которые бюджет выдает одному кодированию"""
+    threads = threads or core_budget.threads_per_encode
+    return frames * (pixels / (1920 * 1080)) / (PRESET_FPS_1080P[preset] * threads / PRESET_FPS_THREADS)
+
+
+def choose_profile(
+    clip_seconds: float,
+    width: int,
+    height: int,
+    fps: float = 30.0,
+    source_bytes: int | None = None,
+    size_limit: int = UPLOAD_LIMIT,
+    time_budget: float = ENCODE_TIME_BUDGET,
+    max_height: int | None = None,
+) -> EncodingProfile:
+    """
+    Выбирает пресет, CRF или целевой битрейт и разрешение так,
+    чтобы клип уложился в лимит загрузки и в бюджет времени с первого раза
+    max_height - потолок разрешения из выбранного пользователем качества
+    """
+    clip_seconds = max(clip_seconds, 1.0)
+    fps = fps or 30.0
+    width = width or 1920
+    height = height or 1080
+    source_width, source_height = width, height
+    # Исходник выше выбранного качества - считаем все для уменьшенной картинки
+    cap_height = max_height if max_height and height > max_height else None
+    if cap_height:
+        width, height = width * cap_height / height, cap_height
+    budget_bytes = size_limit * SIZE_SAFETY
+    audio_bytes = AUDIO_BITRATE * clip_seconds / 8
+
+    # Сначала пробуем CRF в исходном разрешении - лучшее качество за один проход
+    target_height = cap_height
+    crf = None
+    for candidate in CRF_CHOICES:
+        estimate = CRF_BITS_PER_PIXEL[candidate] * width * height * fps * clip_seconds / 8 + audio_bytes
+        if estimate <= budget_bytes:
+            crf = candidate
+            break
+
+    video_bitrate = None
+    if crf is None:
+        # Не помещаемся даже с CRF 23 - кодируем под целевой битрейт
+        video_bitrate = max(int((budget_bytes - audio_bytes) * 8 / clip_seconds), 100_000)
+        # Если на пиксель остается слишком мало бит - уменьшаем разрешение
+        if video_bitrate / (width * height * fps) < MIN_BITS_PER_PIXEL:
+            target_height = SCALE_HEIGHTS[-1] if height > SCALE_HEIGHTS[-1] else cap_height
+            for scale in SCALE_HEIGHTS:
+                scaled_pixels = width * scale / height * scale
+                if scale < height and video_bitrate / (scaled_pixels * fps) >= MIN_BITS_PER_PIXEL:
+                    target_height = scale
+                    break
+
+    out_height = target_height or height
+    out_width = width * out_height / height
+    frames = clip_seconds * fps
+    pixels = int(out_width * out_height)
+
+    # Самый качественный пресет, который укладывается в бюджет времени
+    preset = PRESETS[-1]
+    for candidate in PRESETS:
+        if estimate_encode_seconds(candidate, frames, pixels) <= time_budget:
+            preset = candidate
+            break
+
+    # Второй проход - только если на него хватает времени
+    two_pass = False
+    if video_bitrate is not None:
+        two_pass = estimate_encode_seconds(preset, frames, pixels) * 2 <= time_budget
+
+    profile = EncodingProfile(
+        preset=preset,
+        crf=crf,
+        video_bitrate=video_bitrate,
+        two_pass=two_pass,
+        height=target_height,
+        size_limit=size_limit,
+        # Исходник, который сам не влезает в лимит, копировать нельзя
+        copy_ok=not (source_bytes and source_bytes > budget_bytes),
+    )
+
+    logger.info(
+        f"Профиль кодирования: {profile.name} "
+        f"(клип {clip_seconds:.0f}s, {source_width}x{source_height}@{fps:.0f}, лимит {size_limit / MB:.0f} MB, "
+        f"бюджет {time_budget:.0f}s)"
+    )
+    return profile
+
+
+def preview_profile(height: int) -> EncodingProfile:
+    """Профиль превью: ultrafast, высокий CRF и низкое разрешение - кодируется в разы быстрее реального времени"""
+    return EncodingProfile(preset=PRESETS[-1], crf=PREVIEW_CRF, height=height,
+                           audio_bitrate=PREVIEW_AUDIO_BITRATE, copy_ok=False)
+
+
+def parse_frame_rate(rate: str | None) -> float:
+    """Переводит r_frame_rate из ffprobe ('30000/1001') в число"""
+    if not rate:
+        return 30.0
+    try:
+        if '/' in rate:
+            num, den = rate.split('/')
+            return float(num) / float(den) if float(den) else 30.0
+        return float(rate)
+    except ValueError:
+        return 30.0
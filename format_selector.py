@@ -0,0 +1,201 @@
+import os
+import logging
+from dataclasses import dataclass
+
+from encoding_profiles import AUDIO_BITRATE, MB, SIZE_SAFETY, UPLOAD_LIMIT, estimate_encode_seconds
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class QualityTier:
+    """Уровень качества, который выбирает пользователь: ограничивает разрешение готового клипа"""
+    name: str
+    max_height: int
+
+
+QUALITY_TIERS = {tier.name: tier for tier in (
+    QualityTier("1080p", 1080),
+    QualityTier("720p", 720),
+    QualityTier("480p", 480),
+    QualityTier("360p", 360),
+)}
+# Качество, если пользователь его не выбирал (и для задач из старых записей журнала)
+DEFAULT_QUALITY = os.getenv("DEFAULT_QUALITY", "1080p")
+# Оценка скорости скачивания с YouTube (Мбит/с): переводит размер формата в секунды
+FORMAT_BANDWIDTH_MBPS = float(os.getenv("FORMAT_BANDWIDTH_MBPS", "50"))
+
+# Кодеки, которые готовый клип может сохранить без перекодирования
+COPYABLE_VIDEO_CODECS = ('avc1', 'h264')
+COPYABLE_AUDIO_CODECS = ('mp4a', 'aac')
+# Во сколько раз перекодирование дороже из-за декодирования исходного кодека (относительно H.264)
+DECODE_COST = {'avc1': 1.0, 'h264': 1.0, 'vp9': 1.4, 'vp09': 1.4, 'av01': 2.2}
+# Пресет, по которому сравниваем стоимость перекодирования разных форматов
+RANKING_PRESET = 'medium'
+# Бит на пиксель, если YouTube не сообщил битрейт формата
+FALLBACK_BITS_PER_PIXEL = 0.1
+
+
+def get_tier(name: str | None) -> QualityTier:
+    """Уровень качества по имени ('720p' или '720'); неизвестное имя - уровень по умолчанию"""
+    if name and not name.endswith('p'):
+        name = f"{name}p"
+    return QUALITY_TIERS.get(name) or QUALITY_TIERS.get(DEFAULT_QUALITY) or QUALITY_TIERS["1080p"]
+
+
+@dataclass
+class FormatCandidate:
+    """Формат (или пара видео + аудио) с оценкой затрат на получение клипа"""
+    video: dict
+    audio: dict | None
+    transfer_bytes: float
+    encode_seconds: float
+    copyable: bool
+
+    @property
+    def spec(self) -> str:
+        return f"{self.video['format_id']}+{self.audio['format_id']}" if self.audio else self.video['format_id']
+
+    @property
+    def transfer_seconds(self) -> float:
+        return self.transfer_bytes * 8 / (FORMAT_BANDWIDTH_MBPS * 1_000_000)
+
+    @property
+    def cost(self) -> float:
+        return self.encode_seconds + self.transfer_seconds
+
+    def describe(self) -> str:
+        video = self.video
+        codecs = codec_family(video.get('vcodec'))
+        if self.audio:
+            codecs += f"+{codec_family(self.audio.get('acodec'))}"
+        action = "копирование" if self.copyable else f"перекодирование ~{self.encode_seconds:.0f}s"
+        return (
+            f"{self.spec} ({video.get('height') or '?'}p {codecs}, ~{self.transfer_bytes / MB:.1f} MB "
+            f"~{self.transfer_seconds:.0f}s, {action})"
+        )
+
+
+def codec_family(codec: str | None) -> str:
+    """'avc1.640028' -> 'avc1', 'vp09.00.40.08' -> 'vp09'"""
+    return (codec or 'none').split('.')[0].lower()
+
+
+def has_video(fmt: dict) -> bool:
+    return fmt.get('vcodec') not in (None, 'none')
+
+
+def has_audio(fmt: dict) -> bool:
+    return fmt.get('acodec') not in (None, 'none')
+
+
+def clip_bytes(fmt: dict, clip_seconds: float, duration: float | None) -> float:
+    """Сколько байт формата придется скачать ради клипа"""
+    if fmt.get('tbr'):
+        return fmt['tbr'] * 1000 / 8 * clip_seconds
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size and duration:
+        return size * min(clip_seconds / duration, 1.0)
+    if fmt.get('abr') and not has_video(fmt):
+        return fmt['abr'] * 1000 / 8 * clip_seconds
+    pixels = (fmt.get('width') or (fmt.get('height') or 720) * 16 / 9) * (fmt.get('height') or 720)
+    return FALLBACK_BITS_PER_PIXEL * pixels * (fmt.get('fps') or 30) * clip_seconds / 8
+
+
+def choose_audio(formats: list[dict]) -> dict | None:
+    """
+    Аудио для отдельного видеопотока: AAC предпочтительнее (не нужно перекодировать),
+    из него - самый легкий поток не хуже битрейта готового клипа, иначе самый качественный
+    """
+    audio = [fmt for fmt in formats if has_audio(fmt) and not has_video(fmt)]
+    if not audio:
+        return None
+    target = AUDIO_BITRATE / 1000 * 2 / 3  # AAC 128k не хуже перекодированных 192k
+
+    def _rank(fmt: dict):
+        abr = fmt.get('abr') or fmt.get('tbr') or 0
+        return (
+            codec_family(fmt.get('acodec')) not in COPYABLE_AUDIO_CODECS,
+            abr < target,
+            abr if abr >= target else -abr,
+        )
+
+    return min(audio, key=_rank)
+
+
+def rank_formats(info: dict, tier: QualityTier, clip_seconds: float,
+                 size_limit: int = UPLOAD_LIMIT) -> list[FormatCandidate]:
+    """
+    Оценивает форматы видео под готовый клип: разрешение не выше уровня качества,
+    H.264 + AAC в пределах лимита размера, минимум скачивания и перекодирования
+    Возвращает кандидатов от лучшего к худшему
+    """
+    formats = [
+        fmt for fmt in info.get('formats') or []
+        if fmt.get('format_id') and not fmt.get('has_drm') and fmt.get('ext') != 'mhtml'
+    ]
+    videos = [fmt for fmt in formats if has_video(fmt)]
+    if not videos:
+        return []
+    clip_seconds = max(clip_seconds, 1.0)
+    duration = info.get('duration')
+    audio = choose_audio(formats)
+
+    # Целевое разрешение - уровень качества или лучшее, что есть у видео
+    target_height = min(tier.max_height, max(fmt.get('height') or 0 for fmt in videos))
+    budget_bytes = size_limit * SIZE_SAFETY
+
+    candidates = []
+    for video in videos:
+        height = video.get('height') or 0
+        # Форматы ниже цели дешевле, но теряют качество, которое пользователь выбрал
+        if height < target_height:
+            continue
+        paired = None if has_audio(video) else audio
+        transfer = clip_bytes(video, clip_seconds, duration)
+        if paired:
+            transfer += clip_bytes(paired, clip_seconds, duration)
+        vcodec = codec_family(video.get('vcodec'))
+        copyable = (
+            vcodec in COPYABLE_VIDEO_CODECS
+            and height <= tier.max_height
+            and transfer <= budget_bytes
+        )
+        encode = 0.0
+        if not copyable:
+            out_height = min(height, tier.max_height) or 720
+            out_width = (video.get('width') or out_height * 16 / 9) * out_height / (height or out_height)
+            frames = clip_seconds * (video.get('fps') or 30)
+            encode = (estimate_encode_seconds(RANKING_PRESET, frames, int(out_width * out_height))
+                      * DECODE_COST.get(vcodec, 1.5))
+        candidates.append(FormatCandidate(video, paired, transfer, encode, copyable))
+
+    # При равной стоимости - формат с более высоким разрешением
+    candidates.sort(key=lambda candidate: (candidate.cost, -(candidate.video.get('height') or 0)))
+    return candidates
+
+
+def format_spec(info: dict, tier: QualityTier, clip_seconds: float) -> str | None:
+    """
+    Строка формата yt-dlp для клипа: выбранный формат и запасной вариант с ограничением разрешения
+    None - у видео нет списка форматов, выбор остается yt-dlp
+    """
+    candidates = rank_formats(info, tier, clip_seconds)
+    if not candidates:
+        return None
+    best = candidates[0]
+    logger.info(
+        f"Формат для {info.get('id')} ({tier.name}, клип {clip_seconds:.0f}s): {best.describe()}"
+    )
+    for candidate in candidates[1:4]:
+        logger.info(f"  отклонен {candidate.describe()}: дороже на {candidate.cost - best.cost:.0f}s")
+    height = tier.max_height
+    return f"{best.spec}/bv*[height<={height}]+ba/b[height<={height}]/bv*+ba/b"
+
+
+def apply_format(ydl, info: dict, tier: QualityTier, clip_seconds: float):
+    """Подставляет выбранный формат в ydl перед process_ie_result"""
+    spec = format_spec(info, tier, clip_seconds)
+    if spec:
+        ydl.params['format'] = spec
+        ydl.format_selector = ydl.build_format_selector(spec)
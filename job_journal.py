@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import uuid
+import logging
+import sqlite3
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_DB = Path(os.getenv("JOB_JOURNAL_DB", "data/journal.sqlite3"))
+# Сколько раз задача продолжается после перезапусков, прежде чем считаться проваленной
+JOURNAL_MAX_RESUMES = int(os.getenv("JOURNAL_MAX_RESUMES", "3"))
+# Сколько хранить записи о завершенных задачах (секунды)
+JOURNAL_RETENTION = int(os.getenv("JOURNAL_RETENTION", str(7 * 24 * 3600)))
+
+# Этапы конвейера по порядку; задача продолжается с последнего пройденного
+STAGE_CREATED = "created"
+STAGE_DOWNLOADED = "downloaded"
+STAGE_PROBED = "probed"
+STAGE_CUT = "cut"
+STAGE_ENCODED = "encoded"
+STAGE_UPLOADED = "uploaded"
+STAGES = [STAGE_CREATED, STAGE_DOWNLOADED, STAGE_PROBED, STAGE_CUT, STAGE_ENCODED, STAGE_UPLOADED]
+
+JOB_ACTIVE = "active"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    job_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    artifacts TEXT NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL,
+    resumes INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS journal_status ON journal (status, created_at);
+"""
+
+
+@dataclass
+class JournalEntry:
+    job_id: str
+    kind: str
+    chat_id: int
+    user_id: int
+    payload: dict
+    stage: str
+    artifacts: dict
+    status: str
+    resumes: int
+
+    def reached(self, stage: str) -> bool:
+        """Пройден ли этап stage (или более поздний)"""
+        return STAGES.index(self.stage) >= STAGES.index(stage)
+
+    def artifact_path(self, name: str) -> Path | None:
+        """Путь к файлу-артефакту, если он записан в журнал и еще существует"""
+        value = self.artifacts.get(name)
+        if value and Path(value).exists():
+            return Path(value)
+        return None
+
+
+class JobJournal:
+    """
+    Журнал задач в SQLite: для каждой задачи хранит этап конвейера и его артефакты.
+    После перезапуска бота незавершенные задачи продолжаются с последнего пройденного этапа.
+    Пишут в журнал и бот, и процессы worker.py, поэтому соединение открывается на каждую операцию.
+    """
+
+    def __init__(self, path: Path = JOURNAL_DB):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def create(self, kind: str, chat_id: int, user_id: int, payload: dict) -> str:
+        job_id = uuid.uuid4().hex[:16]
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO journal (job_id, kind, chat_id, user_id, payload, stage, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, chat_id, user_id, json.dumps(payload), STAGE_CREATED, JOB_ACTIVE, now, now),
+            )
+        return job_id
+
+    def get(self, job_id: str | None) -> JournalEntry | None:
+        if not job_id:
+            return None
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM journal WHERE job_id = ?", (job_id,)).fetchone()
+        return self._entry(row) if row else None
+
+    def advance(self, job_id: str | None, stage: str, **artifacts):
+        """Отмечает пройденный этап и добавляет его артефакты (пути файлов, результаты проб)"""
+        if not job_id:
+            return
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT stage, artifacts FROM journal WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return
+            merged = {**json.loads(row['artifacts']), **artifacts}
+            # Этап не откатываем назад: повторная запись более раннего этапа только дополняет артефакты
+            new_stage = stage if STAGES.index(stage) > STAGES.index(row['stage']) else row['stage']
+            conn.execute(
+                "UPDATE journal SET stage = ?, artifacts = ?, updated_at = ? WHERE job_id = ?",
+                (new_stage, json.dumps(merged), time.time(), job_id),
+            )
+            conn.execute("COMMIT")
+        logger.info(f"Журнал: задача {job_id} - этап {stage}")
+
+    def mark_resumed(self, job_id: str) -> int:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE journal SET resumes = resumes + 1, updated_at = ? WHERE job_id = ?",
+                (time.time(), job_id),
+            )
+            row = conn.execute("SELECT resumes FROM journal WHERE job_id = ?", (job_id,)).fetchone()
+        return row['resumes'] if row else 0
+
+    def finish(self, job_id: str | None, status: str):
+        if not job_id:
+            return
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE journal SET status = ?, updated_at = ? WHERE job_id = ? AND status = ?",
+                (status, time.time(), job_id, JOB_ACTIVE),
+            )
+
+    def active(self) -> list[JournalEntry]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM journal WHERE status = ? ORDER BY created_at", (JOB_ACTIVE,)
+            ).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def purge(self, older_than: float = JOURNAL_RETENTION):
+        """Удаляет записи о завершенных задачах старше older_than секунд"""
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM journal WHERE status != ? AND updated_at < ?",
+                (JOB_ACTIVE, time.time() - older_than),
+            )
+
+    @staticmethod
+    def _entry(row: sqlite3.Row) -> JournalEntry:
+        return JournalEntry(
+            job_id=row['job_id'],
+            kind=row['kind'],
+            chat_id=row['chat_id'],
+            user_id=row['user_id'],
+            payload=json.loads(row['payload']),
+            stage=row['stage'],
+            artifacts=json.loads(row['artifacts']),
+            status=row['status'],
+            resumes=row['resumes'],
+        )
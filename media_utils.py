@@ -0,0 +1,78 @@
+import re
+from urllib.parse import urlparse, parse_qs
+
+# Идентификатор видео YouTube - 11 символов
+VIDEO_ID_PATTERN = re.compile(r'^[0-9A-Za-z_-]{11}$')
+
+
+def normalize_time(time_str: str) -> str | None:
+    """
+    Нормализует время до формата HH:MM:SS
+    Возвращает None если формат неверный
+    """
+    # Убираем пробелы
+    time_str = time_str.strip()
+    
+    # Проверяем формат HH:MM:SS
+    time_pattern = r'^(\d{1,2}):(\d{2}):(\d{2})$'
+    match = re.match(time_pattern, time_str)
+    
+    if match:
+        hours = int(match.group(1))
+        minutes = int(match.group(2))
+        seconds = int(match.group(3))
+        
+        # Проверяем валидность
+        if minutes >= 60 or seconds >= 60:
+            return None
+        
+        # Форматируем с ведущими нулями
+        return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+    
+    # Проверяем формат MM:SS
+    time_pattern_mmss = r'^(\d{1,2}):(\d{2})$'
+    match = re.match(time_pattern_mmss, time_str)
+    
+    if match:
+        minutes = int(match.group(1))
+        seconds = int(match.group(2))
+        
+        # Проверяем валидность
+        if minutes >= 60 or seconds >= 60:
+            return None
+        
+        # Форматируем как 00:MM:SS
+        return f"00:{minutes:02d}:{seconds:02d}"
+    
+    return None
+
+
+def extract_video_id(url: str) -> str | None:
+    """
+    Извлекает ID видео из ссылки YouTube
+    Поддерживает watch?v=, youtu.be/, /live/, /shorts/, /embed/
+    Возвращает None, если ID найти не удалось
+    """
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or '').lower()
+    candidate = None
+
+    if host.endswith('youtu.be'):
+        candidate = parsed.path.lstrip('/').split('/')[0]
+    elif host.endswith('youtube.com'):
+        query_id = parse_qs(parsed.query).get('v')
+        if query_id:
+            candidate = query_id[0]
+        else:
+            parts = [part for part in parsed.path.split('/') if part]
+            if len(parts) >= 2 and parts[0] in ('live', 'shorts', 'embed', 'v'):
+                candidate = parts[1]
+
+    if candidate and VIDEO_ID_PATTERN.match(candidate):
+        return candidate
+    return None
+
+
+def time_to_seconds(time_str: str) -> int:
+    """Переводит время HH:MM:SS в секунды"""
+    return sum(int(x) * 60 ** (2 - i) for i, x in enumerate(time_str.split(':')))
@@ -0,0 +1,134 @@
+import os
+import re
+import copy
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from media_utils import extract_video_id
+from metrics import inc
+
+logger = logging.getLogger(__name__)
+
+# Настройки кеша метаданных видео
+METADATA_TTL = int(os.getenv("METADATA_TTL", "3600"))
+# Для трансляций список фрагментов постоянно меняется, поэтому храним недолго
+METADATA_LIVE_TTL = int(os.getenv("METADATA_LIVE_TTL", "120"))
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", "256"))
+# Запас до истечения подписанных ссылок на потоки
+METADATA_EXPIRY_MARGIN = 300
+
+# expire=1700000000 в query-параметрах или /expire/1700000000/ в пути манифеста
+EXPIRE_PATTERN = re.compile(r'[?&/]expire[=/](\d+)')
+
+
+def url_expiry(info: dict) -> float | None:
+    """Находит самый ранний срок действия подписанных ссылок на потоки"""
+    expiries = []
+    for fmt in info.get('formats') or []:
+        for field in ('url', 'manifest_url', 'fragment_base_url'):
+            value = fmt.get(field)
+            if isinstance(value, str):
+                match = EXPIRE_PATTERN.search(value)
+                if match:
+                    expiries.append(int(match.group(1)))
+    return min(expiries) if expiries else None
+
+
+class MetadataCache:
+    """
+    Кеш результатов extract_info по ID видео.
+    Учитывает срок действия подписанных ссылок, чтобы не отдавать протухшие форматы.
+    """
+
+    def __init__(
+        self,
+        ttl: int = METADATA_TTL,
+        live_ttl: int = METADATA_LIVE_TTL,
+        max_entries: int = METADATA_CACHE_SIZE,
+        expiry_margin: int = METADATA_EXPIRY_MARGIN,
+    ):
+        self.ttl = ttl
+        self.live_ttl = live_ttl
+        self.max_entries = max_entries
+        self.expiry_margin = expiry_margin
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+        # Отдельная блокировка на каждое видео, чтобы параллельные задачи не извлекали его дважды;
+        # хранится, пока ее кто-то ждет или держит: [блокировка, число пользователей]
+        self._key_locks: dict[str, list] = {}
+
+    def _expires_at(self, info: dict) -> float:
+        now = time.time()
+        expires_at = now + (self.live_ttl if info.get('is_live') else self.ttl)
+        signed_expiry = url_expiry(info)
+        if signed_expiry:
+            expires_at = min(expires_at, signed_expiry - self.expiry_margin)
+        return expires_at
+
+    def get(self, key: str) -> dict | None:
+        """Возвращает копию закешированной информации или None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, info = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return copy.deepcopy(info)
+
+    def put(self, key: str, info: dict):
+        expires_at = self._expires_at(info)
+        if expires_at <= time.time():
+            return
+        with self._lock:
+            self._entries[key] = (expires_at, copy.deepcopy(info))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_or_extract(self, url: str, ydl) -> dict:
+        """
+        Возвращает информацию о видео из кеша или извлекает ее через yt-dlp
+        Результат не обработан (process=False), чтобы выбор формата делался по опциям конкретной задачи
+        """
+        key = extract_video_id(url) or url
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+
+        try:
+            with key_lock[0]:
+                info = self.get(key)
+                if info is not None:
+                    self.hits += 1
+                    inc('metadata_cache_total', result='hit')
+                    logger.info(f"Метаданные {key} взяты из кеша (попаданий={self.hits}, промахов={self.misses})")
+                    return info
+
+                self.misses += 1
+                inc('metadata_cache_total', result='miss')
+                logger.info(f"Извлекаю метаданные {key} (попаданий={self.hits}, промахов={self.misses})")
+                info = ydl.extract_info(url, download=False, process=False)
+                self.put(key, info)
+                return copy.deepcopy(info)
+        finally:
+            # Блокировки видео, которые никто не ждет, не копятся все время жизни процесса
+            with self._lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    del self._key_locks[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"metadata_cached": len(self._entries), "metadata_hits": self.hits,
+                    "metadata_misses": self.misses}
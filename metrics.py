@@ -0,0 +1,216 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних наблюдений хранить для квантилей каждой метрики
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "1024"))
+METRICS_PREFIX = "trubabot_"
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Метрики: имя -> (тип Prometheus, описание)
+METRICS = {
+    'stage_seconds': ('summary', 'Длительность этапов задачи (extract, download, merge, probe, cut, encode, stream, preview, upload)'),
+    'queue_wait_seconds': ('summary', 'Ожидание задачи в очереди планировщика'),
+    'core_wait_seconds': ('summary', 'Ожидание ядер перед кодированием'),
+    'job_seconds': ('summary', 'Время от запроса до отправки клипа'),
+    'jobs_total': ('counter', 'Завершенные задачи по виду и результату'),
+    'encode_decisions_total': ('counter', 'Как получен клип: copy, smart_cut, reencode, stream'),
+    'fallbacks_total': ('counter', 'Переходы на запасной путь обработки'),
+    'errors_total': ('counter', 'Ошибки задач по виду'),
+    'clip_cache_hits_total': ('counter', 'Клипы, отданные из кеша'),
+    'metadata_cache_total': ('counter', 'Обращения к кешу метаданных видео: hit, miss'),
+    'previews_total': ('counter', 'Превью клипов по результату'),
+    'youtube_throttled_total': ('counter', 'Ограничения YouTube по виду'),
+}
+
+# ID задачи для логов и метрик; в процессе worker.py приходит вместе с задачей
+trace_id: ContextVar[str] = ContextVar('trace_id', default='-')
+# Записи метрик задачи, которые воркер возвращает боту (None - не собирать)
+_trace_records: ContextVar[list | None] = ContextVar('trace_records', default=None)
+
+
+class Summary:
+    """Число и сумма наблюдений плюс окно последних значений для квантилей"""
+
+    def __init__(self, window: int = METRICS_WINDOW):
+        self.count = 0
+        self.sum = 0.0
+        self.window: deque[float] = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.window.append(value)
+
+    def quantiles(self) -> dict[float, float]:
+        values = sorted(self.window)
+        if not values:
+            return {}
+        return {q: values[min(len(values) - 1, int(q * len(values)))] for q in QUANTILES}
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: tuple, **extra) -> str:
+    pairs = [*labels, *((key, str(value)) for key, value in extra.items())]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+class MetricsRegistry:
+    """Счетчики и сводки процесса; записываются из event loop и из потоков yt-dlp"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: dict[str, dict[tuple, float]] = {}
+        self._summaries: dict[str, dict[tuple, Summary]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._summaries.setdefault(name, {}).setdefault(key, Summary()).observe(value)
+
+    def counters(self, name: str) -> dict[tuple, float]:
+        with self._lock:
+            return dict(self._counters.get(name, {}))
+
+    def summaries(self, name: str) -> dict[tuple, tuple[int, float, dict]]:
+        """labels -> (число, сумма, квантили)"""
+        with self._lock:
+            return {key: (summary.count, summary.sum, summary.quantiles())
+                    for key, summary in self._summaries.get(name, {}).items()}
+
+    def render(self, gauges: dict | None = None) -> str:
+        """Текстовый формат Prometheus; gauges - текущие значения (очередь, ядра и т.п.)"""
+        lines = []
+        for name, (kind, description) in METRICS.items():
+            full_name = METRICS_PREFIX + name
+            if kind == 'counter':
+                series = self.counters(name)
+                if not series:
+                    continue
+                lines += [f"# HELP {full_name} {description}", f"# TYPE {full_name} counter"]
+                lines += [f"{full_name}{_format_labels(key)} {value:g}" for key, value in sorted(series.items())]
+            else:
+                series = self.summaries(name)
+                if not series:
+                    continue
+                lines += [f"# HELP {full_name} {description}", f"# TYPE {full_name} summary"]
+                for key, (count, total, quantiles) in sorted(series.items()):
+                    lines += [f"{full_name}{_format_labels(key, quantile=q)} {value:.6f}"
+                              for q, value in quantiles.items()]
+                    lines += [f"{full_name}_sum{_format_labels(key)} {total:.6f}",
+                              f"{full_name}_count{_format_labels(key)} {count}"]
+        for name, value in (gauges or {}).items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            lines += [f"# TYPE {METRICS_PREFIX}{name} gauge", f"{METRICS_PREFIX}{name} {value:g}"]
+        return "\n".join(lines) + "\n"
+
+
+# Метрики процесса (у бота и у каждого процесса worker.py свои; воркеры передают записи боту)
+registry = MetricsRegistry()
+
+
+def inc(name: str, value: float = 1, **labels):
+    """Увеличивает счетчик (и запоминает запись для бота, если задача выполняется в воркере)"""
+    registry.inc(name, value, **labels)
+    records = _trace_records.get()
+    if records is not None:
+        records.append(('inc', name, value, labels))
+
+
+def observe(name: str, value: float, **labels):
+    """Добавляет наблюдение в сводку (и запоминает запись для бота, если задача выполняется в воркере)"""
+    registry.observe(name, value, **labels)
+    records = _trace_records.get()
+    if records is not None:
+        records.append(('observe', name, value, labels))
+
+
+def _describe_labels(key: tuple) -> str:
+    return ", ".join(value for _, value in key) or "всего"
+
+
+def describe_summaries(name: str) -> list[str]:
+    """Сводка для людей (команда /stats): 'extract: 0.41/1.20/2.05s (n=12)'"""
+    lines = []
+    for key, (count, _, quantiles) in sorted(registry.summaries(name).items()):
+        values = "/".join(f"{value:.2f}" for value in quantiles.values())
+        lines.append(f"{_describe_labels(key)}: {values}s (n={count})")
+    return lines
+
+
+def describe_counters(name: str) -> list[str]:
+    """Счетчики для людей (команда /stats): 'clip, done: 10'"""
+    return [f"{_describe_labels(key)}: {value:g}" for key, value in sorted(registry.counters(name).items())]
+
+
+@contextmanager
+def stage(name: str):
+    """Замеряет этап задачи; время пишется и в метрики, и в лог с ID задачи"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - started
+        observe('stage_seconds', elapsed, stage=name)
+        logger.info(f"Этап {name}: {elapsed:.2f}s")
+
+
+@contextmanager
+def job_trace(job_id: str | None, collect: bool = False):
+    """
+    Привязывает логи и метрики к задаче на время блока
+    collect=True - собирает записи метрик в список, который воркер возвращает боту
+    """
+    records = [] if collect else None
+    trace_token = trace_id.set(job_id or '-')
+    records_token = _trace_records.set(records)
+    try:
+        yield records
+    finally:
+        trace_id.reset(trace_token)
+        _trace_records.reset(records_token)
+
+
+def replay(records: list | None):
+    """Переносит в метрики бота записи, собранные воркером"""
+    for kind, name, value, labels in records or []:
+        if kind == 'inc':
+            registry.inc(name, value, **labels)
+        elif kind == 'observe':
+            registry.observe(name, value, **labels)
+
+
+class TraceFilter(logging.Filter):
+    """Добавляет в записи лога ID задачи (%(trace_id)s в формате)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id.get()
+        return True
+
+
+def install_trace_logging():
+    """Подключает ID задачи к обработчикам корневого логгера (вызывать после logging.basicConfig)"""
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(TraceFilter())
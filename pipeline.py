@@ -0,0 +1,558 @@
+import re
+import asyncio
+import logging
+import tempfile
+from pathlib import Path
+from typing import Callable
+
+import yt_dlp
+
+from batch import Clip, ClipCutter, covered_seconds, merge_ranges
+from media_utils import extract_video_id, time_to_seconds
+from metadata_cache import MetadataCache
+from encoding_profiles import EncodingProfile, SIZE_SAFETY, choose_profile, parse_frame_rate, preview_profile
+from format_selector import QualityTier, apply_format, get_tier
+from streaming import (PREVIEW_BACKENDS, PREVIEW_MAX_SECONDS, PREVIEW_MIN_SECONDS, PREVIEW_QUALITY, PREVIEW_THREADS,
+                       STREAMING_MODE, StreamTooLarge, resolve_stream_formats, stream_segment)
+from process_runner import JobCancelled, JobHandle, ProcessTimeout
+from smart_cut import full_reencode, probe_video_stream, smart_cut
+from scheduler import SHORT_CLIP_SECONDS
+from job_journal import STAGE_CUT, STAGE_DOWNLOADED, STAGE_ENCODED, STAGE_PROBED, JobJournal
+from workspace import WorkspaceManager
+from throttle import youtube_throttle
+from ydl_pool import YdlPool
+from segmented import (JOB_BANDWIDTH_MBPS, SectionHandoff, SectionMerge, bytes_per_second, download_sections,
+                       merge_section)
+from metrics import inc, job_trace, stage
+from durable_queue import JOB_BACKEND
+
+logger = logging.getLogger(__name__)
+
+# Папки задач и бюджет диска (общие для бота и процессов worker.py)
+workspaces = WorkspaceManager()
+
+# Общие опции yt-dlp для извлечения и скачивания
+YDL_BASE_OPTS = {
+    # Запасной выбор формата; для задач формат подбирает format_selector под уровень качества клипа
+    # bv* - лучшее видео любого формата, ba* - лучшее аудио
+    'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/bestvideo+bestaudio/best',
+    'quiet': False,
+    'no_warnings': False,
+    'extract_flat': False,
+    # Опции для обхода блокировок YouTube
+    'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'referer': 'https://www.youtube.com/',
+    'extractor_args': {
+        'youtube': {
+            'player_client': ['android', 'web'],  # Задачи берут набор клиентов из throttle.py
+        }
+    },
+    # Ограничение скорости задачи, если диапазон или файл качает сам yt-dlp
+    'ratelimit': bytes_per_second(JOB_BANDWIDTH_MBPS) or None,
+}
+
+# Прогретые экземпляры YoutubeDL: соединения, куки и кеш плеера переживают задачу
+ydl_pool = YdlPool(YDL_BASE_OPTS)
+
+# Кеш метаданных видео (результаты extract_info)
+metadata_cache = MetadataCache()
+
+# Журнал этапов задач (общий для бота и процессов worker.py)
+journal = JobJournal()
+
+
+def choose_file_profile(path: Path, clip_seconds: int, video_stream: dict,
+                        max_height: int | None = None) -> EncodingProfile:
+    """Подбирает профиль кодирования для скачанного файла"""
+    file_size = path.stat().st_size
+    file_duration = video_stream.get('format_duration') or 0
+    # Если скачался весь файл, оцениваем размер только нужного фрагмента
+    source_bytes = file_size * min(clip_seconds / file_duration, 1.0) if file_duration else file_size
+    return choose_profile(
+        clip_seconds,
+        int(video_stream.get('width') or 0),
+        int(video_stream.get('height') or 0),
+        parse_frame_rate(video_stream.get('r_frame_rate')),
+        source_bytes=int(source_bytes),
+        max_height=max_height,
+    )
+
+
+def warm_ydl_pool():
+    """Прогревает пул YoutubeDL с текущими заголовками (синхронно - запускать в отдельном потоке)"""
+    ydl_pool.warm(youtube_throttle.request_opts()['http_headers'])
+
+
+def video_key(url: str) -> str:
+    """Ключ видео для кеша метаданных и ограничений запросов"""
+    return extract_video_id(url) or url
+
+
+async def run_ydl(url: str, func, *args):
+    """Вызов yt-dlp в отдельном потоке через контроллер ограничений YouTube (темп, повторы, размыкатель)"""
+    return await youtube_throttle.run(video_key(url), func, *args, invalidate=metadata_cache.invalidate)
+
+
+def download_info(ydl, info: dict, ydl_opts: dict, handoff: SectionHandoff | None = None):
+    """
+    Диапазоны download_ranges качаем параллельными фрагментами, остальное (и неподдерживаемые форматы) - yt-dlp
+    handoff - куда передавать скачанные по фрагментам диапазоны на склейку (None - все качает yt-dlp)
+    """
+    with stage('download'):
+        if handoff is not None and download_sections(ydl, info, ydl_opts.get('progress_hooks', []), handoff):
+            return
+        if handoff is not None and handoff.claimed:
+            # Часть диапазонов уже склеивается: остальные yt-dlp докачает, когда склейка закончится
+            handoff.incomplete = True
+            return
+        ydl.process_ie_result(info, download=True)
+
+
+def ydl_download(url: str, ydl_opts: dict, tier: QualityTier | None = None, clip_seconds: float = 0,
+                 handoff: SectionHandoff | None = None):
+    """
+    Скачивает видео через yt-dlp
+    Метаданные берем из кеша, чтобы не запускать экстрактор YouTube заново
+    tier и clip_seconds - под них выбирается формат (скачиваем не больше, чем нужно клипу)
+    handoff - диапазоны качаются по фрагментам и по одному передаются на склейку в event loop
+    (download_ranges); без него диапазоны качает сам yt-dlp
+    """
+    # Клиенты YouTube и User-Agent - текущие для контроллера ограничений (меняются после блокировок)
+    with ydl_pool.checkout({**ydl_opts, **youtube_throttle.request_opts()}) as ydl:
+        with stage('extract'):
+            info = metadata_cache.get_or_extract(url, ydl)
+            if tier:
+                apply_format(ydl, info, tier, clip_seconds)
+        try:
+            return download_info(ydl, info, ydl_opts, handoff)
+        except yt_dlp.utils.DownloadError as e:
+            if 'HTTP Error 403' not in str(e):
+                raise
+            # Подписанные ссылки протухли раньше срока - извлекаем заново
+            logger.warning("Ссылки на потоки недействительны, обновляю метаданные")
+            metadata_cache.invalidate(video_key(url))
+            inc('fallbacks_total', kind='refresh_metadata')
+            with stage('extract'):
+                info = metadata_cache.get_or_extract(url, ydl)
+                if tier:
+                    apply_format(ydl, info, tier, clip_seconds)
+            return download_info(ydl, info, ydl_opts, handoff)
+
+
+async def download_ranges(handle: JobHandle, url: str, ydl_opts: dict, tier: QualityTier, clip_seconds: float,
+                          on_section: Callable[[SectionMerge], None] | None = None):
+    """
+    Скачивает диапазоны download_ranges: фрагменты качаются в потоке yt-dlp, а каждый скачанный диапазон
+    сразу склеивается здесь через run_process, пока качаются следующие (отмена задачи сразу останавливает ffmpeg)
+    on_section(merge) вызывается для каждого склеенного диапазона - с него уже можно начинать нарезку
+    Диапазоны, которые не удалось скачать по фрагментам или склеить, потом качает сам yt-dlp
+    """
+    handle.set_progress('extract')
+    handoff = SectionHandoff(asyncio.get_running_loop())
+    download = asyncio.ensure_future(run_ydl(url, ydl_download, url, ydl_opts, tier, clip_seconds, handoff))
+    download.add_done_callback(lambda _: handoff.close())
+    complete = True
+    try:
+        while (merge := await handoff.next()) is not None:
+            with handle.stage('merge'):
+                merged = await merge_section(merge, handle)
+            if merged and on_section:
+                on_section(merge)
+            complete = complete and merged
+        await download
+    finally:
+        # Поток yt-dlp еще качает (склейка прервана отменой) - ждем его, чтобы он не писал в папку задачи
+        if not download.done():
+            await asyncio.gather(download, return_exceptions=True)
+        handoff.discard()
+    if not complete or handoff.incomplete:
+        handle.set_progress('download')
+        await run_ydl(url, ydl_download, url, ydl_opts, tier, clip_seconds)
+
+
+def find_download(output_path: Path) -> Path | None:
+    """Ищет файл, скачанный yt-dlp по шаблону output_path.%(ext)s (без .part и отдельных потоков)"""
+    for ext in ['.mp4', '.mkv', '.webm', '.m4a']:
+        candidate = output_path.with_suffix(ext)
+        if candidate.exists():
+            return candidate
+    for candidate in sorted(output_path.parent.glob(f"{output_path.name}.*")):
+        if candidate.is_file() and candidate.suffix not in ('.part', '.ytdl') and not re.search(r'\.f\d+$', candidate.stem):
+            return candidate
+    return None
+
+
+async def download_video_segment(handle: JobHandle, url: str, start_time: str, end_time: str,
+                                 journal_id: str | None = None, quality: str | None = None) -> Path | None:
+    """
+    Скачивает фрагмент видео с YouTube
+    Пытается использовать download_ranges для скачивания только нужного фрагмента
+    ffmpeg/ffprobe запускаются асинхронно и убиваются при отмене задачи через handle
+    Пройденные этапы записываются в журнал; после перезапуска задача продолжается с последнего
+    quality - уровень качества: по нему выбирается формат и потолок разрешения клипа
+    """
+    tier = get_tier(quality)
+    workspace = workspaces.workspace(journal_id)
+    output_path = workspace / "video"
+    entry = journal.get(journal_id)
+    
+    # Вычисляем длительность для download_ranges
+    start_seconds = time_to_seconds(start_time)
+    end_seconds = time_to_seconds(end_time)
+    duration = end_seconds - start_seconds
+    
+    # Клип уже готов - задача прервалась на отправке
+    if entry and entry.reached(STAGE_CUT) and entry.artifact_path('clip'):
+        logger.info(f"Задача {journal_id}: клип уже готов, продолжаю с отправки")
+        return entry.artifact_path('clip')
+    
+    # Опции для yt-dlp - пытаемся скачать только нужный фрагмент
+    # download_ranges работает с форматами, которые поддерживают сегментированную загрузку
+    # (опция download_sections есть только в CLI, Python API ее молча игнорирует)
+    ydl_opts = {
+        **YDL_BASE_OPTS,
+        'outtmpl': str(output_path) + '.%(ext)s',
+        # Не указываем merge_output_format, чтобы сохранить исходное качество
+        # Будем перекодировать в MP4 через ffmpeg с сохранением качества
+        'download_ranges': yt_dlp.utils.download_range_func(None, [(start_seconds, end_seconds)]),
+        # Продолжаем скачивание с уже загруженных фрагментов (.part), если задача перезапущена
+        'continuedl': True,
+        # Хук прерывает скачивание, если задачу отменили
+        'progress_hooks': [handle.progress_hook],
+    }
+    # При отмене удаляем папку задачи и останавливаем ffmpeg, запущенный yt-dlp
+    handle.register_path(workspace, marker=True)
+    
+    try:
+        source_path = entry.artifact_path('source') if entry and entry.reached(STAGE_DOWNLOADED) else None
+        if source_path:
+            logger.info(f"Задача {journal_id}: фрагмент уже скачан, пропускаю скачивание")
+        else:
+            logger.info(f"Пытаюсь скачать только фрагмент: URL={url}, сегмент={start_time}-{end_time}")
+            
+            # Пытаемся скачать только нужный фрагмент (yt-dlp синхронный, поэтому в отдельном потоке)
+            await download_ranges(handle, url, ydl_opts, tier, duration)
+            handle.check()
+            
+            logger.info(f"Скачивание завершено, ищу файл: {output_path}")
+            source_path = find_download(output_path)
+            if source_path is None:
+                logger.warning(f"Файл не найден после скачивания. Искал: {output_path}")
+                logger.warning(f"Содержимое папки задачи: {list(workspace.iterdir())}")
+                return None
+            journal.advance(journal_id, STAGE_DOWNLOADED, source=str(source_path))
+        
+        file_size = source_path.stat().st_size
+        logger.info(f"Файл скачан: {source_path}, размер: {file_size / 1024 / 1024:.2f} MB")
+        
+        # Проверяем длительность и кодек через ffprobe
+        if entry and entry.reached(STAGE_PROBED) and 'probe' in entry.artifacts:
+            video_stream = entry.artifacts['probe']
+        else:
+            logger.info("Проверяю длительность и формат файла...")
+            with handle.stage('probe'):
+                video_stream = await probe_video_stream(source_path, handle) or {}
+            journal.advance(journal_id, STAGE_PROBED, probe=video_stream)
+        codec = video_stream.get('codec_name', '')
+        pix_fmt = video_stream.get('pix_fmt', '')
+        actual_duration = video_stream.get('format_duration', 0.0)
+        logger.info(f"Кодек: {codec}, Pix_fmt: {pix_fmt}, Длительность: {actual_duration:.2f}s, Ожидалось: {duration}s")
+        
+        # Профиль подбираем сразу под лимит Telegram и бюджет времени
+        profile = choose_file_profile(source_path, duration, video_stream, tier.max_height)
+        final_path = workspace / "clip.mp4"
+        
+        # Если длительность намного больше ожидаемой (или ее не удалось узнать, а файл > 100 MB),
+        # значит скачался весь файл
+        if actual_duration > duration * 2 or (not actual_duration and file_size > 100 * 1024 * 1024):
+            logger.warning(f"Скачался весь файл ({actual_duration:.2f}s vs {duration}s), обрезаю...")
+            # Умная нарезка: копируем середину, перекодируем только края
+            with handle.stage('cut'):
+                cut = await smart_cut(source_path, start_seconds, end_seconds, final_path, profile, handle)
+            if cut:
+                source_path.unlink()  # Удаляем большой файл
+                logger.info(f"Фрагмент вырезан: {final_path}")
+                journal.advance(journal_id, STAGE_CUT, clip=str(final_path))
+                return final_path
+            logger.error("Не удалось вырезать фрагмент из большого файла")
+        
+        # Если это MP4 с H.264 и совместимым pix_fmt и файл влезает в лимит, перекодирование не нужно
+        elif (source_path.suffix == '.mp4' and codec == 'h264' and pix_fmt in ['yuv420p', 'yuv420p10le']
+                and file_size <= profile.size_limit * SIZE_SAFETY
+                and int(video_stream.get('height') or 0) <= tier.max_height):
+            logger.info("Файл совместим, используем без перекодирования")
+            inc('encode_decisions_total', decision='copy')
+            journal.advance(journal_id, STAGE_ENCODED, clip=str(source_path))
+            return source_path
+        
+        else:
+            logger.info(f"Перекодирую в совместимый формат для мобильных устройств ({profile.name})...")
+            with handle.stage('encode'):
+                encoded = await full_reencode(source_path, 0, actual_duration or duration, final_path, profile, handle)
+            if encoded:
+                source_path.unlink()
+                logger.info(f"Фрагмент перекодирован: {final_path}")
+                journal.advance(journal_id, STAGE_ENCODED, clip=str(final_path))
+                return final_path
+            logger.warning("Перекодирование не удалось")
+        
+        # Если перекодировать не вышло, возвращаем исходный файл
+        logger.info("Используем исходный файл без перекодирования")
+        inc('fallbacks_total', kind='source_as_is')
+        journal.advance(journal_id, STAGE_ENCODED, clip=str(source_path))
+        return source_path
+            
+    except ProcessTimeout:
+        logger.error("Таймаут при обрезке видео")
+        return None
+    except yt_dlp.utils.DownloadCancelled:
+        raise JobCancelled(f"Задача {handle.name} отменена")
+    except yt_dlp.utils.DownloadError as e:
+        logger.error(f"Ошибка yt-dlp при скачивании: {e}", exc_info=True)
+        raise
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка при скачивании: {e}", exc_info=True)
+        raise
+
+
+def resolve_formats(url: str, tier: QualityTier, clip_seconds: float) -> list[dict] | None:
+    """Извлекает метаданные (из кеша) и возвращает прямые ссылки на потоки, выбранные под клип"""
+    with ydl_pool.checkout({**YDL_BASE_OPTS, **youtube_throttle.request_opts()}) as ydl:
+        with stage('extract'):
+            info = metadata_cache.get_or_extract(url, ydl)
+            apply_format(ydl, info, tier, clip_seconds)
+            return resolve_stream_formats(info, ydl)
+
+
+async def stream_video_segment(handle: JobHandle, url: str, start_time: str, end_time: str,
+                               quality: str | None = None) -> bytes | None:
+    """
+    Вырезает фрагмент в потоковом режиме, без записи на диск
+    Возвращает None, если потоки нельзя читать напрямую или клип не влезает в память
+    """
+    start_seconds = time_to_seconds(start_time)
+    duration = time_to_seconds(end_time) - start_seconds
+    tier = get_tier(quality)
+    
+    try:
+        handle.set_progress('extract')
+        formats = await run_ydl(url, resolve_formats, url, tier, duration)
+        if not formats:
+            return None
+        with handle.stage('stream'):
+            data = await stream_segment(formats, start_seconds, duration, handle, tier.max_height)
+        inc('encode_decisions_total', decision='stream')
+        return data
+    except (StreamTooLarge, ProcessTimeout, RuntimeError, OSError) as e:
+        logger.warning(f"Потоковый режим не сработал, переключаюсь на скачивание: {e}")
+        return None
+
+
+async def fetch_clip(handle: JobHandle, url: str, start_time: str, end_time: str,
+                     journal_id: str | None = None, quality: str | None = None,
+                     preview: bool = False) -> Path | bytes | None:
+    """
+    Получает клип: в потоковом режиме без диска, иначе (или при неудаче) через скачивание
+    preview=True - параллельно готовит превью начала клипа (появляется в handle.preview)
+    """
+    preview_task = asyncio.create_task(fetch_preview(handle, url, start_time, end_time, journal_id)) if preview else None
+    try:
+        if STREAMING_MODE:
+            data = await stream_video_segment(handle, url, start_time, end_time, quality)
+            if data:
+                return data
+            handle.check()
+            inc('fallbacks_total', kind='stream_to_download')
+        return await download_video_segment(handle, url, start_time, end_time, journal_id, quality)
+    finally:
+        if preview_task and not preview_task.done():
+            # Клип готов раньше превью - оно больше не нужно
+            preview_task.cancel()
+            await asyncio.gather(preview_task, return_exceptions=True)
+
+
+def wants_preview(clip_seconds: float, quality: str | None = None) -> bool:
+    """
+    Нужно ли превью: оно включено для этого режима задач, клип достаточно длинный,
+    а выбранное качество выше качества превью
+    """
+    return (JOB_BACKEND in PREVIEW_BACKENDS and clip_seconds >= PREVIEW_MIN_SECONDS
+            and get_tier(quality).max_height > get_tier(PREVIEW_QUALITY).max_height)
+
+
+async def fetch_preview(handle: JobHandle, url: str, start_time: str, end_time: str,
+                        journal_id: str | None = None) -> Path | None:
+    """
+    Быстрое превью начала клипа: поток низкого качества, ultrafast
+    Выполняется в процессе задачи: метаданные видео извлекаются один раз на задачу и превью
+    (общий кеш с блокировкой на видео), ядра берутся из бюджета процесса
+    Готовое превью записывается в папку задачи и передается через handle.preview
+    Возвращает None, если превью не получилось (клип в полном качестве придет все равно)
+    """
+    start_seconds = time_to_seconds(start_time)
+    duration = min(time_to_seconds(end_time) - start_seconds, PREVIEW_MAX_SECONDS)
+    tier = get_tier(PREVIEW_QUALITY)
+    try:
+        formats = await run_ydl(url, resolve_formats, url, tier, duration)
+        if not formats:
+            inc('previews_total', status='failed')
+            return None
+        with stage('preview'):
+            data = await stream_segment(formats, start_seconds, duration, handle, tier.max_height,
+                                        profile=preview_profile(tier.max_height), threads=PREVIEW_THREADS)
+    except JobCancelled:
+        return None
+    except (StreamTooLarge, ProcessTimeout, RuntimeError, OSError, yt_dlp.utils.DownloadError) as e:
+        logger.warning(f"Превью не получилось: {e}")
+        inc('previews_total', status='failed')
+        return None
+    # Путь абсолютный: в режиме очереди его читает процесс бота
+    path = (workspaces.workspace(journal_id) / "preview.mp4").resolve()
+    path.write_bytes(data)
+    handle.set_preview(path)
+    return path
+
+
+async def download_batch(handle: JobHandle, url: str, clips: list[Clip],
+                         journal_id: str | None = None, quality: str | None = None) -> list[Path | None]:
+    """
+    Скачивает куски, покрывающие все клипы пакета, одним вызовом yt-dlp и нарезает из них клипы
+    Метаданные извлекаются один раз, близкие диапазоны скачиваются одним куском
+    Возвращает пути к клипам в порядке запроса (None - клип вырезать не удалось)
+    """
+    sections = merge_ranges(clips)
+    tier = get_tier(quality)
+    batch_dir = workspaces.workspace(journal_id)
+    entry = journal.get(journal_id)
+    # Артефакты в журнале привязаны к диапазонам, а не к номерам: после перезапуска
+    # часть клипов может оказаться в кеше, и набор кусков изменится
+    done_clips = entry.artifacts.get('clips', {}) if entry else {}
+    done_sections = entry.artifacts.get('sections', {}) if entry else {}
+    
+    results = [done_clips.get(f"{clip.start}-{clip.end}") for clip in clips]
+    if entry and entry.reached(STAGE_CUT) and all(path and Path(path).exists() for path in results):
+        logger.info(f"Задача {journal_id}: клипы пакета уже готовы, продолжаю с отправки")
+        return [Path(path) for path in results]
+    
+    # При отмене удаляем папку пакета и останавливаем ffmpeg, запущенный yt-dlp
+    handle.register_path(batch_dir, marker=True)
+    
+    section_files: dict[int, Path] = {}
+    for index, section in enumerate(sections):
+        path = done_sections.get(f"{section.start}-{section.end}")
+        if path and Path(path).exists():
+            section_files[index] = Path(path)
+    missing = [index for index in range(len(sections)) if index not in section_files]
+    
+    def _ranges(info, ydl):
+        for index in missing:
+            yield {'start_time': sections[index].start, 'end_time': sections[index].end, 'index': index}
+    
+    ydl_opts = {
+        **YDL_BASE_OPTS,
+        'outtmpl': str(batch_dir / 'section_%(section_number)s.%(ext)s'),
+        'download_ranges': _ranges,
+        'continuedl': True,
+        'progress_hooks': [handle.progress_hook],
+    }
+    
+    probes: dict[Path, dict] = {}
+    
+    async def _cut_clip(source: Path, start: int, end: int, output: Path) -> bool:
+        if source not in probes:
+            with handle.stage('probe'):
+                probes[source] = await probe_video_stream(source, handle) or {}
+        profile = choose_file_profile(source, end - start, probes[source], tier.max_height)
+        try:
+            with handle.stage('cut'):
+                return await smart_cut(source, start, end, output, profile, handle)
+        except ProcessTimeout:
+            logger.error(f"Таймаут при нарезке {output.name}")
+            return False
+    
+    # Клипы куска режутся, как только он готов: пока качаются следующие куски
+    cutter = ClipCutter(clips, sections, batch_dir, _cut_clip)
+    for index, path in section_files.items():
+        cutter.add(index, path)
+    
+    def _section_ready(merge: SectionMerge):
+        section_files[merge.number] = merge.output
+        cutter.add(merge.number, merge.output)
+    
+    try:
+        if missing:
+            try:
+                logger.info(
+                    f"Пакет: {len(clips)} клипов, {len(missing)} кусков, "
+                    f"{covered_seconds([sections[index] for index in missing])}s видео: URL={url}"
+                )
+                await download_ranges(handle, url, ydl_opts, tier, covered_seconds([sections[index] for index in missing]),
+                                      on_section=_section_ready)
+                handle.check()
+            except yt_dlp.utils.DownloadCancelled:
+                raise JobCancelled(f"Задача {handle.name} отменена")
+            
+            # Находим куски, скачанные самим yt-dlp (промежуточные .part и отдельные потоки до слияния пропускаем)
+            for index in missing:
+                path = section_files.get(index) or find_download(batch_dir / f"section_{index}")
+                if path:
+                    section_files[index] = path
+                    cutter.add(index, path)
+                else:
+                    logger.warning(f"Кусок {index} не найден после скачивания")
+            journal.advance(journal_id, STAGE_DOWNLOADED, sections={
+                **done_sections,
+                **{f"{sections[index].start}-{sections[index].end}": str(path) for index, path in section_files.items()},
+            })
+        else:
+            logger.info(f"Задача {journal_id}: куски пакета уже скачаны, пропускаю скачивание")
+        
+        paths = await cutter.wait()
+    except BaseException:
+        await cutter.close()
+        raise
+    journal.advance(journal_id, STAGE_CUT, clips={
+        **done_clips,
+        **{f"{clip.start}-{clip.end}": str(path) for clip, path in zip(clips, paths) if path},
+    })
+    return paths
+
+
+# Виды задач для общей очереди (режим JOB_BACKEND=queue)
+JOB_KIND_CLIP = "clip"
+JOB_KIND_BATCH = "batch"
+
+
+def job_priority(clip_seconds: int) -> int:
+    """Короткие клипы воркеры берут раньше длинных"""
+    return 0 if clip_seconds <= SHORT_CLIP_SECONDS else 1
+
+
+async def execute_job(handle: JobHandle, kind: str, payload: dict) -> dict:
+    """
+    Выполняет задачу из общей очереди в процессе воркера
+    Результат - пути к готовым файлам (фронтенд отправляет их из общей папки downloads)
+    и записи метрик задачи, которые бот добавляет к своим
+    """
+    journal_id = payload.get('journal_id')
+    with job_trace(journal_id, collect=True) as records:
+        result = await _execute_job(handle, kind, payload, journal_id)
+    return {**result, 'metrics': records}
+
+
+async def _execute_job(handle: JobHandle, kind: str, payload: dict, journal_id: str | None) -> dict:
+    if kind == JOB_KIND_CLIP:
+        clip = await fetch_clip(handle, payload['url'], payload['start_time'], payload['end_time'], journal_id,
+                                payload.get('quality'), payload.get('preview', False))
+        if isinstance(clip, bytes):
+            # Фронтенд в другом процессе - клип из потокового режима передаем через файл
+            fd, name = tempfile.mkstemp(prefix='stream_', suffix='.mp4', dir=workspaces.workspace(journal_id))
+            with open(fd, 'wb') as output:
+                output.write(clip)
+            clip = Path(name)
+        return {'path': str(clip.resolve()) if clip else None}
+    if kind == JOB_KIND_BATCH:
+        clips = [Clip(item['start_time'], item['end_time']) for item in payload['clips']]
+        paths = await download_batch(handle, payload['url'], clips, journal_id, payload.get('quality'))
+        return {'paths': [str(path.resolve()) if path else None for path in paths]}
+    raise ValueError(f"Неизвестный вид задачи: {kind}")
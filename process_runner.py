@@ -0,0 +1,219 @@
+import os
+import signal
+import asyncio
+import logging
+import shutil
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+import yt_dlp
+
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    """Задача отменена пользователем или при остановке бота"""
+
+
+class ProcessTimeout(Exception):
+    """Внешний процесс не уложился в таймаут и был остановлен"""
+
+
+@dataclass
+class ProcessResult:
+    returncode: int
+    stdout: str
+    stderr: str
+
+
+def kill_process_tree(pid: int):
+    """Убивает группу процессов (ffmpeg запускается в отдельной сессии)"""
+    try:
+        os.killpg(os.getpgid(pid), signal.SIGKILL)
+    except (ProcessLookupError, PermissionError, OSError):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except (ProcessLookupError, OSError):
+            pass
+
+
+def kill_child_processes(marker: str) -> int:
+    """
+    Убивает дочерние процессы бота, в командной строке которых есть marker.
+    Так останавливается ffmpeg, который yt-dlp запускает сам через Popen.
+    Работает только на Linux (через /proc), на других системах ничего не делает.
+    """
+    proc_dir = Path('/proc')
+    if not proc_dir.exists() or not marker:
+        return 0
+    own_pid = os.getpid()
+    killed = 0
+    for entry in proc_dir.iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / 'stat').read_text()
+            # Поле ppid идет после имени процесса в скобках
+            ppid = int(stat.rsplit(')', 1)[1].split()[1])
+            if ppid != own_pid:
+                continue
+            cmdline = (entry / 'cmdline').read_bytes().replace(b'\0', b' ').decode('utf-8', errors='replace')
+        except (OSError, IndexError, ValueError):
+            continue
+        if marker in cmdline:
+            kill_process_tree(int(entry.name))
+            killed += 1
+    return killed
+
+
+class JobHandle:
+    """
+    Ручка задачи: позволяет отменить ее в любой момент.
+    Отмена убивает запущенные ffmpeg/ffprobe, прерывает скачивание yt-dlp через progress hook
+    и удаляет промежуточные файлы задачи.
+    Через ручку же видно, на каком этапе задача: бот показывает это в статусном сообщении.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.cancelled = False
+        # Текущий этап и прогресс: {'stage': ..., 'percent': ..., 'speed': ...}; None - задача не начата
+        self.progress: dict | None = None
+        # Готовое превью клипа (файл в папке задачи), которое бот отправляет до полного качества
+        self.preview: Path | None = None
+        self._processes: set[asyncio.subprocess.Process] = set()
+        self._paths: set[Path] = set()
+        self._markers: set[str] = set()
+
+    def check(self):
+        """Бросает JobCancelled, если задача отменена"""
+        if self.cancelled:
+            raise JobCancelled(f"Задача {self.name} отменена")
+
+    def register_path(self, path: Path, marker: bool = False):
+        """
+        Запоминает файл или префикс файлов задачи для удаления при отмене
+        marker=True - путь также используется для поиска процессов, запущенных yt-dlp
+        """
+        self._paths.add(path)
+        if marker:
+            self._markers.add(str(path))
+
+    def set_progress(self, stage: str, percent: float | None = None, speed: float | None = None):
+        """Запоминает этап задачи (percent - 0..100, speed - байт/с; None - неизвестно)"""
+        self.progress = {'stage': stage, 'percent': percent, 'speed': speed}
+
+    def set_preview(self, path: Path):
+        self.preview = path
+
+    def snapshot(self) -> dict:
+        """Этап, прогресс и превью задачи - то, что воркер передает фронтенду через очередь"""
+        return {**(self.progress or {}), 'preview': str(self.preview) if self.preview else None}
+
+    def restore(self, snapshot: dict):
+        """Принимает состояние задачи, переданное воркером"""
+        if snapshot.get('stage'):
+            self.set_progress(snapshot['stage'], snapshot.get('percent'), snapshot.get('speed'))
+        if snapshot.get('preview'):
+            self.set_preview(Path(snapshot['preview']))
+
+    @contextmanager
+    def stage(self, name: str):
+        """Этап задачи: отмечается в прогрессе и замеряется в метриках"""
+        self.set_progress(name)
+        with stage(name):
+            yield
+
+    def progress_hook(self, status: dict):
+        """Хук для yt-dlp: прерывает скачивание после отмены и запоминает прогресс скачивания"""
+        if self.cancelled:
+            raise yt_dlp.utils.DownloadCancelled(f"Задача {self.name} отменена")
+        if status.get('status') != 'downloading':
+            return
+        done = status.get('downloaded_bytes')
+        total = status.get('total_bytes') or status.get('total_bytes_estimate')
+        percent = None
+        if done is not None and total:
+            percent = min(100.0, done * 100 / total)
+        elif status.get('fragment_count'):
+            percent = min(100.0, (status.get('fragment_index') or 0) * 100 / status['fragment_count'])
+        self.set_progress('download', percent, status.get('speed'))
+
+    def attach(self, process: asyncio.subprocess.Process):
+        self._processes.add(process)
+        if self.cancelled:
+            kill_process_tree(process.pid)
+
+    def detach(self, process: asyncio.subprocess.Process):
+        self._processes.discard(process)
+
+    def cancel(self, cleanup: bool = True):
+        """
+        Отменяет задачу: убивает процессы и удаляет файлы
+        cleanup=False - файлы остаются, чтобы задачу можно было продолжить после перезапуска
+        """
+        if self.cancelled:
+            return
+        self.cancelled = True
+        for process in list(self._processes):
+            kill_process_tree(process.pid)
+        for marker in self._markers:
+            kill_child_processes(marker)
+        logger.info(f"Задача {self.name} отменена, процессы остановлены")
+        if cleanup:
+            self.cleanup()
+
+    def cleanup(self):
+        """Удаляет все файлы задачи (включая .part и промежуточные)"""
+        for path in self._paths:
+            candidates = [path] if path.exists() else list(path.parent.glob(f"{path.name}*"))
+            for candidate in candidates:
+                try:
+                    if candidate.is_dir():
+                        shutil.rmtree(candidate, ignore_errors=True)
+                    else:
+                        candidate.unlink(missing_ok=True)
+                except OSError as e:
+                    logger.warning(f"Не удалось удалить {candidate}: {e}")
+
+
+async def run_process(cmd: list[str], handle: JobHandle | None = None,
+                      timeout: float | None = None) -> ProcessResult:
+    """
+    Запускает внешний процесс асинхронно в отдельной группе процессов.
+    При таймауте, отмене корутины или задачи убивает все дерево процессов.
+    """
+    if handle:
+        handle.check()
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
+    )
+    if handle:
+        handle.attach(process)
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        kill_process_tree(process.pid)
+        await process.wait()
+        raise ProcessTimeout(f"{cmd[0]} не завершился за {timeout}s")
+    except asyncio.CancelledError:
+        kill_process_tree(process.pid)
+        await process.wait()
+        raise
+    finally:
+        if handle:
+            handle.detach(process)
+
+    if handle:
+        handle.check()
+    return ProcessResult(
+        process.returncode,
+        stdout.decode('utf-8', errors='replace'),
+        stderr.decode('utf-8', errors='replace'),
+    )
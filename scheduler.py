@@ -0,0 +1,299 @@
+import os
+import asyncio
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import count
+from typing import Any, Callable
+
+from metrics import observe
+
+logger = logging.getLogger(__name__)
+
+# Настройки планировщика (можно переопределить через переменные окружения)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "20"))
+JOB_PER_USER_RUNNING = int(os.getenv("JOB_PER_USER_RUNNING", "1"))
+JOB_PER_USER_PENDING = int(os.getenv("JOB_PER_USER_PENDING", "3"))
+SHORT_CLIP_SECONDS = int(os.getenv("SHORT_CLIP_SECONDS", "60"))
+# Каждая N-я выборка отдается длинной очереди, чтобы она не голодала
+LONG_LANE_EVERY = int(os.getenv("LONG_LANE_EVERY", "3"))
+
+LANE_SHORT = "short"
+LANE_LONG = "long"
+
+# Начальная оценка времени обработки (секунды на секунду клипа) до накопления статистики
+DEFAULT_SECONDS_PER_CLIP_SECOND = 2.0
+
+
+class SchedulerError(Exception):
+    """Базовая ошибка планировщика задач"""
+
+
+class QueueFullError(SchedulerError):
+    """Очередь переполнена - новая задача отклонена"""
+
+
+class UserLimitError(SchedulerError):
+    """У пользователя слишком много задач в очереди"""
+
+
+@dataclass(eq=False)
+class Job:
+    """Задача на обработку одного фрагмента"""
+    job_id: int
+    user_id: int
+    lane: str
+    clip_seconds: int
+    func: Callable[..., Any]
+    args: tuple
+    future: asyncio.Future
+    submitted_at: float = field(default_factory=time.monotonic)
+    started_at: float | None = None
+    task: asyncio.Future | None = None
+
+    @property
+    def started(self) -> bool:
+        return self.started_at is not None
+
+
+class JobScheduler:
+    """
+    Планировщик задач скачивания и обработки видео.
+    Ограничивает число одновременных задач пулом воркеров, держит ограниченную очередь
+    с двумя приоритетами (короткие и длинные клипы) и лимитами на пользователя.
+    """
+
+    def __init__(
+        self,
+        workers: int = JOB_WORKERS,
+        max_queue: int = JOB_QUEUE_SIZE,
+        per_user_running: int = JOB_PER_USER_RUNNING,
+        per_user_pending: int = JOB_PER_USER_PENDING,
+        short_clip_seconds: int = SHORT_CLIP_SECONDS,
+        long_lane_every: int = LONG_LANE_EVERY,
+    ):
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.per_user_running = per_user_running
+        self.per_user_pending = per_user_pending
+        self.short_clip_seconds = short_clip_seconds
+        self.long_lane_every = max(1, long_lane_every)
+
+        self._lanes: dict[str, deque[Job]] = {LANE_SHORT: deque(), LANE_LONG: deque()}
+        self._running: dict[int, Job] = {}
+        self._user_running: dict[int, int] = {}
+        self._user_pending: dict[int, int] = {}
+        self._ids = count(1)
+        self._picks = 0
+        self._cond = asyncio.Condition()
+        self._tasks: list[asyncio.Task] = []
+        self._executor: ThreadPoolExecutor | None = None
+        # Скользящее среднее: секунды обработки на секунду клипа, отдельно по очередям
+        self._rate: dict[str, float] = {
+            LANE_SHORT: DEFAULT_SECONDS_PER_CLIP_SECOND,
+            LANE_LONG: DEFAULT_SECONDS_PER_CLIP_SECOND,
+        }
+
+    async def start(self):
+        """Запускает воркеры"""
+        if self._tasks:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job-worker")
+        self._tasks = [
+            asyncio.create_task(self._worker(i), name=f"job-worker-{i}")
+            for i in range(self.workers)
+        ]
+        logger.info(
+            f"Планировщик запущен: воркеров={self.workers}, очередь={self.max_queue}, "
+            f"на пользователя={self.per_user_running}/{self.per_user_pending}"
+        )
+
+    async def stop(self):
+        """Останавливает воркеры и отменяет задачи в очереди"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for lane in self._lanes.values():
+            while lane:
+                job = lane.popleft()
+                if not job.future.done():
+                    job.future.cancel()
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        logger.info("Планировщик остановлен")
+
+    @property
+    def queued(self) -> int:
+        return sum(len(lane) for lane in self._lanes.values())
+
+    @property
+    def running(self) -> int:
+        return len(self._running)
+
+    def submit(self, user_id: int, clip_seconds: int, func: Callable[..., Any], *args) -> Job:
+        """
+        Ставит задачу в очередь.
+        Бросает QueueFullError или UserLimitError, если задачу принять нельзя.
+        """
+        if self.queued >= self.max_queue:
+            raise QueueFullError(f"Очередь заполнена ({self.max_queue} задач)")
+        if self._user_pending.get(user_id, 0) >= self.per_user_pending:
+            raise UserLimitError(f"Не больше {self.per_user_pending} задач на пользователя")
+
+        lane = LANE_SHORT if clip_seconds <= self.short_clip_seconds else LANE_LONG
+        job = Job(
+            job_id=next(self._ids),
+            user_id=user_id,
+            lane=lane,
+            clip_seconds=clip_seconds,
+            func=func,
+            args=args,
+            future=asyncio.get_running_loop().create_future(),
+        )
+        self._lanes[lane].append(job)
+        self._user_pending[user_id] = self._user_pending.get(user_id, 0) + 1
+        logger.info(f"Задача #{job.job_id} в очереди {lane}: пользователь={user_id}, клип={clip_seconds}s")
+        self._notify()
+        return job
+
+    def cancel(self, job: Job) -> bool:
+        """
+        Отменяет задачу: из очереди просто убирает, у выполняющейся отменяет корутину
+        Возвращает False, если задача уже завершена
+        """
+        if job.future.done():
+            return False
+        if job.task is not None:
+            job.task.cancel()
+            return True
+        lane = self._lanes[job.lane]
+        if job in lane:
+            lane.remove(job)
+            self._user_pending[job.user_id] = self._user_pending.get(job.user_id, 1) - 1
+            if self._user_pending[job.user_id] <= 0:
+                del self._user_pending[job.user_id]
+        job.future.cancel()
+        logger.info(f"Задача #{job.job_id} убрана из очереди")
+        self._notify()
+        return True
+
+    def position(self, job: Job) -> int:
+        """Позиция задачи в очереди (1 - следующая), 0 - если задача уже выполняется"""
+        if job.started or job.future.done():
+            return 0
+        lane = self._lanes[job.lane]
+        try:
+            index = lane.index(job)
+        except ValueError:
+            return 0
+        ahead = index
+        if job.lane == LANE_LONG:
+            ahead += len(self._lanes[LANE_SHORT])
+        return ahead + 1
+
+    def eta(self, job: Job) -> float:
+        """Примерное время до завершения задачи в секундах"""
+        own = self._rate[job.lane] * job.clip_seconds
+        position = self.position(job)
+        if position == 0:
+            elapsed = time.monotonic() - job.started_at if job.started_at else 0.0
+            return max(own - elapsed, 0.0)
+        ahead = 0.0
+        for lane_name in (LANE_SHORT, LANE_LONG):
+            for other in self._lanes[lane_name]:
+                if other is job:
+                    break
+                ahead += self._rate[other.lane] * other.clip_seconds
+            if lane_name == job.lane:
+                break
+        for other in self._running.values():
+            elapsed = time.monotonic() - (other.started_at or time.monotonic())
+            ahead += max(self._rate[other.lane] * other.clip_seconds - elapsed, 0.0)
+        return ahead / self.workers + own
+
+    def _notify(self):
+        async def _wake():
+            async with self._cond:
+                self._cond.notify_all()
+        asyncio.get_running_loop().create_task(_wake())
+
+    def _pop_next(self) -> Job | None:
+        """Выбирает следующую задачу с учетом приоритетов и лимитов пользователей"""
+        self._picks += 1
+        if self._picks % self.long_lane_every == 0:
+            order = (LANE_LONG, LANE_SHORT)
+        else:
+            order = (LANE_SHORT, LANE_LONG)
+        for lane_name in order:
+            lane = self._lanes[lane_name]
+            for job in lane:
+                if self._user_running.get(job.user_id, 0) < self.per_user_running:
+                    lane.remove(job)
+                    return job
+        self._picks -= 1
+        return None
+
+    async def _worker(self, index: int):
+        loop = asyncio.get_running_loop()
+        while True:
+            async with self._cond:
+                while (job := self._pop_next()) is None:
+                    await self._cond.wait()
+                job.started_at = time.monotonic()
+                self._running[job.job_id] = job
+                self._user_running[job.user_id] = self._user_running.get(job.user_id, 0) + 1
+
+            waited = job.started_at - job.submitted_at
+            observe('queue_wait_seconds', waited, lane=job.lane)
+            logger.info(f"Воркер {index}: начинаю задачу #{job.job_id} (ожидание {waited:.1f}s)")
+            # Задача выполняется отдельно от воркера, чтобы ее можно было отменить, не останавливая воркер
+            if asyncio.iscoroutinefunction(job.func):
+                job.task = asyncio.create_task(job.func(*job.args), name=f"job-{job.job_id}")
+            else:
+                job.task = loop.run_in_executor(self._executor, job.func, *job.args)
+            try:
+                await asyncio.wait({job.task})
+            except asyncio.CancelledError:
+                # Остановлен сам воркер - отменяем и задачу
+                job.task.cancel()
+                if not job.future.done():
+                    job.future.cancel()
+                self._finish(job)
+                raise
+
+            if not job.future.done():
+                if job.task.cancelled():
+                    job.future.cancel()
+                elif job.task.exception() is not None:
+                    job.future.set_exception(job.task.exception())
+                else:
+                    job.future.set_result(job.task.result())
+            self._finish(job)
+
+    def _finish(self, job: Job):
+        elapsed = time.monotonic() - (job.started_at or time.monotonic())
+        # Отмененные и упавшие задачи не учитываем в оценке скорости
+        succeeded = job.future.done() and not job.future.cancelled() and job.future.exception() is None
+        if succeeded and job.clip_seconds > 0:
+            rate = elapsed / job.clip_seconds
+            self._rate[job.lane] = 0.7 * self._rate[job.lane] + 0.3 * rate
+        self._running.pop(job.job_id, None)
+        for counter in (self._user_running, self._user_pending):
+            counter[job.user_id] = counter.get(job.user_id, 1) - 1
+            if counter[job.user_id] <= 0:
+                del counter[job.user_id]
+        logger.info(f"Задача #{job.job_id} завершена за {elapsed:.1f}s")
+        self._notify()
+
+
+def format_eta(seconds: float) -> str:
+    """Форматирует оценку времени для пользователя"""
+    if seconds < 60:
+        return "меньше минуты"
+    minutes = round(seconds / 60)
+    return f"~{minutes} мин"
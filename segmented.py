@@ -0,0 +1,538 @@
+import os
+import time
+import struct
+import asyncio
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+
+import yt_dlp
+from yt_dlp.networking import Request
+from yt_dlp.networking.exceptions import HTTPError, RequestError
+
+from encoding_profiles import MB
+from format_selector import codec_family
+from throttle import TokenBucket, backoff_delay
+from metrics import inc
+from process_runner import JobHandle, ProcessTimeout, run_process
+
+logger = logging.getLogger(__name__)
+
+# Скачивать фрагменты диапазонов (download_ranges) параллельно; иначе диапазон читает ffmpeg из yt-dlp
+SEGMENTED_DOWNLOAD = os.getenv("SEGMENTED_DOWNLOAD", "1").lower() in ("1", "true", "yes")
+# Сколько фрагментов одной задачи качается одновременно
+FRAGMENT_CONCURRENCY = int(os.getenv("FRAGMENT_CONCURRENCY", "4"))
+# Повторы одного фрагмента после обрыва или ошибки сервера
+FRAGMENT_RETRIES = int(os.getenv("FRAGMENT_RETRIES", "5"))
+# Ограничение скорости (Мбит/с, 0 - без ограничения): на задачу и на всю машину
+JOB_BANDWIDTH_MBPS = float(os.getenv("JOB_BANDWIDTH_MBPS", "0"))
+BANDWIDTH_MBPS = float(os.getenv("BANDWIDTH_MBPS", "0"))
+
+# Длинные диапазоны байт (DASH по sidx) делятся на куски такого размера
+FRAGMENT_CHUNK_BYTES = 2 * MB
+# Сколько байт начала файла читать в поисках индекса sidx
+HEAD_BYTES = 256 * 1024
+READ_CHUNK = 64 * 1024
+FRAGMENT_TIMEOUT = 30
+MERGE_TIMEOUT = 300
+# Сколько фрагментов может ждать записи впереди первого недокачанного (на дорожку)
+REORDER_WINDOW = 4
+
+# Кодеки, которые ffmpeg кладет в MP4 без перекодирования; с остальными итог - MKV
+MP4_CODECS = {'avc1', 'h264', 'hev1', 'hvc1', 'av01', 'mp4a', 'aac', 'none'}
+
+
+class SegmentedUnsupported(Exception):
+    """Диапазон нельзя скачать по фрагментам - качает yt-dlp"""
+
+
+class FragmentError(Exception):
+    """Фрагмент пришел не полностью - повторяем"""
+
+
+def bytes_per_second(mbps: float) -> float:
+    return mbps * 1_000_000 / 8
+
+
+class BandwidthLimiter:
+    """Ограничение скорости поверх корзины токенов (токен - байт); общее для потоков"""
+
+    def __init__(self, mbps: float = 0):
+        self._lock = threading.Lock()
+        self.configure(mbps)
+
+    def configure(self, mbps: float):
+        """Задает скорость (процессы worker.py делят общую скорость между собой); 0 - без ограничения"""
+        rate = bytes_per_second(mbps)
+        self.bucket = TokenBucket(rate, int(rate)) if rate > 0 else None
+
+    def consume(self, size: int):
+        if self.bucket is None:
+            return
+        with self._lock:
+            wait_seconds = self.bucket.reserve(size)
+        if wait_seconds:
+            time.sleep(wait_seconds)
+
+
+# Ограничение скорости процесса (у бота и у каждого процесса worker.py свое)
+global_bandwidth = BandwidthLimiter(BANDWIDTH_MBPS)
+
+
+@dataclass
+class Piece:
+    """Кусок дорожки: фрагмент HLS/DASH или диапазон байт; data - уже прочитанные байты"""
+    url: str
+    headers: dict
+    byte_range: tuple[int, int] | None = None
+    data: bytes | None = None
+
+    @property
+    def size(self) -> int | None:
+        if self.data is not None:
+            return len(self.data)
+        return self.byte_range[1] - self.byte_range[0] + 1 if self.byte_range else None
+
+
+@dataclass
+class TrackPlan:
+    """Куски одной дорожки (формата), покрывающие диапазон; start_time - время начала первого куска"""
+    fmt: dict
+    pieces: list[Piece]
+    start_time: float
+
+
+def select_pieces(timeline: list[tuple[Piece, float | None]], start: float, end: float) -> tuple[list[Piece], float]:
+    """
+    Выбирает куски, пересекающие [start, end); куски без длительности (инициализация) берутся всегда
+    Возвращает куски и время начала первого медиакуска
+    """
+    pieces, position, first = [], 0.0, None
+    for piece, duration in timeline:
+        if duration is None:
+            pieces.append(piece)
+            continue
+        if position + duration > start and position < end:
+            if first is None:
+                first = position
+            pieces.append(piece)
+        position += duration
+        if position >= end:
+            break
+    if first is None:
+        raise SegmentedUnsupported(f"диапазон {start}-{end} за пределами потока ({position:.0f}s)")
+    return pieces, first
+
+
+def plan_dash(fmt: dict, start: float, end: float) -> TrackPlan:
+    """DASH со списком фрагментов (fragments от yt-dlp)"""
+    fragments = fmt.get('fragments')
+    if not isinstance(fragments, list):
+        # Генератор фрагментов (трансляции с начала) - только через yt-dlp
+        raise SegmentedUnsupported("фрагменты не заданы списком")
+    base = fmt.get('fragment_base_url')
+    headers = fmt.get('http_headers') or {}
+    timeline = []
+    for fragment in fragments:
+        url = fragment.get('url') or yt_dlp.utils.urljoin(base, fragment.get('path'))
+        if not url:
+            raise SegmentedUnsupported("у фрагмента нет адреса")
+        timeline.append((Piece(url, headers), fragment.get('duration')))
+    pieces, first = select_pieces(timeline, start, end)
+    return TrackPlan(fmt, pieces, first)
+
+
+def plan_hls(ydl, fmt: dict, start: float, end: float) -> TrackPlan:
+    """HLS: разбирает плейлист и выбирает сегменты диапазона"""
+    headers = fmt.get('http_headers') or {}
+    playlist_url = fmt['url']
+    with ydl.urlopen(Request(playlist_url, headers=headers, extensions={'timeout': FRAGMENT_TIMEOUT})) as response:
+        playlist = response.read().decode('utf-8', errors='replace')
+    if '#EXT-X-STREAM-INF' in playlist:
+        raise SegmentedUnsupported("мастер-плейлист вместо плейлиста сегментов")
+    if '#EXT-X-BYTERANGE' in playlist:
+        raise SegmentedUnsupported("сегменты заданы диапазонами байт")
+    timeline = []
+    duration = None
+    for line in playlist.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-KEY') and 'METHOD=NONE' not in line:
+            raise SegmentedUnsupported("сегменты зашифрованы")
+        if line.startswith('#EXT-X-MAP'):
+            uri = line.split('URI="', 1)[1].split('"', 1)[0] if 'URI="' in line else None
+            if not uri:
+                raise SegmentedUnsupported("не удалось разобрать #EXT-X-MAP")
+            timeline.append((Piece(yt_dlp.utils.urljoin(playlist_url, uri), headers), None))
+        elif line.startswith('#EXTINF:'):
+            duration = float(line[len('#EXTINF:'):].split(',')[0] or 0)
+        elif line and not line.startswith('#'):
+            timeline.append((Piece(yt_dlp.utils.urljoin(playlist_url, line), headers), duration or 0.0))
+            duration = None
+    pieces, first = select_pieces(timeline, start, end)
+    return TrackPlan(fmt, pieces, first)
+
+
+def iter_boxes(data: bytes, offset: int = 0):
+    """Боксы MP4 верхнего уровня: (тип, начало, конец); конец может быть за пределами data"""
+    while offset + 8 <= len(data):
+        size, box_type = struct.unpack('>I4s', data[offset:offset + 8])
+        if size == 1:
+            if offset + 16 > len(data):
+                return
+            size = struct.unpack('>Q', data[offset + 8:offset + 16])[0]
+        if size < 8:
+            return
+        yield box_type.decode('latin-1'), offset, offset + size
+        offset += size
+
+
+def parse_sidx(box: bytes) -> tuple[float, int, list[tuple[int, float]]]:
+    """
+    Индекс сегментов sidx: время начала (с), смещение первого сегмента от конца бокса
+    и сегменты (размер в байтах, длительность в секундах)
+    """
+    version = box[8]
+    timescale = struct.unpack('>I', box[16:20])[0]
+    if version == 0:
+        earliest, first_offset = struct.unpack('>II', box[20:28])
+        position = 28
+    else:
+        earliest, first_offset = struct.unpack('>QQ', box[20:36])
+        position = 36
+    count = struct.unpack('>H', box[position + 2:position + 4])[0]
+    position += 4
+    references = []
+    for _ in range(count):
+        reference, duration = struct.unpack('>II', box[position:position + 8])
+        if reference >> 31:
+            raise SegmentedUnsupported("иерархический индекс sidx")
+        references.append((reference & 0x7FFFFFFF, duration / timescale))
+        position += 12
+    return earliest / timescale, first_offset, references
+
+
+def fetch_range(ydl, url: str, headers: dict, first: int, last: int) -> bytes:
+    with ydl.urlopen(Request(url, headers={**headers, 'Range': f"bytes={first}-{last}"},
+                             extensions={'timeout': FRAGMENT_TIMEOUT})) as response:
+        return response.read()
+
+
+def plan_sidx(ydl, fmt: dict, start: float, end: float) -> TrackPlan:
+    """
+    Фрагментированный MP4 по одной ссылке (DASH YouTube): по индексу sidx находим байты диапазона
+    Итог - инициализация (ftyp + moov) и фрагменты moof + mdat, вместе это корректный fMP4
+    """
+    if fmt.get('ext') not in ('mp4', 'm4a'):
+        raise SegmentedUnsupported(f"контейнер {fmt.get('ext')} без индекса sidx")
+    url, headers = fmt['url'], fmt.get('http_headers') or {}
+    head = fetch_range(ydl, url, headers, 0, HEAD_BYTES - 1)
+    for box_type, box_start, box_end in iter_boxes(head):
+        if box_type in ('moof', 'mdat'):
+            break
+        if box_type != 'sidx':
+            continue
+        if box_end > len(head):
+            head += fetch_range(ydl, url, headers, len(head), box_end - 1)
+        media_time, first_offset, references = parse_sidx(head[box_start:box_end])
+        init = Piece(url, headers, data=head[:box_start])
+        position = box_end + first_offset
+        first_byte = last_byte = first_time = None
+        for size, duration in references:
+            if media_time + duration > start and media_time < end:
+                if first_byte is None:
+                    first_byte, first_time = position, media_time
+                last_byte = position + size - 1
+            position += size
+            media_time += duration
+            if media_time >= end:
+                break
+        if first_byte is None:
+            raise SegmentedUnsupported(f"диапазон {start}-{end} за пределами индекса ({media_time:.0f}s)")
+        pieces = [init] + [
+            Piece(url, headers, (offset, min(offset + FRAGMENT_CHUNK_BYTES, last_byte + 1) - 1))
+            for offset in range(first_byte, last_byte + 1, FRAGMENT_CHUNK_BYTES)
+        ]
+        return TrackPlan(fmt, pieces, first_time)
+    raise SegmentedUnsupported("в начале файла нет индекса sidx")
+
+
+def plan_track(ydl, fmt: dict, start: float, end: float) -> TrackPlan:
+    protocol = fmt.get('protocol')
+    if protocol == 'http_dash_segments':
+        return plan_dash(fmt, start, end)
+    if protocol in ('m3u8', 'm3u8_native'):
+        return plan_hls(ydl, fmt, start, end)
+    if protocol in ('http', 'https'):
+        return plan_sidx(ydl, fmt, start, end)
+    raise SegmentedUnsupported(f"протокол {protocol}")
+
+
+class OrderedWriter:
+    """Дописывает куски дорожки в файл по порядку, как только приходит очередной"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.next_index = 0
+        self.pending: dict[int, bytes] = {}
+
+    def write(self, index: int, data: bytes):
+        self.pending[index] = data
+        while self.next_index in self.pending:
+            self.file.write(self.pending.pop(self.next_index))
+            self.next_index += 1
+
+    def close(self):
+        self.file.close()
+
+
+class SectionDownload:
+    """Параллельное скачивание кусков всех дорожек одного диапазона с ограничением скорости и повторами"""
+
+    def __init__(self, ydl, tracks: list[TrackPlan], filename: Path, hooks: list, info: dict):
+        self.ydl = ydl
+        self.tracks = tracks
+        self.filename = filename
+        self.hooks = hooks
+        self.info = info
+        # Файлы дорожек известны заранее: вызывающий удаляет их, даже если скачивание оборвалось
+        self.parts = [filename.with_name(f"{filename.name}.f{track.fmt.get('format_id')}.part") for track in tracks]
+        self.limiters = [BandwidthLimiter(JOB_BANDWIDTH_MBPS), global_bandwidth]
+        self.stop = threading.Event()
+        self.downloaded = 0
+        self.started = time.monotonic()
+
+    def _read(self, piece: Piece) -> bytes:
+        headers = dict(piece.headers)
+        if piece.byte_range:
+            headers['Range'] = f"bytes={piece.byte_range[0]}-{piece.byte_range[1]}"
+        chunks = []
+        with self.ydl.urlopen(Request(piece.url, headers=headers, extensions={'timeout': FRAGMENT_TIMEOUT})) as response:
+            while True:
+                if self.stop.is_set():
+                    raise FragmentError("скачивание остановлено")
+                chunk = response.read(READ_CHUNK)
+                if not chunk:
+                    break
+                for limiter in self.limiters:
+                    limiter.consume(len(chunk))
+                chunks.append(chunk)
+        data = b''.join(chunks)
+        if piece.size is not None and len(data) != piece.size:
+            raise FragmentError(f"получено {len(data)} из {piece.size} байт")
+        return data
+
+    def _fetch(self, piece: Piece) -> bytes:
+        """Скачивает кусок с повторами; 403 означает протухшую ссылку и уходит в yt-dlp как ошибка скачивания"""
+        if piece.data is not None:
+            return piece.data
+        for attempt in range(FRAGMENT_RETRIES + 1):
+            try:
+                return self._read(piece)
+            except HTTPError as e:
+                if e.status == 403:
+                    raise yt_dlp.utils.DownloadError(f"HTTP Error 403: Forbidden (фрагмент {piece.url[:80]})")
+                if e.status < 500 and e.status not in (408, 429):
+                    raise SegmentedUnsupported(f"HTTP {e.status} на фрагменте")
+                error = e
+            except (RequestError, FragmentError, OSError) as e:
+                error = e
+            if self.stop.is_set() or attempt == FRAGMENT_RETRIES:
+                break
+            delay = backoff_delay(attempt, base=1, cap=30)
+            logger.warning(f"Фрагмент не скачан ({error}), повтор {attempt + 1}/{FRAGMENT_RETRIES} через {delay:.1f}s")
+            time.sleep(delay)
+        raise SegmentedUnsupported(f"фрагмент не скачан после {FRAGMENT_RETRIES} повторов: {error}")
+
+    def _report(self, status: str, done: int, total: int):
+        """Прогресс в формате хуков yt-dlp; хук задачи бросает DownloadCancelled после отмены"""
+        elapsed = time.monotonic() - self.started
+        sizes = [piece.size for track in self.tracks for piece in track.pieces]
+        estimate = sum(sizes) if None not in sizes else (self.downloaded / done * total if done else None)
+        progress = {
+            'status': status, 'filename': str(self.filename), 'info_dict': self.info,
+            'downloaded_bytes': self.downloaded, 'total_bytes_estimate': estimate,
+            'fragment_index': done, 'fragment_count': total,
+            'elapsed': elapsed, 'speed': self.downloaded / elapsed if elapsed else None,
+        }
+        for hook in self.hooks:
+            hook(progress)
+
+    def run(self) -> list[Path]:
+        """Скачивает все куски; возвращает файлы дорожек в порядке tracks"""
+        parts = self.parts
+        writers = [OrderedWriter(path) for path in parts]
+        # Дорожки перемежаются по времени, чтобы аудио не ждало конца видео
+        queue = sorted(
+            ((index / len(track.pieces), number, index)
+             for number, track in enumerate(self.tracks) for index in range(len(track.pieces))),
+        )
+        total, done = len(queue), 0
+        window = FRAGMENT_CONCURRENCY + REORDER_WINDOW * len(self.tracks)
+        running = {}
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, FRAGMENT_CONCURRENCY), thread_name_prefix='fragment') as pool:
+                try:
+                    while queue or running:
+                        # Не убегаем далеко вперед первого недокачанного куска: буфер записи ограничен
+                        while queue and len(running) + sum(len(w.pending) for w in writers) < window:
+                            _, number, index = queue.pop(0)
+                            future = pool.submit(self._fetch, self.tracks[number].pieces[index])
+                            running[future] = (number, index)
+                        finished, _ = wait(running, timeout=1, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            number, index = running.pop(future)
+                            data = future.result()
+                            writers[number].write(index, data)
+                            self.downloaded += len(data)
+                            done += 1
+                        self._report('downloading', done, total)
+                finally:
+                    self.stop.set()
+        finally:
+            for writer in writers:
+                writer.close()
+        self._report('finished', done, total)
+        return parts
+
+
+@dataclass
+class SectionMerge:
+    """Скачанные дорожки диапазона, которые осталось склеить (склейка идет в event loop через run_process)"""
+    tracks: list[TrackPlan]
+    parts: list[Path]
+    start: float
+    end: float
+    output: Path
+    # Номер диапазона из download_ranges (section_number в outtmpl)
+    number: int | None = None
+
+    def command(self) -> list[str]:
+        """Склейка дорожек без перекодирования с обрезкой лишнего по краям фрагментов"""
+        cmd = ['ffmpeg', '-v', 'error']
+        for track, part in zip(self.tracks, self.parts):
+            cmd += ['-ss', f"{max(0.0, self.start - track.start_time):.3f}", '-i', str(part)]
+        for index in range(len(self.parts)):
+            cmd += ['-map', str(index)]
+        cmd += ['-t', f"{self.end - self.start:.3f}", '-c', 'copy']
+        if self.output.suffix == '.mp4':
+            cmd += ['-movflags', '+faststart']
+        return cmd + ['-y', str(self.output)]
+
+    def discard(self):
+        for part in self.parts:
+            part.unlink(missing_ok=True)
+
+
+class SectionHandoff:
+    """
+    Передает скачанные диапазоны из потока yt-dlp в event loop: диапазон склеивается (и нарезается),
+    пока качаются следующие
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue: asyncio.Queue[SectionMerge | None] = asyncio.Queue()
+        # Выходные файлы переданных диапазонов: при повторе скачивания (403) их не качаем заново
+        self.claimed: set[Path] = set()
+        # Часть диапазонов не скачана по фрагментам - их докачает yt-dlp после склейки переданных
+        self.incomplete = False
+
+    def submit(self, merge: SectionMerge):
+        """Вызывается из потока yt-dlp"""
+        self.claimed.add(merge.output)
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, merge)
+
+    def close(self):
+        """Поток yt-dlp закончил: больше диапазонов не будет"""
+        self.queue.put_nowait(None)
+
+    async def next(self) -> SectionMerge | None:
+        return await self.queue.get()
+
+    def discard(self):
+        """Удаляет дорожки диапазонов, которые так и не склеили (задача прервалась)"""
+        while not self.queue.empty():
+            merge = self.queue.get_nowait()
+            if merge:
+                merge.discard()
+
+
+async def merge_section(merge: SectionMerge, handle: JobHandle | None = None) -> bool:
+    """
+    Склеивает дорожки скачанного диапазона; ffmpeg отменяется вместе с задачей
+    Возвращает False, если склеить не удалось - тогда диапазон качает yt-dlp
+    """
+    try:
+        try:
+            result = await run_process(merge.command(), handle, timeout=MERGE_TIMEOUT)
+            error = None
+            if result.returncode != 0 or not merge.output.exists():
+                error = result.stderr.strip()[-300:]
+        except ProcessTimeout as e:
+            error = str(e)
+        except BaseException:
+            # Недописанный файл диапазона не должен сойти за готовый после перезапуска
+            merge.output.unlink(missing_ok=True)
+            raise
+        if error is not None:
+            merge.output.unlink(missing_ok=True)
+            logger.info(f"Не удалось склеить дорожки ({error}), диапазон скачает yt-dlp")
+            inc('fallbacks_total', kind='segmented_to_ytdlp')
+            return False
+        return True
+    finally:
+        merge.discard()
+
+
+def section_ext(formats: list[dict]) -> str:
+    codecs = {codec_family(fmt.get(key)) for fmt in formats for key in ('vcodec', 'acodec')}
+    return 'mp4' if codecs <= MP4_CODECS else 'mkv'
+
+
+def download_sections(ydl, info: dict, hooks: list, handoff: SectionHandoff) -> bool:
+    """
+    Скачивает диапазоны download_ranges параллельными фрагментами вместо ffmpeg из yt-dlp
+    (yt-dlp читает диапазон одним потоком ffmpeg, и время растет с длиной клипа)
+    Файлы получают имена по outtmpl ydl, как при скачивании через yt-dlp
+    Каждый скачанный диапазон сразу уходит в handoff на склейку, не дожидаясь следующих
+    Возвращает False, если форматы нельзя скачать по фрагментам - тогда диапазоны качает yt-dlp
+    """
+    ranges_func = ydl.params.get('download_ranges')
+    if not SEGMENTED_DOWNLOAD or not ranges_func:
+        return False
+    processed = ydl.process_ie_result(info, download=False)
+    formats = processed.get('requested_formats') or [processed]
+    try:
+        # Сначала планируем все диапазоны: если что-то не поддерживается, ничего не скачано зря
+        plans = []
+        for section in ranges_func(processed, ydl):
+            start, end = section['start_time'], section['end_time']
+            tracks = [plan_track(ydl, fmt, start, end) for fmt in formats]
+            output = Path(ydl.prepare_filename({
+                **processed, 'section_start': start, 'section_end': end,
+                'section_number': section.get('index'), 'ext': section_ext(formats),
+            }))
+            plans.append((start, end, section.get('index'), tracks, output))
+        for start, end, number, tracks, output in plans:
+            if output.exists() or output in handoff.claimed:
+                continue
+            pieces = sum(len(track.pieces) for track in tracks)
+            logger.info(f"Скачиваю диапазон {start}-{end} по фрагментам: {pieces} шт., "
+                        f"форматы {'+'.join(str(fmt.get('format_id')) for fmt in formats)}")
+            download = SectionDownload(ydl, tracks, output, hooks, processed)
+            merge = SectionMerge(tracks, download.parts, start, end, output, number)
+            try:
+                download.run()
+            except BaseException:
+                # Дорожки удаляются и после ошибки (403, отмена): повтор с новыми ссылками идет в ту же папку
+                merge.discard()
+                raise
+            handoff.submit(merge)
+        return True
+    except SegmentedUnsupported as e:
+        logger.info(f"Фрагментное скачивание недоступно ({e}), диапазон скачает yt-dlp")
+        inc('fallbacks_total', kind='segmented_to_ytdlp')
+        return False
@@ -0,0 +1,279 @@
+import os
+import json
+import logging
+import shutil
+import tempfile
+from pathlib import Path
+
+from core_budget import core_budget, thread_args
+from encoding_profiles import EncodingProfile
+from metrics import inc
+from process_runner import JobHandle, run_process
+
+logger = logging.getLogger(__name__)
+
+# Форматы, которые можно склеивать с перекодированными краями без перекодирования середины
+CONCAT_CODECS = {'h264'}
+CONCAT_PIX_FMTS = {'yuv420p'}
+
+# Профили H.264 из ffprobe -> значения для -profile:v libx264
+X264_PROFILES = {'Baseline': 'baseline', 'Constrained Baseline': 'baseline', 'Main': 'main', 'High': 'high'}
+
+# Края короче этого (секунды) не перекодируем - середина начинается ровно с ключевого кадра
+EDGE_EPSILON = 0.01
+
+PROBE_TIMEOUT = 30
+COPY_TIMEOUT = 300
+EDGE_TIMEOUT = 300
+FULL_ENCODE_TIMEOUT = 900
+
+
+async def probe_video_stream(path: Path, handle: JobHandle | None = None) -> dict | None:
+    """
+    Возвращает параметры первого видеопотока или None
+    Длительность всего файла добавляется в поле format_duration
+    """
+    probe_cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'stream=codec_name,profile,pix_fmt,width,height,r_frame_rate',
+        '-show_entries', 'format=duration',
+        '-of', 'json',
+        str(path)
+    ]
+    result = await run_process(probe_cmd, handle, timeout=PROBE_TIMEOUT)
+    if result.returncode != 0:
+        logger.warning(f"ffprobe не смог прочитать {path}: {result.stderr}")
+        return None
+    try:
+        probe_data = json.loads(result.stdout)
+    except json.JSONDecodeError:
+        return None
+    streams = probe_data.get('streams') or []
+    if not streams:
+        return None
+    stream = streams[0]
+    try:
+        stream['format_duration'] = float(probe_data.get('format', {}).get('duration', 0))
+    except (TypeError, ValueError):
+        stream['format_duration'] = 0.0
+    return stream
+
+
+async def probe_keyframes(path: Path, start: float, end: float,
+                          handle: JobHandle | None = None) -> list[float]:
+    """
+    Находит время ключевых кадров в интервале [start, end]
+    Читает только пакеты (без декодирования), поэтому работает быстро
+    """
+    probe_cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-read_intervals', f"{max(start - 1, 0):.3f}%{end + 1:.3f}",
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=p=0',
+        str(path)
+    ]
+    result = await run_process(probe_cmd, handle, timeout=PROBE_TIMEOUT)
+    if result.returncode != 0:
+        logger.warning(f"Не удалось получить ключевые кадры: {result.stderr}")
+        return []
+    keyframes = []
+    for line in result.stdout.splitlines():
+        parts = line.strip().split(',')
+        if len(parts) < 2 or 'K' not in parts[1]:
+            continue
+        try:
+            pts = float(parts[0])
+        except ValueError:
+            continue
+        if start <= pts <= end:
+            keyframes.append(pts)
+    return sorted(keyframes)
+
+
+async def full_reencode(source: Path, start: float, end: float, output: Path, profile: EncodingProfile,
+                        handle: JobHandle | None = None) -> bool:
+    """
+    Полностью перекодирует фрагмент [start, end] по профилю (в один или два прохода)
+    Ядра берутся из бюджета на оба прохода; таймауты отсчитываются после получения ядер
+    """
+    inc('encode_decisions_total', decision='reencode')
+    async with core_budget.reserve() as threads:
+        return await _full_reencode(source, start, end, output, profile, threads, handle)
+
+
+async def _full_reencode(source: Path, start: float, end: float, output: Path, profile: EncodingProfile,
+                         threads: int, handle: JobHandle | None = None) -> bool:
+    input_args = [*thread_args(threads), '-ss', f"{start:.3f}", '-i', str(source), '-t', f"{end - start:.3f}"]
+    passlog = str(output.with_suffix('.passlog'))
+    try:
+        if profile.two_pass:
+            first_pass_cmd = [
+                'ffmpeg',
+                *input_args,
+                *profile.video_args(pass_num=1, passlog=passlog, threads=threads),
+                '-pix_fmt', 'yuv420p',
+                '-an',
+                '-f', 'null',
+                '-y',
+                os.devnull
+            ]
+            result = await run_process(first_pass_cmd, handle, timeout=FULL_ENCODE_TIMEOUT)
+            if result.returncode != 0:
+                logger.error(f"Ошибка первого прохода: {result.stderr}")
+                return False
+
+        ffmpeg_cmd = [
+            'ffmpeg',
+            *input_args,
+            *profile.video_args(pass_num=2 if profile.two_pass else None, passlog=passlog, threads=threads),
+            *profile.audio_args(),
+            '-movflags', '+faststart',
+            '-pix_fmt', 'yuv420p',
+            '-y',
+            str(output)
+        ]
+        result = await run_process(ffmpeg_cmd, handle, timeout=FULL_ENCODE_TIMEOUT)
+        if result.returncode == 0 and output.exists():
+            return True
+        logger.error(f"Ошибка при перекодировании: {result.stderr}")
+        return False
+    finally:
+        for log_file in output.parent.glob(f"{Path(passlog).name}*"):
+            log_file.unlink(missing_ok=True)
+
+
+async def _encode_edge(source: Path, start: float, end: float, output: Path,
+                       stream: dict, profile: EncodingProfile, handle: JobHandle | None = None) -> bool:
+    """Перекодирует неполную группу кадров на краю фрагмента в MPEG-TS"""
+    async with core_budget.reserve() as threads:
+        ffmpeg_cmd = [
+            'ffmpeg',
+            *thread_args(threads),
+            '-ss', f"{start:.3f}",
+            '-i', str(source),
+            '-t', f"{end - start:.3f}",
+            '-an',
+            *profile.video_args(threads=threads),
+            '-pix_fmt', stream.get('pix_fmt', 'yuv420p'),
+        ]
+        h264_profile = X264_PROFILES.get(stream.get('profile', ''))
+        if h264_profile:
+            ffmpeg_cmd += ['-profile:v', h264_profile]
+        if stream.get('r_frame_rate') and stream['r_frame_rate'] != '0/0':
+            ffmpeg_cmd += ['-r', stream['r_frame_rate']]
+        ffmpeg_cmd += ['-bsf:v', 'h264_mp4toannexb', '-f', 'mpegts', '-y', str(output)]
+        result = await run_process(ffmpeg_cmd, handle, timeout=EDGE_TIMEOUT)
+    if result.returncode != 0:
+        logger.warning(f"Не удалось перекодировать край фрагмента: {result.stderr}")
+        return False
+    return True
+
+
+async def _copy_middle(source: Path, start: float, end: float, output: Path,
+                       handle: JobHandle | None = None) -> bool:
+    """Копирует середину фрагмента между ключевыми кадрами без перекодирования"""
+    ffmpeg_cmd = [
+        'ffmpeg',
+        '-ss', f"{start:.3f}",
+        '-i', str(source),
+        '-t', f"{end - start:.3f}",
+        '-an',
+        '-c:v', 'copy',
+        '-bsf:v', 'h264_mp4toannexb',
+        '-f', 'mpegts',
+        '-y',
+        str(output)
+    ]
+    result = await run_process(ffmpeg_cmd, handle, timeout=COPY_TIMEOUT)
+    if result.returncode != 0:
+        logger.warning(f"Не удалось скопировать середину фрагмента: {result.stderr}")
+        return False
+    return True
+
+
+async def smart_cut(source: Path, start: float, end: float, output: Path, profile: EncodingProfile,
+                    handle: JobHandle | None = None) -> bool:
+    """
+    Вырезает фрагмент [start, end] с точностью до кадра.
+    Перекодирует только неполные группы кадров в начале и конце, середину копирует как есть
+    и склеивает части через concat demuxer. Если кодек нельзя склеивать или профиль требует
+    другого разрешения/битрейта, перекодирует фрагмент целиком.
+    """
+    if not profile.allows_copy:
+        logger.info(f"Профиль {profile.name} не допускает копирование, перекодирую фрагмент целиком")
+        return await full_reencode(source, start, end, output, profile, handle)
+
+    stream = await probe_video_stream(source, handle)
+    if not stream or stream.get('codec_name') not in CONCAT_CODECS or stream.get('pix_fmt') not in CONCAT_PIX_FMTS:
+        codec = stream.get('codec_name') if stream else 'неизвестен'
+        logger.info(f"Кодек {codec} нельзя склеивать, перекодирую фрагмент целиком")
+        return await full_reencode(source, start, end, output, profile, handle)
+
+    keyframes = await probe_keyframes(source, start, end, handle)
+    if len(keyframes) < 2:
+        # Весь фрагмент внутри одной группы кадров - его дешевле просто перекодировать
+        logger.info("Во фрагменте меньше двух ключевых кадров, перекодирую целиком")
+        return await full_reencode(source, start, end, output, profile, handle)
+
+    first_key, last_key = keyframes[0], keyframes[-1]
+    logger.info(
+        f"Умная нарезка: перекодирую {first_key - start:.2f}s + {end - last_key:.2f}s, "
+        f"копирую {last_key - first_key:.2f}s"
+    )
+
+    work_dir = Path(tempfile.mkdtemp(prefix='smartcut_', dir=output.parent))
+    try:
+        parts = []
+        if first_key - start > EDGE_EPSILON:
+            head = work_dir / 'head.ts'
+            if not await _encode_edge(source, start, first_key, head, stream, profile, handle):
+                inc('fallbacks_total', kind='smart_cut_to_reencode')
+                return await full_reencode(source, start, end, output, profile, handle)
+            parts.append(head)
+
+        middle = work_dir / 'middle.ts'
+        if not await _copy_middle(source, first_key, last_key, middle, handle):
+            inc('fallbacks_total', kind='smart_cut_to_reencode')
+            return await full_reencode(source, start, end, output, profile, handle)
+        parts.append(middle)
+
+        if end - last_key > EDGE_EPSILON:
+            tail = work_dir / 'tail.ts'
+            if not await _encode_edge(source, last_key, end, tail, stream, profile, handle):
+                inc('fallbacks_total', kind='smart_cut_to_reencode')
+                return await full_reencode(source, start, end, output, profile, handle)
+            parts.append(tail)
+
+        concat_list = work_dir / 'parts.txt'
+        concat_list.write_text(''.join(f"file '{part.name}'\n" for part in parts), encoding='utf-8')
+
+        # Аудио перекодируем целиком - это дешево и избавляет от щелчков на стыках
+        ffmpeg_cmd = [
+            'ffmpeg',
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', str(concat_list),
+            '-ss', f"{start:.3f}",
+            '-t', f"{end - start:.3f}",
+            '-i', str(source),
+            '-map', '0:v:0',
+            '-map', '1:a:0?',
+            '-c:v', 'copy',
+            *profile.audio_args(),
+            '-movflags', '+faststart',
+            '-y',
+            str(output)
+        ]
+        result = await run_process(ffmpeg_cmd, handle, timeout=COPY_TIMEOUT)
+        if result.returncode == 0 and output.exists():
+            inc('encode_decisions_total', decision='smart_cut')
+            return True
+        logger.warning(f"Не удалось склеить части, перекодирую целиком: {result.stderr}")
+        inc('fallbacks_total', kind='smart_cut_to_reencode')
+        return await full_reencode(source, start, end, output, profile, handle)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,165 @@
+import os
+import io
+import asyncio
+import logging
+import dataclasses
+
+from core_budget import core_budget, thread_args
+from encoding_profiles import MB, UPLOAD_LIMIT, EncodingProfile, choose_profile
+from process_runner import JobHandle, ProcessTimeout, kill_process_tree
+
+logger = logging.getLogger(__name__)
+
+# Режим без диска: ffmpeg читает потоки напрямую по HTTP и отдает fMP4 в пайп
+STREAMING_MODE = os.getenv("STREAMING_MODE", "").lower() in ("1", "true", "yes")
+# Клип держится в памяти до отправки, поэтому ограничиваем размер отдельно
+STREAM_MAX_BYTES = int(os.getenv("STREAM_MAX_MB", "200")) * MB
+
+# Превью: пока готовится клип в полном качестве, пользователь получает начало клипа в низком
+# Превью делает процесс, выполняющий задачу; список JOB_BACKEND, в которых оно включено (пусто - выключено)
+PREVIEW_BACKENDS = {backend.strip().lower() for backend in os.getenv("PREVIEW_BACKENDS", "local").split(',')
+                    if backend.strip()}
+PREVIEW_QUALITY = os.getenv("PREVIEW_QUALITY", "360p")
+# Клипы короче этого и так готовы быстро - превью для них не делаем
+PREVIEW_MIN_SECONDS = int(os.getenv("PREVIEW_MIN_SECONDS", "20"))
+# Превью покрывает только начало клипа, чтобы уложиться в несколько секунд
+PREVIEW_MAX_SECONDS = int(os.getenv("PREVIEW_MAX_SECONDS", "30"))
+# Сколько ядер превью просит у бюджета (немного, чтобы не ждать долго и не отнимать ядра у клипов)
+PREVIEW_THREADS = int(os.getenv("PREVIEW_THREADS", "2"))
+
+# Протоколы, в которые ffmpeg умеет перематывать сам (HTTP range / HLS)
+SEEKABLE_PROTOCOLS = {'http', 'https', 'm3u8', 'm3u8_native'}
+
+STREAM_TIMEOUT = 900
+READ_CHUNK = 1024 * 1024
+
+
+class StreamTooLarge(Exception):
+    """Клип не помещается в лимит потокового режима"""
+
+
+def resolve_stream_formats(info: dict, ydl) -> list[dict] | None:
+    """
+    Выбирает форматы по опциям ydl и возвращает прямые ссылки на потоки
+    Возвращает None, если потоки нельзя читать напрямую (например, DASH-фрагменты трансляций)
+    """
+    processed = ydl.process_ie_result(info, download=False)
+    formats = processed.get('requested_formats') or [processed]
+    resolved = []
+    for fmt in formats:
+        if fmt.get('protocol') not in SEEKABLE_PROTOCOLS or not fmt.get('url'):
+            logger.info(f"Формат {fmt.get('format_id')} ({fmt.get('protocol')}) нельзя читать напрямую")
+            return None
+        resolved.append(fmt)
+    return resolved
+
+
+def build_stream_command(formats: list[dict], start: float, duration: float, profile,
+                         threads: int | None = None) -> list[str]:
+    """Команда ffmpeg: перемотка до -i в каждом потоке, кодирование и fMP4 в stdout"""
+    ffmpeg_cmd = ['ffmpeg', '-v', 'error']
+    if threads:
+        ffmpeg_cmd += thread_args(threads)
+    for fmt in formats:
+        headers = ''.join(f"{name}: {value}\r\n" for name, value in (fmt.get('http_headers') or {}).items())
+        if headers:
+            ffmpeg_cmd += ['-headers', headers]
+        # -ss перед -i: ffmpeg запрашивает у сервера только нужный диапазон байт
+        ffmpeg_cmd += ['-ss', f"{start:.3f}", '-i', fmt['url']]
+    ffmpeg_cmd += ['-t', f"{duration:.3f}"]
+
+    if len(formats) > 1:
+        video_index = next((i for i, f in enumerate(formats) if f.get('vcodec') not in (None, 'none')), 0)
+        audio_index = next((i for i, f in enumerate(formats) if f.get('acodec') not in (None, 'none')), 1)
+        ffmpeg_cmd += ['-map', f"{video_index}:v:0", '-map', f"{audio_index}:a:0"]
+    else:
+        ffmpeg_cmd += ['-map', '0:v:0', '-map', '0:a:0?']
+
+    ffmpeg_cmd += [
+        *profile.video_args(threads=threads),
+        *profile.audio_args(),
+        '-pix_fmt', 'yuv420p',
+        # Фрагментированный MP4 можно писать в пайп - moov не нужно переписывать в конце
+        '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+        '-f', 'mp4',
+        'pipe:1'
+    ]
+    return ffmpeg_cmd
+
+
+def stream_profile(formats: list[dict], duration: float, max_height: int | None = None):
+    """Профиль кодирования для потокового режима (однопроходный, с лимитом по памяти)"""
+    video = next((f for f in formats if f.get('vcodec') not in (None, 'none')), formats[0])
+    source_bytes = None
+    if video.get('tbr'):
+        source_bytes = int(video['tbr'] * 1000 / 8 * duration)
+    profile = choose_profile(
+        duration,
+        int(video.get('width') or 0),
+        int(video.get('height') or 0),
+        float(video.get('fps') or 30.0),
+        source_bytes=source_bytes,
+        size_limit=min(UPLOAD_LIMIT, STREAM_MAX_BYTES),
+        max_height=max_height,
+    )
+    # Второй проход по пайпу невозможен - полагаемся на ограничение maxrate
+    return dataclasses.replace(profile, two_pass=False)
+
+
+async def stream_segment(formats: list[dict], start: float, duration: float,
+                         handle: JobHandle | None = None, max_height: int | None = None,
+                         profile: EncodingProfile | None = None, threads: int | None = None) -> bytes:
+    """
+    Вырезает фрагмент прямо из удаленных потоков, ничего не записывая на диск
+    Возвращает готовый fMP4 в памяти
+    profile - готовый профиль (иначе подбирается под клип); threads - сколько ядер просить у бюджета
+    """
+    async with core_budget.reserve(threads) as granted:
+        return await _stream_segment(formats, start, duration, granted, handle, max_height, profile)
+
+
+async def _stream_segment(formats: list[dict], start: float, duration: float, threads: int,
+                          handle: JobHandle | None = None, max_height: int | None = None,
+                          profile: EncodingProfile | None = None) -> bytes:
+    profile = profile or stream_profile(formats, duration, max_height)
+    ffmpeg_cmd = build_stream_command(formats, start, duration, profile, threads)
+    logger.info(f"Потоковая обработка: {len(formats)} потока(ов), профиль {profile.name}")
+
+    if handle:
+        handle.check()
+    buffer = io.BytesIO()
+    process = await asyncio.create_subprocess_exec(
+        *ffmpeg_cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
+    )
+    if handle:
+        handle.attach(process)
+    stderr_task = asyncio.create_task(process.stderr.read())
+
+    async def _read_output():
+        while chunk := await process.stdout.read(READ_CHUNK):
+            buffer.write(chunk)
+            if buffer.tell() > STREAM_MAX_BYTES:
+                raise StreamTooLarge(f"Клип больше {STREAM_MAX_BYTES / MB:.0f} MB")
+        return await process.wait()
+
+    try:
+        returncode = await asyncio.wait_for(_read_output(), STREAM_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise ProcessTimeout(f"Потоковая обработка не завершилась за {STREAM_TIMEOUT}s")
+    finally:
+        if process.returncode is None:
+            kill_process_tree(process.pid)
+            await process.wait()
+        if handle:
+            handle.detach(process)
+        stderr = (await stderr_task).decode('utf-8', errors='replace')
+
+    if handle:
+        handle.check()
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg завершился с кодом {returncode}: {stderr[-500:]}")
+    logger.info(f"Клип получен потоком: {buffer.tell() / MB:.2f} MB, на диск ничего не записано")
+    return buffer.getvalue()
@@ -0,0 +1,284 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import OrderedDict
+
+import yt_dlp
+
+from metrics import inc
+
+logger = logging.getLogger(__name__)
+
+# Общий темп запросов к YouTube (запросов в секунду и запас на всплеск)
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "1.0"))
+THROTTLE_BURST = int(os.getenv("THROTTLE_BURST", "5"))
+# Темп запросов к одному видео: много пользователей и пакеты не бьют в одно видео подряд
+THROTTLE_VIDEO_RATE = float(os.getenv("THROTTLE_VIDEO_RATE", "0.2"))
+THROTTLE_VIDEO_BURST = int(os.getenv("THROTTLE_VIDEO_BURST", "3"))
+# Повторы после ограничений YouTube и экспоненциальная задержка между ними (секунды)
+THROTTLE_MAX_RETRIES = int(os.getenv("THROTTLE_MAX_RETRIES", "4"))
+THROTTLE_BACKOFF_BASE = float(os.getenv("THROTTLE_BACKOFF_BASE", "2"))
+THROTTLE_BACKOFF_MAX = float(os.getenv("THROTTLE_BACKOFF_MAX", "120"))
+# Сколько ограничений подряд размыкают цепь и на сколько (секунды, растет с каждым размыканием)
+THROTTLE_BREAKER_FAILURES = int(os.getenv("THROTTLE_BREAKER_FAILURES", "3"))
+THROTTLE_BREAKER_COOLDOWN = float(os.getenv("THROTTLE_BREAKER_COOLDOWN", "60"))
+THROTTLE_BREAKER_MAX_COOLDOWN = float(os.getenv("THROTTLE_BREAKER_MAX_COOLDOWN", "900"))
+# Наборы player_client, которые перебираются после блокировок ("android,web;tv,web_safari")
+THROTTLE_PLAYER_CLIENTS = [
+    [client.strip() for client in group.split(',') if client.strip()]
+    for group in os.getenv("THROTTLE_PLAYER_CLIENTS", "android,web;tv,web_safari;ios,mweb;web_embedded,mweb").split(';')
+    if group.strip()
+]
+
+# User-Agent меняется вместе с набором клиентов (в Python API yt-dlp он задается через http_headers)
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Safari/605.1.15',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:121.0) Gecko/20100101 Firefox/121.0',
+]
+
+# Сколько корзин отдельных видео держать в памяти
+VIDEO_BUCKETS_MAX = 1024
+
+# Виды ограничений YouTube
+THROTTLE_BOT_CHECK = "bot_check"
+THROTTLE_RATE_LIMIT = "rate_limit"
+THROTTLE_FORBIDDEN = "forbidden"
+
+
+def classify_error(error: Exception) -> str | None:
+    """Вид ограничения YouTube по ошибке yt-dlp; None - ошибка не связана с ограничениями"""
+    message = str(error).lower()
+    if "confirm you're not a bot" in message or "confirm you’re not a bot" in message:
+        return THROTTLE_BOT_CHECK
+    if "http error 429" in message or "too many requests" in message or "rate-limited" in message:
+        return THROTTLE_RATE_LIMIT
+    if "http error 403" in message:
+        return THROTTLE_FORBIDDEN
+    return None
+
+
+def backoff_delay(attempt: int, base: float = THROTTLE_BACKOFF_BASE, cap: float = THROTTLE_BACKOFF_MAX) -> float:
+    """Экспоненциальная задержка со случайным разбросом (full jitter): повторы не приходят пачкой"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    """Корзина токенов: rate запросов в секунду, до burst подряд"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, count: float = 1) -> float:
+        """Берет count токенов (в долг, если их нет); возвращает, сколько секунд подождать до запроса"""
+        self._refill()
+        self.tokens -= count
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def refund(self, count: float = 1):
+        """Возвращает токены, взятые под запрос, который так и не ушел"""
+        self.tokens = min(self.burst, self.tokens + count)
+
+    def try_reserve(self, count: float = 1) -> bool:
+        """Берет count токенов, только если они есть (без долга); False - запрос лучше пропустить"""
+        self._refill()
+        if self.tokens < count:
+            return False
+        self.tokens -= count
+        return True
+
+
+class CircuitBreaker:
+    """
+    Размыкается после нескольких ограничений подряд: запросы к YouTube откладываются, а не проваливаются.
+    После паузы пропускает один пробный запрос: успех замыкает цепь, новая ошибка удваивает паузу.
+    Остальные запросы ждут окончания пробного (probe_finished), а не опрашивают состояние цепи.
+    """
+
+    def __init__(self, threshold: int = THROTTLE_BREAKER_FAILURES, cooldown: float = THROTTLE_BREAKER_COOLDOWN,
+                 max_cooldown: float = THROTTLE_BREAKER_MAX_COOLDOWN):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.trips = 0
+        self.opened_until = 0.0
+        self.probing = False
+        # Пробный запрос может быть целым скачиванием: ожидающие будятся по его окончании
+        self.probe_finished = asyncio.Event()
+        self.probe_finished.set()
+
+    @property
+    def state(self) -> str:
+        if time.monotonic() < self.opened_until:
+            return "open"
+        return "half-open" if self.trips else "closed"
+
+    def delay(self) -> float:
+        """Сколько ждать до конца паузы (0 - цепь не разомкнута)"""
+        return max(0.0, self.opened_until - time.monotonic())
+
+    def begin(self) -> bool:
+        """Отмечает начало запроса; True - это пробный запрос после паузы"""
+        if self.trips and not self.probing:
+            self.probing = True
+            self.probe_finished.clear()
+            return True
+        return False
+
+    def _end_probe(self):
+        self.probing = False
+        self.probe_finished.set()
+
+    def release(self, probe: bool):
+        """Пробный запрос завершился без ответа о блокировке (отмена, другая ошибка) - пропускаем следующий"""
+        if probe:
+            self._end_probe()
+
+    def record_success(self):
+        if self.trips:
+            logger.info("Цепь запросов к YouTube снова замкнута")
+        self.failures = 0
+        self.trips = 0
+        self._end_probe()
+
+    def record_failure(self, probe: bool) -> bool:
+        """Учитывает ограничение; True - цепь разомкнулась"""
+        self.failures += 1
+        if probe:
+            self._end_probe()
+        if not probe and self.failures < self.threshold:
+            return False
+        self.trips += 1
+        self.failures = 0
+        pause = min(self.max_cooldown, self.cooldown * 2 ** (self.trips - 1))
+        self.opened_until = time.monotonic() + pause
+        logger.warning(f"YouTube ограничивает запросы: цепь разомкнута на {pause:.0f}s (размыкание {self.trips})")
+        return True
+
+
+class ThrottleController:
+    """
+    Все обращения к YouTube идут через контроллер: общий темп и темп на видео (корзины токенов),
+    повторы с экспоненциальной задержкой, размыкатель цепи и смена player_client после блокировок.
+    Живет в одном event loop (у бота и у каждого процесса worker.py свой контроллер).
+    """
+
+    def __init__(self, rate: float = THROTTLE_RATE, burst: int = THROTTLE_BURST,
+                 video_rate: float = THROTTLE_VIDEO_RATE, video_burst: int = THROTTLE_VIDEO_BURST):
+        self.video_rate = video_rate
+        self.video_burst = video_burst
+        self.configure(rate, burst)
+        self.breaker = CircuitBreaker()
+        self.client_index = 0
+        self.throttled = 0
+        self._videos: OrderedDict[str, TokenBucket] = OrderedDict()
+
+    def configure(self, rate: float, burst: int | None = None):
+        """Задает общий темп (процессы worker.py делят его между собой)"""
+        self.bucket = TokenBucket(rate, burst or THROTTLE_BURST)
+
+    def request_opts(self) -> dict:
+        """Опции yt-dlp для текущего набора клиентов (меняется после блокировок)"""
+        return {
+            'extractor_args': {'youtube': {'player_client': THROTTLE_PLAYER_CLIENTS[self.client_index]}},
+            'http_headers': {'User-Agent': USER_AGENTS[self.client_index % len(USER_AGENTS)]},
+        }
+
+    def stats(self) -> dict:
+        return {"youtube_breaker": self.breaker.state, "youtube_throttled": self.throttled,
+                "youtube_clients": ",".join(THROTTLE_PLAYER_CLIENTS[self.client_index])}
+
+    def _video_bucket(self, key: str) -> TokenBucket:
+        bucket = self._videos.get(key)
+        if bucket is None:
+            bucket = self._videos[key] = TokenBucket(self.video_rate, self.video_burst)
+            # Давно не запрошенные видео забываем: их корзины давно полные
+            while len(self._videos) > VIDEO_BUCKETS_MAX:
+                self._videos.popitem(last=False)
+        self._videos.move_to_end(key)
+        return bucket
+
+    async def _admit(self, key: str) -> bool:
+        """Ждет, пока цепь замкнута и есть токены; возвращает, пробный ли это запрос"""
+        while True:
+            delay = self.breaker.delay()
+            if delay:
+                logger.info(f"Запрос к YouTube ({key}) отложен на {delay:.0f}s: цепь разомкнута")
+                await asyncio.sleep(delay)
+                continue
+            if self.breaker.probing:
+                logger.info(f"Запрос к YouTube ({key}) ждет окончания пробного запроса")
+                await self.breaker.probe_finished.wait()
+                continue
+            video_bucket = self._video_bucket(key)
+            wait = max(self.bucket.reserve(), video_bucket.reserve())
+            try:
+                if wait:
+                    await asyncio.sleep(wait)
+            except BaseException:
+                self.bucket.refund()
+                video_bucket.refund()
+                raise
+            # За время ожидания токена цепь могла разомкнуться или начаться пробный запрос
+            if not self.breaker.delay() and not self.breaker.probing:
+                return self.breaker.begin()
+            # Запрос откладывается до замыкания цепи: токен возвращаем, иначе повтор возьмет второй
+            self.bucket.refund()
+            video_bucket.refund()
+
+    def _rotate(self):
+        self.client_index = (self.client_index + 1) % len(THROTTLE_PLAYER_CLIENTS)
+        logger.warning(f"Меняю клиентов YouTube на {','.join(THROTTLE_PLAYER_CLIENTS[self.client_index])}")
+
+    async def run(self, key: str, func, *args, invalidate=None):
+        """
+        Выполняет синхронный вызов yt-dlp в отдельном потоке с учетом ограничений YouTube
+        key - ID видео; invalidate(key) сбрасывает метаданные, извлеченные прежним клиентом
+        Ошибки, не связанные с ограничениями, пробрасываются сразу
+        """
+        attempt = 0
+        while True:
+            probe = await self._admit(key)
+            try:
+                result = await asyncio.to_thread(func, *args)
+            except yt_dlp.utils.DownloadError as e:
+                kind = classify_error(e)
+                if kind is None:
+                    self.breaker.release(probe)
+                    raise
+                self.throttled += 1
+                inc('youtube_throttled_total', kind=kind)
+                self.breaker.record_failure(probe)
+                if kind in (THROTTLE_BOT_CHECK, THROTTLE_FORBIDDEN):
+                    # Блокировка привязана к клиенту: следующие запросы (и чужие задачи) идут другим клиентом
+                    self._rotate()
+                    if invalidate:
+                        invalidate(key)
+                attempt += 1
+                if attempt > THROTTLE_MAX_RETRIES:
+                    raise
+                delay = backoff_delay(attempt)
+                logger.warning(f"YouTube ограничил запрос ({kind}), повтор {attempt}/{THROTTLE_MAX_RETRIES} "
+                               f"через {delay:.1f}s: {key}")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self.breaker.release(probe)
+                raise
+            self.breaker.record_success()
+            return result
+
+
+# Контроллер запросов к YouTube (у бота и у каждого процесса worker.py свой)
+youtube_throttle = ThrottleController()
@@ -0,0 +1,95 @@
+import os
+import hashlib
+import logging
+from typing import Callable
+
+import tornado.web
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+# Режим webhook включается, если задан публичный адрес бота (например, https://bot.up.railway.app)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip('/')
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "telegram").strip('/')
+# Секрет, который Telegram присылает в заголовке; по умолчанию выводится из токена
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Сколько соединений Telegram может держать с ботом одновременно
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Railway передает порт в PORT; в режиме webhook его занимает сервер webhook python-telegram-bot
+HTTP_LISTEN = os.getenv("HTTP_LISTEN", "0.0.0.0")
+HTTP_PORT = int(os.getenv("PORT", "8080"))
+# Проверка готовности и метрики не отдаются на публичном порту webhook: в режиме webhook они слушают
+# следующий порт (доступен только во внутренней сети), в режиме polling - PORT
+HEALTH_LISTEN = os.getenv("HEALTH_LISTEN", HTTP_LISTEN)
+HEALTH_PORT = int(os.getenv("HEALTH_PORT") or (HTTP_PORT + 1 if WEBHOOK_URL else HTTP_PORT))
+HEALTH_PATH = "/healthz"
+# Метрики в текстовом формате Prometheus
+METRICS_PATH = "/metrics"
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Проверка готовности поднимается в режиме webhook, если платформа выдала порт или это включено явно
+HEALTH_SERVER = (bool(WEBHOOK_URL or os.getenv("PORT"))
+                 or os.getenv("HEALTH_SERVER", "").lower() in ("1", "true", "yes"))
+
+
+def derive_secret(token: str) -> str:
+    """Секрет webhook из токена: одинаковый на всех репликах, но не раскрывает сам токен"""
+    return hashlib.sha256(f"webhook:{token}".encode()).hexdigest()[:64]
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def initialize(self, server: 'HealthServer'):
+        self.server = server
+
+    def get(self):
+        status, payload = self.server.status()
+        self.set_status(status)
+        self.write(payload)
+
+    def head(self):
+        self.set_status(self.server.status()[0])
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, server: 'HealthServer'):
+        self.server = server
+
+    def get(self):
+        self.set_header("Content-Type", METRICS_CONTENT_TYPE)
+        self.write(self.server.metrics())
+
+
+class HealthServer:
+    """
+    HTTP-сервер проверки готовности и метрик на tornado (тот же, что у webhook python-telegram-bot).
+    Слушает отдельно от webhook: состояние очереди не видно с публичного адреса бота.
+    """
+
+    def __init__(self, application: Application, health: Callable[[], dict] | None = None,
+                 metrics: Callable[[], str] | None = None):
+        self.application = application
+        self.health = health
+        self.metrics = metrics
+        self._server = None
+
+    def status(self) -> tuple[int, dict]:
+        # Приложение считается запущенным после установки webhook и до начала остановки
+        ready = self.application.running
+        payload = {"status": "ready" if ready else "starting"}
+        if self.health:
+            payload.update(self.health())
+        return (200 if ready else 503), payload
+
+    async def start(self, host: str = HEALTH_LISTEN, port: int = HEALTH_PORT):
+        handlers = [(HEALTH_PATH, HealthHandler, {'server': self})]
+        if self.metrics:
+            handlers.append((METRICS_PATH, MetricsHandler, {'server': self}))
+        # Запросы проверки готовности идут постоянно - в лог их не пишем
+        app = tornado.web.Application(handlers, log_function=lambda handler: None)
+        self._server = app.listen(port, address=host)
+        logger.info(f"Проверка готовности и метрики слушают {host}:{port}")
+
+    async def stop(self):
+        if self._server:
+            self._server.stop()
+            await self._server.close_all_connections()
+            self._server = None
@@ -0,0 +1,212 @@
+import os
+import signal
+import socket
+import asyncio
+import logging
+import multiprocessing
+import time
+from dotenv import load_dotenv
+
+# Загружаем переменные окружения до импорта модулей, которые читают настройки
+load_dotenv()
+
+import yt_dlp
+
+from core_budget import ENCODE_CORES, core_budget
+from throttle import THROTTLE_RATE, youtube_throttle
+from segmented import BANDWIDTH_MBPS, global_bandwidth
+from durable_queue import LEASE_CANCELLED, LEASE_HELD, LEASE_LOST, DurableQueue, QueuedJob
+from metrics import install_trace_logging
+from pipeline import execute_job, warm_ydl_pool
+from process_runner import JobCancelled, JobHandle
+
+# Настройка логирования
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(processName)s - [%(trace_id)s] %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+install_trace_logging()
+logger = logging.getLogger(__name__)
+
+# Сколько процессов-воркеров запускать (по умолчанию - по одному на ядро)
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", str(os.cpu_count() or 1)))
+# Пауза между проверками пустой очереди
+WORKER_IDLE_SLEEP = float(os.getenv("WORKER_IDLE_SLEEP", "1.0"))
+# Упавший процесс перезапускается не чаще, чем раз в столько секунд
+RESPAWN_DELAY = 5
+# Как часто передавать фронтенду этап, прогресс и превью задачи (пишется только при изменениях)
+PROGRESS_SYNC_INTERVAL = 1.0
+
+
+class Worker:
+    """Процесс-воркер: забирает задачи из общей очереди и выполняет конвейер скачивания и нарезки"""
+
+    def __init__(self, queue: DurableQueue, name: str):
+        self.queue = queue
+        self.name = name
+        self.stopping = asyncio.Event()
+
+    async def run(self):
+        logger.info(f"Воркер {self.name} запущен")
+        while not self.stopping.is_set():
+            job = await asyncio.to_thread(self.queue.claim, self.name)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), WORKER_IDLE_SLEEP)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.run_job(job)
+        logger.info(f"Воркер {self.name} остановлен")
+
+    async def run_job(self, job: QueuedJob):
+        logger.info(f"Воркер {self.name}: задача #{job.job_id} ({job.kind}), попытка {job.attempts}")
+        handle = JobHandle(f"#{job.job_id}")
+        task = asyncio.create_task(execute_job(handle, job.kind, job.payload))
+        heartbeat = asyncio.create_task(self._heartbeat(job, handle, task))
+        progress = asyncio.create_task(self._sync_progress(job, handle))
+        stop_wait = asyncio.create_task(self.stopping.wait())
+        try:
+            await asyncio.wait({task, stop_wait}, return_when=asyncio.FIRST_COMPLETED)
+            if not task.done():
+                # Штатная остановка: прерываем задачу и отдаем ее другому воркеру,
+                # скачанные файлы оставляем - по журналу задача продолжится с того же места
+                handle.cancel(cleanup=False)
+                task.cancel()
+                await asyncio.wait({task})
+                await asyncio.to_thread(self.queue.release, job.job_id, self.name)
+                logger.info(f"Задача #{job.job_id} возвращена в очередь при остановке воркера")
+                return
+            if heartbeat.done() and not heartbeat.cancelled() and heartbeat.result() == LEASE_LOST:
+                # Задачей и ее папкой теперь владеет другой воркер: ничего не пишем и не удаляем
+                logger.warning(f"Задача #{job.job_id} остановлена: ее выполняет другой воркер")
+                return
+            await self._report(job, handle, task)
+        finally:
+            heartbeat.cancel()
+            progress.cancel()
+            stop_wait.cancel()
+
+    async def _report(self, job: QueuedJob, handle: JobHandle, task: asyncio.Task):
+        """
+        Записывает результат задачи в очередь
+        Если задачу уже забрал другой воркер, итог отброшен - файлы теперь его, их не трогаем
+        """
+        if task.cancelled() or isinstance(task.exception(), JobCancelled):
+            if await asyncio.to_thread(self.queue.mark_cancelled, job.job_id, self.name):
+                handle.cleanup()
+                logger.info(f"Задача #{job.job_id} отменена")
+            return
+        error = task.exception()
+        if error is not None:
+            error_type = 'download' if isinstance(error, yt_dlp.utils.DownloadError) else type(error).__name__
+            logger.error(f"Задача #{job.job_id} завершилась ошибкой: {error}", exc_info=error)
+            if await asyncio.to_thread(self.queue.fail, job.job_id, self.name, str(error), error_type):
+                handle.cleanup()
+            return
+        result = task.result()
+        if not await asyncio.to_thread(self.queue.complete, job.job_id, self.name, result):
+            return
+        if not result.get('path') and not any(result.get('paths') or []):
+            # Готовых файлов нет - промежуточные удаляем здесь, фронтенду убирать нечего
+            handle.cleanup()
+        logger.info(f"Задача #{job.job_id} выполнена")
+
+    async def _sync_progress(self, job: QueuedJob, handle: JobHandle):
+        """Передает фронтенду этап, прогресс и готовое превью задачи через очередь"""
+        last = None
+        while True:
+            await asyncio.sleep(PROGRESS_SYNC_INTERVAL)
+            if handle.progress is None and handle.preview is None:
+                continue
+            snapshot = handle.snapshot()
+            if snapshot != last:
+                await asyncio.to_thread(self.queue.set_progress, job.job_id, self.name, snapshot)
+                last = snapshot
+
+    async def _heartbeat(self, job: QueuedJob, handle: JobHandle, task: asyncio.Task) -> str:
+        """
+        Продлевает аренду задачи и останавливает ее, если фронтенд попросил отмену или аренду потеряли
+        Возвращает итог последнего продления (LEASE_CANCELLED или LEASE_LOST)
+        """
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            lease = await asyncio.to_thread(self.queue.heartbeat, job.job_id, self.name)
+            if lease == LEASE_HELD:
+                continue
+            if lease == LEASE_CANCELLED:
+                logger.info(f"Задача #{job.job_id} отменена, останавливаю")
+                handle.cancel()
+            else:
+                # Новый владелец продолжает задачу по журналу в той же папке - файлы не трогаем
+                logger.warning(f"Аренда задачи #{job.job_id} истекла, ее забрал другой воркер, останавливаю")
+                handle.cancel(cleanup=False)
+            task.cancel()
+            return lease
+
+
+def worker_process():
+    """Точка входа процесса-воркера"""
+    # Процессы делят ядра машины, иначе каждый раздал бы кодированиям все ядра
+    core_budget.configure(max(1, ENCODE_CORES // max(1, WORKER_PROCESSES)), core_budget.threads_per_encode)
+    # Общий темп запросов к YouTube и скорость скачивания тоже делятся между процессами
+    youtube_throttle.configure(THROTTLE_RATE / max(1, WORKER_PROCESSES))
+    global_bandwidth.configure(BANDWIDTH_MBPS / max(1, WORKER_PROCESSES))
+
+    async def _main():
+        worker = Worker(DurableQueue(), f"{socket.gethostname()}:{os.getpid()}")
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, worker.stopping.set)
+        # Экземпляры YoutubeDL прогреваются в фоне, пока воркер ждет первую задачу
+        warmup = loop.run_in_executor(None, warm_ydl_pool)
+        await worker.run()
+        await warmup
+
+    asyncio.run(_main())
+
+
+def main():
+    """Запускает процессы-воркеры и перезапускает упавшие"""
+    # Создаем таблицы до старта процессов, чтобы они не делали это одновременно
+    DurableQueue()
+    stopping = False
+
+    def _stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+
+    def _spawn(index: int) -> multiprocessing.Process:
+        process = multiprocessing.Process(target=worker_process, name=f"worker-{index}")
+        process.start()
+        return process
+
+    processes = [_spawn(i) for i in range(max(1, WORKER_PROCESSES))]
+    started = [time.monotonic()] * len(processes)
+    logger.info(f"Запущено процессов-воркеров: {len(processes)}")
+
+    while not stopping:
+        time.sleep(1)
+        for index, process in enumerate(processes):
+            if process.is_alive() or stopping:
+                continue
+            if time.monotonic() - started[index] < RESPAWN_DELAY:
+                continue
+            # Задачи упавшего процесса вернутся в очередь, когда истечет их аренда
+            logger.warning(f"Воркер {process.name} завершился с кодом {process.exitcode}, перезапускаю")
+            processes[index] = _spawn(index)
+            started[index] = time.monotonic()
+
+    logger.info("Останавливаю воркеры...")
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import os
+import shutil
+import logging
+import tempfile
+import threading
+from pathlib import Path
+
+from scheduler import SHORT_CLIP_SECONDS
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Папка для файлов задач: у каждой задачи своя подпапка job_<id>
+DOWNLOAD_DIR = Path(os.getenv("DOWNLOAD_DIR", "downloads"))
+# Общий бюджет диска на файлы задач и кеш готовых клипов
+DISK_QUOTA_MB = int(os.getenv("DISK_QUOTA_MB", "8192"))
+# Сколько места на диске оставлять свободным в любом случае
+DISK_MIN_FREE_MB = int(os.getenv("DISK_MIN_FREE_MB", "512"))
+# Оценка места под задачу на секунду клипа: исходник, промежуточные файлы и результат
+WORKSPACE_BYTES_PER_SECOND = int(os.getenv("WORKSPACE_BYTES_PER_SECOND", str(2 * MB)))
+# Папка в оперативной памяти (например, /dev/shm) для коротких клипов; пусто - не использовать
+TMPFS_DIR = os.getenv("TMPFS_DIR", "")
+# Клипы не длиннее этого (секунды) обрабатываются в tmpfs
+TMPFS_MAX_SECONDS = int(os.getenv("TMPFS_MAX_SECONDS", str(SHORT_CLIP_SECONDS)))
+# Сколько памяти tmpfs могут занимать задачи одновременно
+TMPFS_MAX_MB = int(os.getenv("TMPFS_MAX_MB", "512"))
+
+WORKSPACE_PREFIX = "job_"
+
+
+class DiskQuotaError(Exception):
+    """Под задачу не хватает места даже после очистки кеша"""
+
+
+def tree_size(path: Path) -> int:
+    """Размер файла или папки со всем содержимым"""
+    try:
+        if not path.is_dir():
+            return path.lstat().st_size
+    except OSError:
+        return 0
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(directory, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class WorkspaceManager:
+    """
+    Папки задач и бюджет диска.
+    Каждая задача работает в своей папке job_<id>, поэтому одинаковые таймкоды разных видео не пересекаются.
+    Место под задачу резервируется при постановке в очередь: если бюджета не хватает,
+    сначала вытесняются давно использованные файлы кешей, а затем задача отклоняется.
+    Короткие клипы можно обрабатывать в tmpfs, чтобы не тратить диск и его пропускную способность.
+    """
+
+    def __init__(self, root: Path = DOWNLOAD_DIR, quota_bytes: int = DISK_QUOTA_MB * MB,
+                 tmpfs_dir: str = TMPFS_DIR, tmpfs_bytes: int = TMPFS_MAX_MB * MB):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.quota_bytes = quota_bytes
+        self.tmpfs_bytes = tmpfs_bytes
+        self.tmpfs_root: Path | None = None
+        if tmpfs_dir:
+            # Своя подпапка, чтобы очистка не задела чужие файлы в /dev/shm
+            tmpfs_root = Path(tmpfs_dir) / "trubabot"
+            try:
+                tmpfs_root.mkdir(parents=True, exist_ok=True)
+                self.tmpfs_root = tmpfs_root
+            except OSError as e:
+                logger.warning(f"tmpfs {tmpfs_dir} недоступен, все задачи будут на диске: {e}")
+        self._lock = threading.Lock()
+        # job_id -> зарезервированные байты
+        self._reserved: dict[str, int] = {}
+        self._caches = []
+
+    @property
+    def roots(self) -> list[Path]:
+        return [root for root in (self.tmpfs_root, self.root) if root]
+
+    def add_cache(self, cache):
+        """
+        Подключает кеш, который делит бюджет диска с задачами
+        Кеш должен уметь total_size() и trim(bytes_to_free) -> освобожденные байты
+        """
+        self._caches.append(cache)
+
+    def path(self, job_id: str) -> Path | None:
+        """Существующая папка задачи (в tmpfs или на диске)"""
+        for root in self.roots:
+            workspace = root / f"{WORKSPACE_PREFIX}{job_id}"
+            if workspace.is_dir():
+                return workspace
+        return None
+
+    def workspace(self, job_id: str | None) -> Path:
+        """
+        Папка задачи: все файлы задачи (включая .part yt-dlp) лежат в ней
+        Для задачи из журнала папка постоянная - после перезапуска в ней продолжается скачивание
+        """
+        if not job_id:
+            return Path(tempfile.mkdtemp(prefix=WORKSPACE_PREFIX, dir=self.root))
+        workspace = self.path(job_id)
+        if workspace is None:
+            # Задача не проходила admit (например, папка создана в tmpfs другого контейнера)
+            workspace = self.root / f"{WORKSPACE_PREFIX}{job_id}"
+            workspace.mkdir(parents=True, exist_ok=True)
+        return workspace
+
+    def admit(self, job_id: str, clip_seconds: int) -> Path:
+        """
+        Резервирует место под задачу и создает ее папку
+        Бросает DiskQuotaError, если места нет даже после вытеснения из кешей
+        """
+        estimate = max(clip_seconds, 1) * WORKSPACE_BYTES_PER_SECOND
+        with self._lock:
+            workspace = self.path(job_id)
+            if workspace is None and self._fits_tmpfs(clip_seconds, estimate):
+                workspace = self.tmpfs_root / f"{WORKSPACE_PREFIX}{job_id}"
+            elif workspace is None:
+                self._ensure_disk(estimate)
+                workspace = self.root / f"{WORKSPACE_PREFIX}{job_id}"
+            workspace.mkdir(parents=True, exist_ok=True)
+            self._reserved[job_id] = estimate
+        logger.info(f"Задача {job_id}: папка {workspace}, резерв {estimate / MB:.0f} MB")
+        return workspace
+
+    def release(self, job_id: str | None):
+        """Удаляет папку задачи и снимает ее резерв"""
+        if not job_id:
+            return
+        with self._lock:
+            self._reserved.pop(job_id, None)
+        for root in self.roots:
+            shutil.rmtree(root / f"{WORKSPACE_PREFIX}{job_id}", ignore_errors=True)
+
+    def sweep(self, keep: set[str]) -> int:
+        """Удаляет все, что не относится к задачам из keep (брошенные после падений файлы); возвращает байты"""
+        freed = 0
+        for root in self.roots:
+            for path in root.iterdir():
+                if path.name.startswith(WORKSPACE_PREFIX) and path.name[len(WORKSPACE_PREFIX):] in keep:
+                    continue
+                size = tree_size(path)
+                with self._lock:
+                    self._reserved.pop(path.name[len(WORKSPACE_PREFIX):], None)
+                logger.info(f"Удаляю брошенные файлы: {path} ({size / MB:.1f} MB)")
+                if path.is_dir():
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    path.unlink(missing_ok=True)
+                freed += size
+        return freed
+
+    def usage(self, root: Path) -> int:
+        """Сколько занимают задачи в root с учетом резервов еще не докачанных задач"""
+        total = 0
+        for path in root.iterdir():
+            size = tree_size(path)
+            if path.name.startswith(WORKSPACE_PREFIX):
+                size = max(size, self._reserved.get(path.name[len(WORKSPACE_PREFIX):], 0))
+            total += size
+        return total
+
+    def stats(self) -> dict:
+        with self._lock:
+            disk = self.usage(self.root) + sum(cache.total_size() for cache in self._caches)
+            stats = {"disk_used_mb": round(disk / MB), "disk_quota_mb": round(self.quota_bytes / MB),
+                     "workspaces": len(self._reserved)}
+            if self.tmpfs_root:
+                stats["tmpfs_used_mb"] = round(self.usage(self.tmpfs_root) / MB)
+        return stats
+
+    def _fits_tmpfs(self, clip_seconds: int, estimate: int) -> bool:
+        if not self.tmpfs_root or clip_seconds > TMPFS_MAX_SECONDS:
+            return False
+        if self.usage(self.tmpfs_root) + estimate > self.tmpfs_bytes:
+            return False
+        # tmpfs может быть меньше настроенного бюджета
+        return shutil.disk_usage(self.tmpfs_root).free >= estimate
+
+    def _ensure_disk(self, estimate: int):
+        """Проверяет бюджет и свободное место на диске, при нехватке вытесняет файлы из кешей"""
+        used = self.usage(self.root) + sum(cache.total_size() for cache in self._caches)
+        free = shutil.disk_usage(self.root).free - DISK_MIN_FREE_MB * MB
+        shortage = max(used + estimate - self.quota_bytes, estimate - free)
+        if shortage > sum(cache.total_size() for cache in self._caches):
+            # Кеш не спасет - не вытесняем его зря
+            raise DiskQuotaError(f"не хватает {shortage / MB:.0f} MB под задачу")
+        for cache in self._caches:
+            if shortage <= 0:
+                break
+            shortage -= cache.trim(shortage)
+        if shortage > 0:
+            raise DiskQuotaError(f"не хватает {shortage / MB:.0f} MB под задачу")
@@ -0,0 +1,160 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import yt_dlp
+from yt_dlp.networking import Request
+from yt_dlp.utils.networking import HTTPHeaderDict
+
+logger = logging.getLogger(__name__)
+
+# Сколько прогретых экземпляров YoutubeDL держать наготове
+YDL_POOL_SIZE = int(os.getenv("YDL_POOL_SIZE", "4"))
+# Экземпляр пересоздается после стольких задач или через столько секунд (куки, соединения, плеер)
+YDL_POOL_MAX_USES = int(os.getenv("YDL_POOL_MAX_USES", "100"))
+YDL_POOL_MAX_AGE = int(os.getenv("YDL_POOL_MAX_AGE", "1800"))
+# Легкий запрос при прогреве: открывает TLS-соединение с YouTube заранее; пусто - не делать
+YDL_POOL_WARMUP_URL = os.getenv("YDL_POOL_WARMUP_URL", "https://www.youtube.com/generate_204")
+WARMUP_TIMEOUT = 10
+
+
+class PooledYdl:
+    """Экземпляр YoutubeDL в пуле и параметры, с которыми он создан"""
+
+    def __init__(self, ydl: yt_dlp.YoutubeDL, headers: dict):
+        self.ydl = ydl
+        self.headers = headers
+        # Параметры после разбора в конструкторе - от них считаются параметры каждой задачи
+        self.params = dict(ydl.params)
+        self.created = time.monotonic()
+        self.uses = 0
+
+    def expired(self) -> bool:
+        return self.uses >= YDL_POOL_MAX_USES or time.monotonic() - self.created > YDL_POOL_MAX_AGE
+
+
+class YdlPool:
+    """
+    Пул долгоживущих экземпляров YoutubeDL.
+    Новый экземпляр на каждую задачу заново инициализирует экстракторы, скачивает и разбирает
+    JS плеера и открывает TLS-соединения; экземпляр из пула сохраняет пул соединений и куки,
+    а кеш плеера и подписей общий для всех экземпляров.
+    Экземпляр выдается одной задаче за раз; после ошибки или по возрасту он пересоздается.
+    Заголовки запросов зашиты в сетевой слой экземпляра, поэтому экземпляры с другими заголовками
+    (например, после смены User-Agent контроллером ограничений) тоже пересоздаются.
+    """
+
+    def __init__(self, base_opts: dict, size: int = YDL_POOL_SIZE):
+        self.base_opts = base_opts
+        self.size = size
+        self._idle: list[PooledYdl] = []
+        self._lock = threading.Lock()
+        # Общий кеш плеера YouTube: JS и решения подписей одинаковы для всех экземпляров
+        self._player_cache: dict = {}
+        self._code_cache: dict = {}
+        self.created = 0
+        self.reused = 0
+        self.recycled = 0
+
+    def _create(self, headers: dict) -> PooledYdl:
+        ydl = yt_dlp.YoutubeDL({**self.base_opts, 'http_headers': headers})
+        youtube = ydl.get_info_extractor('Youtube')
+        if hasattr(youtube, '_player_cache'):
+            youtube._player_cache = self._player_cache
+            youtube._code_cache = self._code_cache
+        with self._lock:
+            self.created += 1
+        return PooledYdl(ydl, headers)
+
+    def _close(self, pooled: PooledYdl, reason: str):
+        logger.info(f"Пересоздаю экземпляр YoutubeDL: {reason} (задач: {pooled.uses})")
+        with self._lock:
+            self.recycled += 1
+        try:
+            pooled.ydl.close()
+        except Exception as e:
+            logger.warning(f"Ошибка при закрытии YoutubeDL: {e}")
+
+    def _acquire(self, headers: dict) -> PooledYdl:
+        while True:
+            with self._lock:
+                pooled = self._idle.pop() if self._idle else None
+            if pooled is None:
+                return self._create(headers)
+            if pooled.headers != headers:
+                self._close(pooled, "сменились заголовки запросов")
+            elif pooled.expired():
+                self._close(pooled, "истек срок")
+            else:
+                with self._lock:
+                    self.reused += 1
+                return pooled
+
+    def _release(self, pooled: PooledYdl, healthy: bool):
+        if not healthy:
+            # После ошибки соединения и куки экземпляра могут быть испорчены (блокировка, обрыв)
+            self._close(pooled, "задача завершилась ошибкой")
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(pooled)
+                return
+        self._close(pooled, "пул заполнен")
+
+    @staticmethod
+    def _prepare(pooled: PooledYdl, opts: dict):
+        """Подставляет параметры задачи в экземпляр так же, как это делает конструктор YoutubeDL"""
+        ydl = pooled.ydl
+        ydl.params.clear()
+        ydl.params.update(pooled.params)
+        ydl.params.update({key: value for key, value in opts.items() if key != 'http_headers'})
+        ydl.params['http_headers'] = HTTPHeaderDict(pooled.params['http_headers'])
+        ydl.params['outtmpl'] = opts.get('outtmpl', {})
+        ydl._parse_outtmpl()
+        ydl.format_selector = (
+            ydl.params['format'] if callable(ydl.params.get('format'))
+            else ydl.build_format_selector(ydl.params['format']) if ydl.params.get('format') else None
+        )
+        ydl._progress_hooks.clear()
+        for hook in opts.get('progress_hooks', []):
+            ydl.add_progress_hook(hook)
+
+    @contextmanager
+    def checkout(self, opts: dict):
+        """Выдает экземпляр с параметрами задачи (opts - как для конструктора YoutubeDL)"""
+        headers = dict(opts.get('http_headers') or {})
+        pooled = self._acquire(headers)
+        healthy = False
+        try:
+            self._prepare(pooled, opts)
+            yield pooled.ydl
+            healthy = True
+        finally:
+            pooled.uses += 1
+            pooled.ydl._progress_hooks.clear()
+            self._release(pooled, healthy)
+
+    def warm(self, headers: dict | None = None, count: int | None = None):
+        """Создает экземпляры заранее и открывает соединения с YouTube (вызывается при запуске в потоке)"""
+        headers = dict(headers or {})
+        count = self.size if count is None else count
+        started = time.monotonic()
+        warmed = []
+        for _ in range(count):
+            pooled = self._create(headers)
+            if YDL_POOL_WARMUP_URL:
+                try:
+                    pooled.ydl.urlopen(Request(YDL_POOL_WARMUP_URL, extensions={'timeout': WARMUP_TIMEOUT})).read()
+                except Exception as e:
+                    logger.warning(f"Прогрев соединения с YouTube не удался: {e}")
+            warmed.append(pooled)
+        for pooled in warmed:
+            self._release(pooled, healthy=True)
+        logger.info(f"Пул YoutubeDL прогрет: {len(warmed)} экз. за {time.monotonic() - started:.1f}s")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"ydl_idle": len(self._idle), "ydl_created": self.created,
+                    "ydl_reused": self.reused, "ydl_recycled": self.recycled}